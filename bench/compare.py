@@ -0,0 +1,48 @@
+'''
+Compare two benchmark result files.
+    python -m bench.compare bench/results/baseline.json bench/results/after.json
+'''
+import json
+import argparse
+
+METRICS = ("throughput_per_second", "p50_ms", "p99_ms")
+HIGHER_IS_BETTER = {"throughput_per_second"}
+
+
+def load(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def change(before, after):
+    if not before:
+        return "n/a"
+    return f"{(after - before) / before * 100:+.1f}%"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare two benchmark result files")
+    parser.add_argument("before")
+    parser.add_argument("after")
+    args = parser.parse_args()
+    before, after = load(args.before), load(args.after)
+
+    print(f"{before['revision']} -> {after['revision']}")
+    print(f"{'scenario':<16}{'metric':<24}{'before':>12}{'after':>12}{'change':>10}")
+    for name, result in after["scenarios"].items():
+        baseline = before["scenarios"].get(name)
+        if baseline is None:
+            continue
+        rows = [(metric, baseline.get(metric, 0), result.get(metric, 0)) for metric in METRICS]
+        for metric in ("max_rss_mb", "rss_growth_mb"):
+            rows.append((metric, baseline["memory"].get(metric, 0), result["memory"].get(metric, 0)))
+        for metric, old, new in rows:
+            marker = ""
+            if old and new != old:
+                better = (new > old) == (metric in HIGHER_IS_BETTER)
+                marker = "" if better else " !"
+            print(f"{name:<16}{metric:<24}{old:>12}{new:>12}{change(old, new):>10}{marker}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,280 @@
+'''
+Local Microsoft Graph stand-in for benchmarks.
+Serves deterministic mail folders, messages (HTML bodies of configurable size),
+file attachments, range paging with @odata.nextLink, delta queries, JSON $batch,
+subscriptions, and optional 429 injection with Retry-After.
+    python -m bench.fake_graph --port 8765
+'''
+import re
+import json
+import base64
+import random
+import hashlib
+import argparse
+import threading
+from datetime import datetime, timedelta, timezone
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs, urlencode
+
+FOLDERS = {"folder-bloomberg": "Bloomberg", "folder-shuchuang": "Shuchuang"}
+EPOCH = datetime(2025, 1, 1, tzinfo=timezone.utc)
+
+
+class FakeGraphConfig:
+    def __init__(self, body_kb=64, attachment_kb=256, attachments_per_message=1,
+                 messages_per_folder=500, page_size=50, throttle_rate=0.0, retry_after=1):
+        self.body_kb = body_kb
+        self.attachment_kb = attachment_kb
+        self.attachments_per_message = attachments_per_message
+        self.messages_per_folder = messages_per_folder
+        self.page_size = page_size
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+
+
+def message_id(index):
+    """Long opaque ids shaped like Graph's, with the message index recoverable from them."""
+    return f"AAMkAD{index:010d}" + hashlib.sha1(str(index).encode()).hexdigest()[:30] + "AAA="
+
+
+def message_index(msg_id):
+    return int(msg_id[6:16]) if msg_id.startswith("AAMkAD") else 0
+
+
+class FakeGraph:
+    def __init__(self, config):
+        self.config = config
+        self.requests = 0
+        self.throttled = 0
+        self._lock = threading.Lock()
+        self.subscriptions = {}
+
+    # ---- content ----
+    def html_body(self, index):
+        size = self.config.body_kb * 1024
+        row = f"<tr><td>Ticker {index}</td><td>{index * 3.14:.2f}</td><td>Bloomberg market wrap</td></tr>"
+        table = "<table>" + row * max(1, size // len(row)) + "</table>"
+        return f"<html><body><h1>Newsletter {index}</h1><p>Daily <b>summary</b>.</p>{table}</body></html>"
+
+    def attachment_bytes(self, index, n=0):
+        # Distinct per attachment so content-addressed storage cannot dedup the whole run into one file
+        rnd = random.Random(index * 1000 + n)
+        line = ",".join(str(rnd.randint(0, 10_000)) for _ in range(16)) + "\n"
+        size = self.config.attachment_kb * 1024
+        return (line * (size // len(line) + 1)).encode()[:size]
+
+    def message(self, index, expand=False):
+        folder_id = "folder-shuchuang" if index % 2 else "folder-bloomberg"
+        received = EPOCH + timedelta(minutes=index)
+        msg = {
+            "id": message_id(index),
+            "subject": f"Message {index}",
+            "receivedDateTime": received.strftime("%Y-%m-%dT%H:%M:%SZ"),
+            "body": {"contentType": "html", "content": self.html_body(index) if folder_id == "folder-bloomberg" else ""},
+            "from": {"emailAddress": {"address": "news@bloomberg.example"}},
+            "parentFolderId": folder_id,
+            "categories": [],
+        }
+        if expand:
+            msg["attachments"] = self.attachments(index, with_content=True)
+        return msg
+
+    def attachments(self, index, with_content=True):
+        received = EPOCH + timedelta(minutes=index)
+        items = []
+        for n in range(self.config.attachments_per_message):
+            item = {
+                "@odata.type": "#microsoft.graph.fileAttachment",
+                "id": f"att-{index}-{n}",
+                "name": f"report-{index}-{n}.csv",
+                "contentType": "text/csv",
+                "size": self.config.attachment_kb * 1024,
+                "lastModifiedDateTime": received.strftime("%Y-%m-%dT%H:%M:%SZ"),
+            }
+            if with_content:
+                item["contentBytes"] = base64.b64encode(self.attachment_bytes(index, n)).decode()
+            items.append(item)
+        return items
+
+    # ---- routing ----
+    def handle(self, method, raw_path, body):
+        """Return (status, headers, payload) where payload is dict / bytes / None."""
+        with self._lock:
+            self.requests += 1
+            if self.config.throttle_rate and random.random() < self.config.throttle_rate:
+                self.throttled += 1
+                return 429, {"Retry-After": str(self.config.retry_after)}, {"error": {"code": "TooManyRequests"}}
+
+        parts = urlsplit(raw_path)
+        path = re.sub(r"/+", "/", parts.path)
+        if path.startswith("/v1.0"):
+            path = path[len("/v1.0"):]
+        query = {k: v[0] for k, v in parse_qs(parts.query).items()}
+        segments = [s for s in path.strip("/").split("/") if s]
+        lowered = [s.lower() for s in segments]
+
+        if method == "POST" and lowered == ["$batch"]:
+            return 200, {}, self.batch(body)
+        if lowered == ["me"]:
+            return 200, {}, {"id": "user-1", "mail": "bench@example.com"}
+        if lowered == ["me", "mailfolders"]:
+            return 200, {}, {"value": [{"id": fid, "displayName": name} for fid, name in FOLDERS.items()]}
+        if lowered[:1] == ["subscriptions"]:
+            return self.subscriptions_route(method, segments, body)
+        if len(lowered) >= 4 and lowered[:2] == ["me", "mailfolders"] and lowered[3] == "messages":
+            if len(lowered) == 5 and lowered[4] == "delta":
+                return 200, {}, self.delta_page(segments[2], query)
+            return 200, {}, self.range_page(segments[2], query)
+
+        # me/messages/{id}[/attachments[/{aid}[/$value]]] or Users/{uid}/Messages/{id}
+        if lowered[:2] == ["me", "messages"]:
+            rest = segments[2:]
+        elif lowered[:1] == ["users"] and len(lowered) >= 4 and lowered[2] == "messages":
+            rest = segments[3:]
+        else:
+            return 404, {}, {"error": {"code": "NotFound", "message": path}}
+        index = message_index(rest[0])
+        if len(rest) == 1:
+            return 200, {}, self.message(index, expand="attachments" in query.get("$expand", ""))
+        if len(rest) == 2 and rest[1].lower() == "attachments":
+            return 200, {}, {"value": self.attachments(index, with_content="$select" not in query)}
+        if len(rest) == 4 and rest[3].lower() == "$value":
+            n = int(rest[2].rsplit("-", 1)[-1]) if rest[2].startswith("att-") else 0
+            return 200, {"Content-Type": "application/octet-stream"}, self.attachment_bytes(index, n)
+        return 404, {}, {"error": {"code": "NotFound", "message": path}}
+
+    def batch(self, body):
+        responses = []
+        for item in (body or {}).get("requests", []):
+            status, headers, payload = self.handle(item.get("method", "GET"), "/v1.0" + item["url"], item.get("body"))
+            responses.append({"id": item["id"], "status": status, "headers": headers, "body": payload})
+        return {"responses": responses}
+
+    def folder_indexes(self, folder_id):
+        parity = 1 if folder_id == "folder-shuchuang" else 0
+        return [i for i in range(2 * self.config.messages_per_folder) if i % 2 == parity]
+
+    def range_page(self, folder_id, query):
+        skip = int(query.get("$skip", 0))
+        top = int(query.get("$top", self.config.page_size))
+        indexes = self.folder_indexes(folder_id)
+        filt = query.get("$filter", "")
+        bounds = re.findall(r"receivedDateTime (ge|lt) (\S+)", filt)
+        for op, value in bounds:
+            dt = datetime.fromisoformat(value.replace("Z", "+00:00"))
+            if op == "ge":
+                indexes = [i for i in indexes if EPOCH + timedelta(minutes=i) >= dt]
+            else:
+                indexes = [i for i in indexes if EPOCH + timedelta(minutes=i) < dt]
+        page = indexes[skip: skip + top]
+        data = {"value": [self.message(i) for i in page]}
+        if skip + top < len(indexes):
+            next_query = dict(query, **{"$skip": skip + top, "$top": top})
+            data["@odata.nextLink"] = f"{self.base_url}/me/mailFolders/{folder_id}/messages?{urlencode(next_query)}"
+        return data
+
+    def delta_page(self, folder_id, query):
+        skip = int(query.get("skip", 0))
+        if query.get("deltatoken"):
+            return {"value": [], "@odata.deltaLink": f"{self.base_url}/me/mailFolders/{folder_id}/messages/delta?deltatoken=1"}
+        indexes = self.folder_indexes(folder_id)
+        page = indexes[skip: skip + self.config.page_size]
+        data = {"value": [self.message(i) for i in page]}
+        if skip + self.config.page_size < len(indexes):
+            data["@odata.nextLink"] = f"{self.base_url}/me/mailFolders/{folder_id}/messages/delta?skip={skip + self.config.page_size}"
+        else:
+            data["@odata.deltaLink"] = f"{self.base_url}/me/mailFolders/{folder_id}/messages/delta?deltatoken=1"
+        return data
+
+    def subscriptions_route(self, method, segments, body):
+        expiration = (datetime.now(timezone.utc) + timedelta(days=3)).strftime("%Y-%m-%dT%H:%M:%SZ")
+        if method == "GET" and len(segments) == 1:
+            return 200, {}, {"value": list(self.subscriptions.values())}
+        if method == "POST" and len(segments) == 1:
+            sub_id = f"sub-{len(self.subscriptions) + 1}"
+            self.subscriptions[sub_id] = dict(body or {}, id=sub_id, expirationDateTime=expiration)
+            return 201, {}, self.subscriptions[sub_id]
+        sub = self.subscriptions.get(segments[1]) if len(segments) == 2 else None
+        if sub is None:
+            return 404, {}, {"error": {"code": "NotFound"}}
+        if method == "PATCH":
+            sub["expirationDateTime"] = expiration
+            return 200, {}, sub
+        if method == "DELETE":
+            del self.subscriptions[segments[1]]
+            return 204, {}, None
+        return 200, {}, sub
+
+
+def make_handler(graph):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1" # Keep-alive, like Graph
+
+        def _dispatch(self, method):
+            length = int(self.headers.get("Content-Length") or 0)
+            raw = self.rfile.read(length) if length else b""
+            body = json.loads(raw) if raw else None
+            status, headers, payload = graph.handle(method, self.path, body)
+            if isinstance(payload, bytes):
+                data = payload
+            elif payload is None:
+                data = b""
+            else:
+                data = json.dumps(payload).encode()
+                headers = dict(headers, **{"Content-Type": "application/json"})
+            self.send_response(status)
+            for key, value in headers.items():
+                self.send_header(key, value)
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            self._dispatch("GET")
+
+        def do_POST(self):
+            self._dispatch("POST")
+
+        def do_PATCH(self):
+            self._dispatch("PATCH")
+
+        def do_DELETE(self):
+            self._dispatch("DELETE")
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def start_fake_graph(config, host="127.0.0.1", port=0):
+    """Start the fake Graph server in a daemon thread; returns (server, graph, base_url)."""
+    graph = FakeGraph(config)
+    server = ThreadingHTTPServer((host, port), make_handler(graph))
+    server.daemon_threads = True
+    graph.base_url = f"http://{host}:{server.server_address[1]}/v1.0"
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, graph, graph.base_url + "/"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local Microsoft Graph stand-in")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--body-kb", type=int, default=64)
+    parser.add_argument("--attachment-kb", type=int, default=256)
+    parser.add_argument("--attachments-per-message", type=int, default=1)
+    parser.add_argument("--messages-per-folder", type=int, default=500)
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="Fraction of requests answered with 429")
+    args = parser.parse_args()
+    config = FakeGraphConfig(args.body_kb, args.attachment_kb, args.attachments_per_message,
+                             args.messages_per_folder, throttle_rate=args.throttle_rate)
+    server, _, base_url = start_fake_graph(config, port=args.port)
+    print(f"Fake Graph listening on {base_url}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+'''
+Open-loop load generator replaying Graph change notifications against /notifications.
+    python -m bench.loadgen --target http://127.0.0.1:8000/notifications --rate 50 --duration 30
+'''
+import time
+import json
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from bench.fake_graph import message_id
+
+
+def make_notifications(start_index, count, client_state="secretClientValue", subscription_id="sub-bench"):
+    """Graph-shaped change notifications for messages start_index .. start_index + count - 1."""
+    return [
+        {
+            "subscriptionId": subscription_id,
+            "clientState": client_state,
+            "changeType": "created",
+            "resource": f"Users/user-1/Messages/{message_id(i)}",
+            "resourceData": {
+                "@odata.type": "#Microsoft.Graph.Message",
+                "@odata.id": f"Users/user-1/Messages/{message_id(i)}",
+                "id": message_id(i),
+            },
+            "tenantId": "bench-tenant",
+        }
+        for i in range(start_index, start_index + count)
+    ]
+
+
+def run_load(target, rate, duration, batch_size=1, start_index=0, client_state="secretClientValue", concurrency=32):
+    """
+    POST `rate` webhook payloads per second for `duration` seconds, each with `batch_size` notifications.
+    return: dict with sent/accepted counts and acknowledgement latencies (seconds)
+    """
+    session = requests.Session()
+    latencies = []
+    statuses = {}
+    lock = threading.Lock()
+
+    def send(index):
+        payload = {"value": make_notifications(start_index + index * batch_size, batch_size, client_state)}
+        started = time.perf_counter()
+        try:
+            status = session.post(target, data=json.dumps(payload),
+                                  headers={"Content-Type": "application/json"}, timeout=30).status_code
+        except requests.RequestException:
+            status = "error"
+        elapsed = time.perf_counter() - started
+        with lock:
+            latencies.append(elapsed)
+            statuses[status] = statuses.get(status, 0) + 1
+
+    total = int(rate * duration)
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for index in range(total):
+            # Open loop: schedule by wall clock so slow responses do not lower the offered rate
+            delay = started + index / rate - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            executor.submit(send, index)
+    wall = time.perf_counter() - started
+    return {
+        "requests": total,
+        "notifications": total * batch_size,
+        "statuses": {str(k): v for k, v in statuses.items()},
+        "latencies": latencies,
+        "wall_seconds": wall,
+    }
+
+
+def main():
+    from bench.run import summarize
+    parser = argparse.ArgumentParser(description="Replay webhook notifications against /notifications")
+    parser.add_argument("--target", default="http://127.0.0.1:8000/notifications")
+    parser.add_argument("--rate", type=float, default=20, help="Requests per second")
+    parser.add_argument("--duration", type=float, default=10, help="Seconds")
+    parser.add_argument("--batch-size", type=int, default=1, help="Notifications per request")
+    parser.add_argument("--start-index", type=int, default=1_000_000)
+    args = parser.parse_args()
+    result = run_load(args.target, args.rate, args.duration, args.batch_size, args.start_index)
+    print(json.dumps(dict(summarize(result.pop("latencies"), result["wall_seconds"], result["requests"]), **result), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,258 @@
+'''
+Offline benchmark for the ingestion path.
+Runs the service against a local fake Graph server (bench/fake_graph.py) and an
+in-memory or local MongoDB, then writes throughput, latency percentiles and memory
+to bench/results/<label>.json for comparison across commits (bench/compare.py).
+Each scenario runs in its own process, so its peak RSS is not inherited from the previous ones.
+    python -m bench.run --label baseline
+    python -m bench.run --label after --scenarios handle_batch,save_emails --mongo-uri mongodb://localhost:27017
+'''
+import os
+import sys
+import json
+import time
+import resource
+import argparse
+import threading
+import tempfile
+import tracemalloc
+import subprocess
+from datetime import datetime, timedelta, timezone
+from bench.fake_graph import FakeGraphConfig, start_fake_graph, EPOCH
+from bench import standins
+
+SCENARIOS = ("notifications", "handle_batch", "save_emails", "backfill")
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def summarize(latencies, wall_seconds, items):
+    return {
+        "items": items,
+        "wall_seconds": round(wall_seconds, 4),
+        "throughput_per_second": round(items / wall_seconds, 2) if wall_seconds else 0.0,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 3),
+        "max_ms": round(max(latencies) * 1000, 3) if latencies else 0.0,
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "describe", "--always", "--dirty"],
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def _max_rss_mb():
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+class Measurement:
+    """
+    Wall time plus memory: tracemalloc peak (optional, slows Python code) and the max RSS of
+    the scenario's process, before (setup) and after the measured run.
+    """
+    def __init__(self, trace_memory):
+        self.trace_memory = trace_memory
+
+    def __enter__(self):
+        self.setup_rss_mb = _max_rss_mb()
+        if self.trace_memory:
+            tracemalloc.start()
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.wall_seconds = time.perf_counter() - self.started
+        max_rss_mb = _max_rss_mb()
+        self.memory = {
+            "max_rss_mb": max_rss_mb,
+            "setup_rss_mb": self.setup_rss_mb,
+            "rss_growth_mb": round(max_rss_mb - self.setup_rss_mb, 1),
+        }
+        if self.trace_memory:
+            self.memory["traced_peak_mb"] = round(tracemalloc.get_traced_memory()[1] / 2**20, 2)
+            tracemalloc.stop()
+        return False
+
+
+class IndexAllocator:
+    """Hands out fresh message indexes so no scenario is short-circuited by dedup."""
+    def __init__(self, start):
+        self._next = start
+        self._lock = threading.Lock()
+
+    def take(self, count):
+        with self._lock:
+            start = self._next
+            self._next += count
+        return start
+
+
+def scenario_handle_batch(ctx, args):
+    from bench.loadgen import make_notifications
+    service = ctx["service"]
+    latencies = []
+    with Measurement(args.trace_memory) as m:
+        for _ in range(args.iterations):
+            batch = make_notifications(ctx["indexes"].take(args.batch_size), args.batch_size)
+            started = time.perf_counter()
+            service.handle_notification_batch(batch)
+            latencies.append(time.perf_counter() - started)
+    return dict(summarize(latencies, m.wall_seconds, args.iterations * args.batch_size), memory=m.memory)
+
+
+def scenario_save_emails(ctx, args):
+    graph, api = ctx["graph"], ctx["api"]
+    batches = []
+    for _ in range(args.iterations):
+        start = ctx["indexes"].take(args.batch_size)
+        batches.append([graph.message(i, expand=True) for i in range(start, start + args.batch_size)])
+    latencies = []
+    with Measurement(args.trace_memory) as m:
+        for batch in batches:
+            started = time.perf_counter()
+            api.save_emails_to_db(batch)
+            latencies.append(time.perf_counter() - started)
+    return dict(summarize(latencies, m.wall_seconds, args.iterations * args.batch_size), memory=m.memory)
+
+
+def scenario_backfill(ctx, args):
+    service = ctx["service"]
+    end = EPOCH + timedelta(minutes=2 * args.messages_per_folder)
+    with Measurement(args.trace_memory) as m:
+        saved = service.backfill_range(EPOCH, end, slice_hours=1, concurrency=args.concurrency)
+    return dict(summarize([m.wall_seconds], m.wall_seconds, saved), memory=m.memory)
+
+
+def scenario_notifications(ctx, args):
+    """Webhook acknowledgement latency under load, then time for the workers to drain the queue."""
+    from werkzeug.serving import make_server
+    from bench.loadgen import run_load
+    import src.app as service_app
+
+    server = make_server("127.0.0.1", 0, service_app.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    target = f"http://127.0.0.1:{server.server_port}/notifications"
+    requests_total = int(args.rate * args.duration)
+    start_index = ctx["indexes"].take(requests_total * args.batch_size)
+
+    service_app.ingestion_pool.start()
+    try:
+        with Measurement(args.trace_memory) as m:
+            load = run_load(target, args.rate, args.duration, args.batch_size, start_index)
+            deadline = time.monotonic() + args.drain_timeout
+            while service_app.ingestion_queue.depth() and time.monotonic() < deadline:
+                time.sleep(0.05)
+    finally:
+        service_app.ingestion_pool.stop()
+        server.shutdown()
+
+    ack = summarize(load["latencies"], load["wall_seconds"], load["requests"])
+    return dict(summarize(load["latencies"], m.wall_seconds, load["notifications"]),
+                ack=ack, statuses=load["statuses"], undrained=service_app.ingestion_queue.depth(), memory=m.memory)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Offline ingestion benchmark")
+    parser.add_argument("--label", default=None, help="Results file name, defaults to the git revision")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+    parser.add_argument("--iterations", type=int, default=20)
+    parser.add_argument("--batch-size", type=int, default=20)
+    parser.add_argument("--concurrency", type=int, default=4, help="Backfill slices in parallel")
+    parser.add_argument("--rate", type=float, default=20, help="Webhook requests per second")
+    parser.add_argument("--duration", type=float, default=10, help="Webhook load seconds")
+    parser.add_argument("--drain-timeout", type=float, default=120)
+    parser.add_argument("--body-kb", type=int, default=64)
+    parser.add_argument("--attachment-kb", type=int, default=256)
+    parser.add_argument("--attachments-per-message", type=int, default=1)
+    parser.add_argument("--messages-per-folder", type=int, default=500)
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="Fraction of Graph requests answered 429")
+    parser.add_argument("--mongo-uri", default=os.getenv("BENCH_MONGO_URI"), help="Local MongoDB, default mongomock")
+    parser.add_argument("--trace-memory", action="store_true", help="Record tracemalloc peaks")
+    parser.add_argument("--child-output", default=None, help=argparse.SUPPRESS) # Set for the per-scenario process
+    return parser.parse_args(argv)
+
+
+def run_scenario(name, args):
+    """Run one scenario in this process. return: (result, backend, graph request counts)"""
+    config = FakeGraphConfig(args.body_kb, args.attachment_kb, args.attachments_per_message,
+                             args.messages_per_folder, throttle_rate=args.throttle_rate, retry_after=0)
+    server, graph, graph_url = start_fake_graph(config)
+    standins.configure_environment(graph_url)
+    standins.install_auth()
+    backend = standins.install_mongo(args.mongo_uri)
+
+    from src.outlook_api import OutlookAPI
+    from src.service import OutlookService
+    api = OutlookAPI(auth=standins.StaticTokenAuth())
+    service = OutlookService(outlook_api=api)
+    api.get_user_folder_ids()
+    ctx = {"graph": graph, "api": api, "service": service, "indexes": IndexAllocator(1_000_000)}
+
+    try:
+        result = globals()[f"scenario_{name}"](ctx, args)
+    finally:
+        server.shutdown()
+    return result, backend, {"requests": graph.requests, "throttled": graph.throttled}
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else list(argv)
+    args = parse_args(argv)
+    scenarios = [s.strip() for s in args.scenarios.split(",") if s.strip()]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        sys.exit(f"Unknown scenario(s): {', '.join(sorted(unknown))}")
+
+    if args.child_output:
+        result, backend, graph = run_scenario(scenarios[0], args)
+        with open(args.child_output, "w") as f:
+            json.dump({"result": result, "backend": backend, "graph": graph}, f)
+        return
+
+    results = {}
+    backend = None
+    graph = {"requests": 0, "throttled": 0}
+    for name in scenarios:
+        print(f"Running {name} ...", flush=True)
+        fd, output = tempfile.mkstemp(prefix="bench-", suffix=".json")
+        os.close(fd)
+        try:
+            # Last --scenarios wins in argparse
+            subprocess.run([sys.executable, "-m", "bench.run", *argv, "--scenarios", name, "--child-output", output],
+                           check=True)
+            with open(output) as f:
+                child = json.load(f)
+        finally:
+            os.remove(output)
+        results[name], backend = child["result"], child["backend"]
+        graph = {k: graph[k] + child["graph"][k] for k in graph}
+        print(json.dumps(results[name], indent=2), flush=True)
+
+    results_doc = {
+        "revision": git_revision(),
+        "timestamp": datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ"),
+        "mongo_backend": backend,
+        "config": {k: v for k, v in vars(args).items() if k != "child_output"},
+        "graph": graph,
+        "scenarios": results,
+    }
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    path = os.path.join(RESULTS_DIR, f"{args.label or results_doc['revision']}.json")
+    with open(path, "w") as f:
+        json.dump(results_doc, f, indent=2)
+    print(f"Results written to {path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+'''
+Local stand-ins wired into the service for offline benchmarks:
+a static bearer token instead of MSAL, and an in-memory (mongomock) or local
+MongoDB instead of the production cluster. Call configure_environment() before
+importing anything from src, since modules read their settings at import time.
+'''
+import os
+import tempfile
+
+
+class StaticTokenAuth:
+    """AuthManager stand-in: the fake Graph server accepts any token."""
+    def get_access_token(self):
+        return "bench-token"
+
+
+def configure_environment(graph_url, workdir=None, **overrides):
+    workdir = workdir or tempfile.mkdtemp(prefix="outlook-bench-")
+    settings = {
+        "OUTLOOK_GRAPH_URL": graph_url,
+        "MONGO_DB_NAME": "outlook_bench",
+        "MONGO_COLLECTION_BLOOMBERG": "bloomberg",
+        "MONGO_COLLECTION_SHUCHUANG": "shuchuang",
+        "MONGO_COLLECTION_SHUCHUANG_FS": "shuchuang_fs",
+        "INGEST_QUEUE_PATH": os.path.join(workdir, "ingest_queue.db"),
+        "LEADER_LOCK_FILE": os.path.join(workdir, "leader.lock"),
+        "DELTA_SYNC_INTERVAL_SECONDS": "0",
+        "GRAPH_BACKOFF_BASE": "0.05",
+    }
+    settings.update({key: str(value) for key, value in overrides.items()})
+    os.environ.update(settings)
+    return workdir
+
+
+def install_auth():
+    """Make the process-wide AuthManager (src.auth.get_auth_manager) a static token."""
+    import src.auth
+    src.auth._auth_manager = StaticTokenAuth()
+
+
+def install_mongo(uri=None):
+    """
+    Point the shared Mongo client at a local server (`uri`), or at mongomock when no uri is given.
+    return: a description of the backend for the results file
+    """
+    import src.mongo_service as mongodb
+    mongodb.close_shared_client()
+    if uri:
+        mongodb.MONGO_URI = uri
+        client = mongodb.get_shared_client()
+        client.client.drop_database(mongodb.MONGO_DB_NAME)
+        return "mongodb"
+
+    import mongomock
+    import mongomock.gridfs
+    mongomock.gridfs.enable_gridfs_integration()
+    client = mongodb.MongoDBClient.__new__(mongodb.MongoDBClient)
+    client.client = mongomock.MongoClient()
+    client.db = client.client[mongodb.MONGO_DB_NAME]
+    mongodb._shared_client = client
+    return "mongomock"
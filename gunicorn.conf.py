@@ -0,0 +1,26 @@
+'''
+Production server configuration: N gunicorn worker processes behind nginx.
+    gunicorn -c gunicorn.conf.py src.app:app
+Each worker drains the shared ingestion queue; only the elected leader
+runs the subscription lifecycle (see src/leader.py).
+'''
+import os
+
+bind = os.getenv("WEB_BIND", "0.0.0.0:8000")
+workers = int(os.getenv("WEB_WORKERS", "4"))
+threads = int(os.getenv("WEB_THREADS", "4"))
+worker_class = "gthread"
+timeout = int(os.getenv("WEB_TIMEOUT", "60"))
+graceful_timeout = int(os.getenv("WEB_GRACEFUL_TIMEOUT", "30"))
+keepalive = 75 # Longer than nginx's upstream keepalive_timeout (60s)
+accesslog = None # Its synchronous, unredacted request lines (with ?validationToken=) would bypass src/logging_setup.py
+
+
+def post_worker_init(worker):
+    from src.app import start_background_services
+    start_background_services()
+
+
+def worker_exit(server, worker):
+    from src.app import stop_background_services
+    stop_background_services()
@@ -1,22 +1,26 @@
 import os
-import threading
 import logging
-import sys
-from flask import Flask, jsonify, request
-from src.auth import AuthManager
+import time
+import threading
+from flask import Flask, Response, jsonify, request
+from src.logging_setup import configure_logging
 from src.service import OutlookService
-from src.outlook_api import OutlookAPI
+from src.outlook_api import OutlookAPI, CLIENT_STATE
+from src.ingestion_queue import NotificationQueue, IngestionWorkerPool, QueueFullError
+from src.leader import LeaderElector, make_leader_lock
+from src.query_api import query_api
+import src.mongo_service as mongodb
+from src import metrics, write_behind
 
+configure_logging()
 app = Flask(__name__)
-auth_manager = AuthManager()
-outlook_api = OutlookAPI(auth=auth_manager)
+app.register_blueprint(query_api)
+outlook_api = OutlookAPI() # Construction is offline; the token is acquired by the first Graph call
 outlook_service = OutlookService(outlook_api=outlook_api)
-
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s [%(levelname)s] %(name)s: %(message)s",
-    handlers=[logging.StreamHandler(sys.stdout)],
-)
+ingestion_queue = NotificationQueue()
+ingestion_pool = IngestionWorkerPool(ingestion_queue, outlook_service.handle_notification_batch)
+DELTA_SYNC_INTERVAL_SECONDS = int(os.getenv("DELTA_SYNC_INTERVAL_SECONDS", "900")) # 0 disables the safety-net sync
+ATTACHMENT_RECONCILE_SECONDS = int(os.getenv("ATTACHMENT_RECONCILE_SECONDS", "86400")) # 0 disables the refCount repair
 
 @app.route('/')
 def home():
@@ -26,13 +30,55 @@ def home():
 def health_check():
     return "OK", 200
 
+@app.route('/stats')
+def stats():
+    return jsonify({
+        "queue": ingestion_queue.stats(),
+        "graph_connections": outlook_api.connection_stats(),
+        "graph_throttling": outlook_api.throttle.stats(),
+        "dedup": outlook_service.seen_cache.stats(),
+        "html_conversion": outlook_api.converter.stats(),
+        "write_behind": write_behind.get_write_buffer().stats() if write_behind.WRITE_BEHIND_ENABLED else None,
+    }), 200
+
+def _runtime_gauges():
+    """Scrape-time gauges from the queue, Graph client, dedup cache and converter."""
+    queue = ingestion_queue.stats()
+    connections = outlook_api.connection_stats()
+    throttling = outlook_api.throttle.stats()
+    dedup = outlook_service.seen_cache.stats()
+    gauges = [
+        ("outlook_queue_depth", "Notifications waiting or in flight", {}, queue["depth"]),
+        ("outlook_queue_in_flight", "Notifications claimed by workers", {}, queue["in_flight"]),
+        ("outlook_queue_backing_off", "Failed notifications waiting for their retry", {}, queue["backing_off"]),
+        ("outlook_queue_dead", "Dead-lettered notifications", {}, queue["dead"]),
+        ("outlook_queue_oldest_age_seconds", "Age of the oldest queued notification", {}, queue["oldest_age_seconds"]),
+        ("outlook_graph_connections_opened", "New connections opened to Graph", {}, connections["connections_opened"]),
+        ("outlook_graph_connections_reused", "Graph requests sent on a reused connection", {}, connections["connections_reused"]),
+        ("outlook_graph_throttle_events", "429/503 responses seen", {}, throttling["throttle_events"]),
+        ("outlook_dedup_cache_hits", "Notifications skipped by the in-memory seen cache", {}, dedup["cache_hits"]),
+        ("outlook_dedup_store_hits", "Notifications skipped by the Mongo existence lookup", {}, dedup["store_hits"]),
+        ("outlook_dedup_misses", "Notifications that required a Graph fetch", {}, dedup["misses"]),
+    ]
+    for mailbox, limiter in throttling["mailboxes"].items():
+        gauges.append(("outlook_graph_concurrency_limit", "Adaptive Graph concurrency limit",
+                       {"mailbox": mailbox}, limiter["limit"]))
+        gauges.append(("outlook_graph_in_flight", "Graph requests in flight", {"mailbox": mailbox}, limiter["in_flight"]))
+    return gauges
+
+metrics.REGISTRY.register_collector(_runtime_gauges)
+
+@app.route('/metrics')
+def prometheus_metrics():
+    return Response(metrics.REGISTRY.render(), mimetype="text/plain; version=0.0.4")
+
+webhook_log = logging.getLogger("src.webhook") # Sampled, see WEBHOOK_LOG_SAMPLE_RATE
+
 @app.route('/notifications', methods=['GET', 'POST'])
 def notifications():
-    logging.info("Incoming /notifications: %s %s %s", request.method, request.args, request.data)
-    
     validation_token = request.args.get("validationToken")
     if validation_token:
-        logging.info("Validation token received: %s", validation_token)
+        logging.info("Subscription validation request received")
         # MUST echo back the token as plain text
         return validation_token, 200, {"Content-Type": "text/plain"}
 
@@ -41,24 +87,107 @@ def notifications():
         payload = request.get_json(force=True, silent=True) or {}
     except Exception:
         payload = {}
-    logging.info("Notification payload: %s", payload)
-    notifications = payload.get("value", [])
+    received = payload.get("value", [])
+    notifications = [
+        n for n in received
+        if n.get("resource") and n.get("clientState") == CLIENT_STATE
+    ]
+    metrics.NOTIFICATIONS_RECEIVED.inc(len(received) - len(notifications), result="invalid")
     
     if not notifications:
+        webhook_log.info("Notifications received", extra={"received": len(received), "valid": 0})
         return "No notifications", 202
-    saved_count = outlook_service.handle_notification_batch(notifications)
+    received_at = time.time()
+    for n in notifications:
+        n["receivedAt"] = received_at # For the end-to-end lag metric
+    # Acknowledge fast: Graph expects a response within ~3 seconds, workers do the fetch + save
+    try:
+        queued_count = ingestion_queue.put(notifications)
+    except QueueFullError:
+        metrics.NOTIFICATIONS_RECEIVED.inc(len(notifications), result="rejected")
+        logging.warning("Ingestion queue full, rejecting %d notification(s)", len(notifications))
+        return "Queue full", 503, {"Retry-After": "30"}
+    metrics.NOTIFICATIONS_RECEIVED.inc(queued_count, result="queued")
+    webhook_log.info("Notifications received", extra={"received": len(received), "valid": len(notifications),
+                                                       "queued": queued_count})
     
-    return jsonify({"status": "Notifications processed",
-                    "saved": saved_count}), 202
+    return jsonify({"status": "Notifications queued",
+                    "queued": queued_count}), 202
+
+@app.route('/lifecycle', methods=['GET', 'POST'])
+def lifecycle_notifications():
+    """Lifecycle events of subscriptions with resource data (GRAPH_RICH_NOTIFICATIONS)."""
+    validation_token = request.args.get("validationToken")
+    if validation_token:
+        return validation_token, 200, {"Content-Type": "text/plain"}
+
+    payload = request.get_json(force=True, silent=True) or {}
+    for event in payload.get("value", []):
+        if event.get("clientState") != CLIENT_STATE:
+            continue
+        subscription_id = event.get("subscriptionId")
+        lifecycle_event = event.get("lifecycleEvent")
+        logging.info("Lifecycle event %s for subscription %s", lifecycle_event, subscription_id)
+        if lifecycle_event == "reauthorizationRequired":
+            # Renewing reauthorizes; off the request thread, Graph expects a quick answer
+            threading.Thread(target=_reauthorize_subscription, args=(subscription_id,), daemon=True).start()
+        elif lifecycle_event == "missed":
+            # Dropped notifications are recovered by the leader's periodic delta sync
+            logging.warning("Graph missed notifications for subscription %s", subscription_id)
+        # subscriptionRemoved: the leader's next reconcile recreates it
+    return "", 202
+
+def _reauthorize_subscription(subscription_id):
+    try:
+        outlook_service.extend_subscription(subscription_id)
+    except Exception:
+        logging.exception("Failed to reauthorize subscription %s", subscription_id)
     
-def start_subscription_lifecycle():
+def start_subscription_lifecycle(stop_event=None):
     callback_url = os.getenv(
         "PUBLIC_BASE_URL",
         "http://127.0.0.1:8000"
     ) + "/notifications"
-    outlook_service.subscription_lifecycle(callback_url)
+    outlook_service.subscription_lifecycle(callback_url, stop_event=stop_event)
+
+def start_delta_sync_loop(stop_event=None):
+    outlook_service.delta_sync_loop(DELTA_SYNC_INTERVAL_SECONDS, stop_event=stop_event)
+
+def start_attachment_reconcile_loop(stop_event=None):
+    stop_event = stop_event or threading.Event()
+    while not stop_event.wait(ATTACHMENT_RECONCILE_SECONDS):
+        try:
+            mongodb.get_shared_client().reconcile_attachment_refcounts()
+        except Exception:
+            logging.exception("Attachment refCount reconcile failed, will retry next cycle")
+
+# Subscription lifecycle and delta sync must run in exactly one process: the elected leader
+leader_duties = [start_subscription_lifecycle]
+if DELTA_SYNC_INTERVAL_SECONDS > 0:
+    leader_duties.append(start_delta_sync_loop)
+if ATTACHMENT_RECONCILE_SECONDS > 0:
+    leader_duties.append(start_attachment_reconcile_loop)
+leader_elector = LeaderElector(make_leader_lock(), leader_duties)
+
+def start_background_services():
+    """Start ingestion workers and leader election; called once in every serving process."""
+    try:
+        mongodb.get_shared_client().ensure_indexes()
+    except Exception:
+        logging.exception("Could not ensure MongoDB indexes, queries may scan collections")
+    ingestion_pool.start()
+    leader_elector.start()
+    metrics.REGISTRY.start_snapshots() # So a scrape landing on any worker reports every worker
+
+def stop_background_services():
+    """Stop background work and release the leader lock (gunicorn worker exit)."""
+    leader_elector.stop()
+    ingestion_pool.stop()
+    metrics.REGISTRY.stop_snapshots()
+    write_behind.close_write_buffer() # Writes still buffered must reach Mongo before the client closes
+    mongodb.close_shared_client()
 
 if __name__ == '__main__':
-    t = threading.Thread(target=start_subscription_lifecycle, daemon=True)
-    t.start()
+    # Development server; production runs gunicorn with gunicorn.conf.py
+    start_background_services()
     app.run(host='0.0.0.0', port=8000)
\ No newline at end of file
@@ -3,50 +3,201 @@ from dotenv import load_dotenv
 import logging
 import json
 from msal import PublicClientApplication, SerializableTokenCache
-import sys
+import time
+import atexit
+import tempfile
+import threading
+from contextlib import contextmanager
+from src import metrics
+from src.logging_setup import configure_logging
 
 load_dotenv()
 OUTLOOK_CLIENT_ID = os.getenv("OUTLOOK_CLIENT_ID")
 OUTLOOK_URL = "https://graph.microsoft.com/v1.0/" # Used API version 1.0
 AUTHORITY = "https://login.microsoftonline.com/consumers"
 SCOPES = ["Mail.Read", "User.Read"]
-CACHE_FILE = "msal_cache.bin"
+CACHE_FILE = os.getenv("MSAL_CACHE_FILE", "msal_cache.bin") # Shared by every worker process
+CACHE_LOCK_FILE = f"{CACHE_FILE}.lock" # Serializes cache read-modify-writes across processes
+LOGIN_LOCK_FILE = f"{CACHE_FILE}.login.lock" # Held by the one process running the device code flow
+TOKEN_REFRESH_MARGIN = int(os.getenv("TOKEN_REFRESH_MARGIN", "300")) # Seconds before expiry to refresh
+CACHE_SAVE_DEBOUNCE = float(os.getenv("MSAL_CACHE_SAVE_DEBOUNCE", "5")) # Seconds to coalesce cache writes
 
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s [%(levelname)s] %(name)s: %(message)s",
-    handlers=[logging.StreamHandler(sys.stdout)],
-)
+_auth_manager = None
+_auth_manager_lock = threading.Lock()
+
+@contextmanager
+def _file_lock(path, shared=False):
+    """Hold a blocking flock on `path` (a no-op where fcntl is unavailable, e.g. Windows dev)."""
+    try:
+        import fcntl
+    except ImportError:
+        yield
+        return
+    with open(path, "a") as f:
+        fcntl.flock(f.fileno(), fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+def _read_cache_file():
+    """Return the serialized token cache on disk, or None."""
+    if not os.path.exists(CACHE_FILE):
+        return None
+    with _file_lock(CACHE_LOCK_FILE, shared=True):
+        with open(CACHE_FILE, "r") as f:
+            return f.read() or None
+
+def _merge_cache(on_disk, ours):
+    """
+    Merge our serialized cache over the one on disk, entry by entry, so tokens another
+    worker process wrote since we loaded are kept and ours (newer) win on conflicts.
+    """
+    try:
+        merged = json.loads(on_disk) if on_disk else {}
+    except ValueError:
+        merged = {}
+    for section, entries in json.loads(ours).items():
+        if isinstance(entries, dict) and isinstance(merged.get(section), dict):
+            merged[section].update(entries)
+        else:
+            merged[section] = entries
+    return json.dumps(merged, indent=4)
+
+def get_auth_manager():
+    """
+    Return the process-wide AuthManager, created on first use.
+    Construction is cheap: the token cache is read and a token acquired on the first Graph call.
+    """
+    global _auth_manager
+    if _auth_manager is None:
+        with _auth_manager_lock:
+            if _auth_manager is None:
+                _auth_manager = AuthManager()
+    return _auth_manager
 
 class AuthManager:
     def __init__(self):
-        self.cache = SerializableTokenCache() # Read token cache from file if exists
-        if os.path.exists(CACHE_FILE):
-            self.cache.deserialize(open(CACHE_FILE, "r").read())
+        self._cached_token = (None, 0.0) # (access_token, expires_at), swapped atomically
+        self._refresh_lock = threading.Lock()
+        self._save_lock = threading.Lock()
+        self._save_timer = None
+        self.cache = None # Token cache and MSAL app are loaded by the first token request
+        self.app = None
+        atexit.register(self._flush_cache)
 
+    def _load_client(self):
+        """Read the token cache file and build the MSAL app; called under the refresh lock."""
+        if self.app is not None:
+            return
+        cache = SerializableTokenCache() # Read token cache from file if exists
+        data = _read_cache_file()
+        if data:
+            cache.deserialize(data)
         self.app = PublicClientApplication(
             OUTLOOK_CLIENT_ID,
             authority=AUTHORITY,
-            token_cache=self.cache,
+            token_cache=cache,
         )
-        
-        token = self.get_access_token() # Get access token interactively or silently
-        self.headers = {"Authorization": f"Bearer {token}"}
-    
-    def _save_cache(self):
-        if self.cache.has_state_changed:
-            with open(CACHE_FILE, "w") as f:
-                f.write(self.cache.serialize())
-                
+        self.cache = cache
+
+    def _save_cache(self, immediate=False):
+        """Schedule a (debounced) write of the token cache, or write it now."""
+        if self.cache is None or not self.cache.has_state_changed:
+            return
+        if immediate:
+            self._flush_cache()
+            return
+        with self._save_lock:
+            if self._save_timer is None:
+                self._save_timer = threading.Timer(CACHE_SAVE_DEBOUNCE, self._flush_cache)
+                self._save_timer.daemon = True
+                self._save_timer.start()
+
+    def _flush_cache(self):
+        """
+        Atomically persist the token cache if it changed: under an exclusive flock, merge it
+        into the file on disk and rename a unique temp file over it, so concurrent worker
+        processes neither clobber each other's tokens nor leave a half-written file.
+        """
+        with self._save_lock:
+            if self._save_timer is not None:
+                self._save_timer.cancel()
+                self._save_timer = None
+            if self.cache is None or not self.cache.has_state_changed:
+                return
+            with _file_lock(CACHE_LOCK_FILE):
+                on_disk = None
+                if os.path.exists(CACHE_FILE):
+                    with open(CACHE_FILE, "r") as f:
+                        on_disk = f.read()
+                data = _merge_cache(on_disk, self.cache.serialize())
+                fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(CACHE_FILE)),
+                                                prefix=".msal_cache.", suffix=".tmp")
+                try:
+                    with os.fdopen(fd, "w") as f:
+                        f.write(data)
+                        f.flush()
+                        os.fsync(f.fileno())
+                    os.replace(tmp_file, CACHE_FILE)
+                except BaseException:
+                    if os.path.exists(tmp_file):
+                        os.remove(tmp_file)
+                    raise
+
     def get_access_token(self):
-        """Acquire access token if needed."""
+        """
+        Return the in-memory access token, acquiring it on first use and
+        refreshing it when it is close to expiry.
+        Only one thread refreshes at a time; the others wait and reuse its result.
+        """
+        token, expires_at = self._cached_token
+        if token and time.time() < expires_at - TOKEN_REFRESH_MARGIN:
+            return token
+
+        with self._refresh_lock:
+            token, expires_at = self._cached_token # Another thread may have refreshed meanwhile
+            if token and time.time() < expires_at - TOKEN_REFRESH_MARGIN:
+                return token
+            self._load_client()
+            with metrics.TOKEN_REFRESH_SECONDS.time():
+                result = self._acquire_token(force_refresh=token is not None)
+            metrics.TOKEN_REFRESHES.inc()
+            self._cached_token = (result['access_token'], time.time() + int(result.get('expires_in', 0)))
+            return result['access_token']
+
+    def _acquire_token(self, force_refresh=False):
+        """Acquire access token silently, falling back to the device code flow."""
         account = self.app.get_accounts() 
         if account: # Try to acquire token silently
-            result = self.app.acquire_token_silent(SCOPES, account=account[0])
+            result = self.app.acquire_token_silent(SCOPES, account=account[0], force_refresh=force_refresh)
         else:
             result = None
             
         if not result or "access_token" not in result: # Try interactive if silent acquisition fails
+            result = self._acquire_token_interactive()
+                        
+        if "access_token" not in result:
+            raise Exception("Could not obtain access token. Err: %s" % json.dumps(result, indent=4))
+        
+        self._save_cache()  # Save the new token to cache file
+        return result
+
+    def _acquire_token_interactive(self):
+        """
+        Run the device code flow in one process only: the others wait on the login lock,
+        then pick up the tokens it saved instead of prompting again.
+        """
+        with _file_lock(LOGIN_LOCK_FILE):
+            data = _read_cache_file() # Another process may have logged in while we waited
+            if data:
+                self.cache.deserialize(data)
+                account = self.app.get_accounts()
+                if account:
+                    result = self.app.acquire_token_silent(SCOPES, account=account[0])
+                    if result and "access_token" in result:
+                        return result
+
             logging.error("No valid token found in cache, acquiring new token interactively...")
             flow = self.app.initiate_device_flow(scopes=SCOPES)
             if "user_code" not in flow:
@@ -56,14 +207,12 @@ class AuthManager:
             logging.info("Enter the email address: chinabaseningbo2@outlook.com .")
             logging.info("Enter the received code to authenticate.")
             result = self.app.acquire_token_by_device_flow(flow)
-                        
-        if "access_token" not in result:
-            raise Exception("Could not obtain access token. Err: %s" % json.dumps(result, indent=4))
-        
-        self._save_cache()  # Save the new token to cache file
-        return result['access_token']
+            if "access_token" in result:
+                self._save_cache(immediate=True)  # Never lose a fresh interactive login, and let waiting workers see it
+            return result
 
 if __name__ == "__main__":
-    auth_manager = AuthManager()
+    configure_logging()
+    auth_manager = get_auth_manager()
     token = auth_manager.get_access_token()
     print("Access Token:", token)
\ No newline at end of file
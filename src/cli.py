@@ -0,0 +1,74 @@
+'''
+Command line entry points for maintenance jobs.
+Usage:
+    python -m src.cli delta-sync [--folder FOLDER_ID ...]
+    python -m src.cli backfill --start 2025-01-01 --end 2025-04-01 [--folder FOLDER_ID ...]
+    python -m src.cli requeue-dead [--id ITEM_ID ...]
+    python -m src.cli reconcile-attachments
+'''
+import argparse
+import logging
+from datetime import datetime, timezone
+from src.service import OutlookService, BACKFILL_SLICE_HOURS, BACKFILL_CONCURRENCY
+from src.ingestion_queue import NotificationQueue
+import src.mongo_service as mongodb
+from src.logging_setup import configure_logging
+
+
+def delta_sync(service, args):
+    saved = service.sync_folder_deltas(args.folder)
+    logging.info("Delta sync saved %d document(s).", saved)
+
+
+def backfill(service, args):
+    saved = service.backfill_range(args.start, args.end, args.folder,
+                                   slice_hours=args.slice_hours, concurrency=args.concurrency)
+    logging.info("Backfill saved %d document(s).", saved)
+
+
+def requeue_dead(service, args):
+    requeued = NotificationQueue().requeue_dead(args.id)
+    logging.info("Requeued %d dead-lettered notification(s).", requeued)
+
+
+def reconcile_attachments(service, args):
+    result = mongodb.get_shared_client().reconcile_attachment_refcounts()
+    logging.info("Checked %(checked)d attachment file(s): %(corrected)d refCount(s) corrected, %(deleted)d deleted.", result)
+
+
+def parse_datetime(value):
+    dt = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    return dt if dt.tzinfo else dt.replace(tzinfo=timezone.utc)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m src.cli", description="Outlook service maintenance jobs")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    delta_parser = subparsers.add_parser("delta-sync", help="Fetch messages changed since the last delta sync")
+    delta_parser.add_argument("--folder", action="append", help="Folder ID to sync (repeatable), defaults to all target folders")
+    delta_parser.set_defaults(func=delta_sync)
+
+    backfill_parser = subparsers.add_parser("backfill", help="Fetch and save all emails received in a time range")
+    backfill_parser.add_argument("--start", type=parse_datetime, required=True, help="ISO-8601 start (inclusive, UTC if no offset)")
+    backfill_parser.add_argument("--end", type=parse_datetime, required=True, help="ISO-8601 end (exclusive, UTC if no offset)")
+    backfill_parser.add_argument("--folder", action="append", help="Folder ID to backfill (repeatable), defaults to all target folders")
+    backfill_parser.add_argument("--slice-hours", type=int, default=BACKFILL_SLICE_HOURS, help="Width of one time slice")
+    backfill_parser.add_argument("--concurrency", type=int, default=BACKFILL_CONCURRENCY, help="Slices fetched in parallel")
+    backfill_parser.set_defaults(func=backfill)
+
+    requeue_parser = subparsers.add_parser("requeue-dead", help="Retry dead-lettered notifications with fresh attempts")
+    requeue_parser.add_argument("--id", type=int, action="append", help="Queue item ID to requeue (repeatable), defaults to all")
+    requeue_parser.set_defaults(func=requeue_dead)
+
+    reconcile_parser = subparsers.add_parser("reconcile-attachments",
+                                             help="Recompute GridFS attachment refCounts and delete unreferenced files")
+    reconcile_parser.set_defaults(func=reconcile_attachments)
+
+    args = parser.parse_args(argv)
+    configure_logging()
+    args.func(OutlookService(), args)
+
+
+if __name__ == "__main__":
+    main()
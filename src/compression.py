@@ -0,0 +1,117 @@
+'''
+Optional compression of payloads stored in MongoDB (Bloomberg bodies, GridFS attachments).
+The codec used is recorded next to each payload, so documents written with any setting,
+including uncompressed ones written before it was enabled, stay readable.
+zstd needs the `zstandard` package; without it zlib is used instead.
+'''
+import os
+import zlib
+import logging
+from dotenv import load_dotenv
+
+try:
+    import zstandard
+except ImportError: # Optional dependency
+    zstandard = None
+
+load_dotenv()
+MONGO_COMPRESSION = os.getenv("MONGO_COMPRESSION", "none").lower() # none, zlib or zstd
+MONGO_COMPRESSION_LEVEL = os.getenv("MONGO_COMPRESSION_LEVEL") # Codec default when unset (zlib 6, zstd 3)
+MONGO_COMPRESSION_MIN_BYTES = int(os.getenv("MONGO_COMPRESSION_MIN_BYTES", "1024")) # Smaller payloads are stored raw
+
+# Already compressed formats (xlsx is a zip archive) gain nothing from another pass
+INCOMPRESSIBLE_CONTENT_TYPES = (
+    "image/", "video/", "audio/", "application/zip", "application/x-zip", "application/gzip",
+    "application/x-7z", "application/pdf", "application/vnd.openxmlformats",
+)
+
+
+def _resolve_codec(name):
+    if name in ("", "none", "off", "false"):
+        return None
+    if name == "zstd" and zstandard is None:
+        logging.warning("MONGO_COMPRESSION=zstd but zstandard is not installed, using zlib")
+        return "zlib"
+    if name not in ("zlib", "zstd"):
+        raise ValueError(f"Unsupported MONGO_COMPRESSION: {name}")
+    return name
+
+
+CODEC = _resolve_codec(MONGO_COMPRESSION)
+
+
+def _level(codec):
+    if MONGO_COMPRESSION_LEVEL:
+        return int(MONGO_COMPRESSION_LEVEL)
+    return 3 if codec == "zstd" else 6
+
+
+def choose_codec(size=None, content_type=None):
+    """
+    Codec to store a payload with, None to store it raw.
+    size: payload size in bytes when known (streamed attachments may only have Graph's declared size)
+    """
+    if CODEC is None:
+        return None
+    if size is not None and size < MONGO_COMPRESSION_MIN_BYTES:
+        return None
+    if content_type and content_type.lower().startswith(INCOMPRESSIBLE_CONTENT_TYPES):
+        return None
+    return CODEC
+
+
+def compressor(codec):
+    """Streaming compressor with compress(chunk) / flush()."""
+    if codec == "zstd":
+        return zstandard.ZstdCompressor(level=_level(codec)).compressobj()
+    if codec == "zlib":
+        return zlib.compressobj(_level(codec))
+    raise ValueError(f"Unsupported codec: {codec}")
+
+
+def decompressor(codec):
+    """Streaming decompressor with decompress(chunk)."""
+    if codec == "zstd":
+        if zstandard is None:
+            raise RuntimeError("zstandard is required to read zstd-compressed data")
+        return zstandard.ZstdDecompressor().decompressobj()
+    if codec == "zlib":
+        return zlib.decompressobj()
+    raise ValueError(f"Unsupported codec: {codec}")
+
+
+def compress(data, content_type=None):
+    """
+    Compress bytes if enabled and worthwhile.
+    return: (codec or None, payload); payload is `data` itself when stored raw
+    """
+    codec = choose_codec(len(data), content_type)
+    if codec is None:
+        return None, data
+    c = compressor(codec)
+    payload = c.compress(data) + c.flush()
+    if len(payload) >= len(data):
+        return None, data
+    return codec, payload
+
+
+def decompress(codec, payload):
+    if not codec:
+        return payload
+    return decompressor(codec).decompress(payload)
+
+
+def iter_decompress(codec, chunks):
+    """Decompress an iterable of chunks (e.g. a GridFS file) as it is read."""
+    if not codec:
+        yield from chunks
+        return
+    d = decompressor(codec)
+    for chunk in chunks:
+        data = d.decompress(chunk)
+        if data:
+            yield data
+    if hasattr(d, "flush"):
+        tail = d.flush()
+        if tail:
+            yield tail
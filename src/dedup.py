@@ -0,0 +1,77 @@
+'''
+Seen-message dedup layer in front of the Graph fetch.
+Graph sends several notifications per message (created, category/read-flag updates, moves);
+ids already ingested are answered from an in-process TTL/LRU cache, or from one
+batched existence lookup against Mongo, so they are never fetched again.
+'''
+import os
+import time
+import threading
+from collections import OrderedDict
+from dotenv import load_dotenv
+
+load_dotenv()
+SEEN_CACHE_SIZE = int(os.getenv("SEEN_CACHE_SIZE", "50000")) # Max message ids kept in memory
+SEEN_CACHE_TTL = int(os.getenv("SEEN_CACHE_TTL", "86400")) # Seconds an id stays cached
+
+
+class SeenMessageCache:
+    def __init__(self, max_size=SEEN_CACHE_SIZE, ttl_seconds=SEEN_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict() # message id -> expires_at, oldest first
+        self._lock = threading.Lock()
+        self.cache_hits = 0
+        self.store_hits = 0
+        self.misses = 0
+
+    def _contains(self, message_id, now):
+        expires_at = self._entries.get(message_id)
+        if expires_at is None:
+            return False
+        if expires_at < now:
+            del self._entries[message_id]
+            return False
+        self._entries.move_to_end(message_id)
+        return True
+
+    def add_many(self, message_ids):
+        """Mark message ids as ingested."""
+        now = time.time()
+        with self._lock:
+            for message_id in message_ids:
+                self._entries[message_id] = now + self.ttl_seconds
+                self._entries.move_to_end(message_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def filter_unseen(self, message_ids, lookup=None):
+        """
+        Return the ids that have not been ingested yet.
+        message_ids: list of message ids
+        lookup: optional callable(list of ids) -> set of ids already stored, called once for cache misses
+        """
+        now = time.time()
+        with self._lock:
+            candidates = [m for m in message_ids if not self._contains(m, now)]
+            self.cache_hits += len(message_ids) - len(candidates)
+
+        stored = set(lookup(candidates)) if (lookup and candidates) else set()
+        if stored:
+            self.add_many(stored)
+        unseen = [m for m in candidates if m not in stored]
+        with self._lock:
+            self.store_hits += len(candidates) - len(unseen)
+            self.misses += len(unseen)
+        return unseen
+
+    def stats(self):
+        with self._lock:
+            total = self.cache_hits + self.store_hits + self.misses
+            return {
+                "size": len(self._entries),
+                "cache_hits": self.cache_hits,
+                "store_hits": self.store_hits,
+                "misses": self.misses,
+                "hit_rate": round((self.cache_hits + self.store_hits) / total, 4) if total else 0.0,
+            }
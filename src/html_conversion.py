@@ -0,0 +1,132 @@
+'''
+HTML to Markdown conversion stage for Bloomberg bodies.
+Large bodies are converted on a process pool so the CPU-bound html2text work runs
+outside the GIL; small ones are converted inline. Results are cached by content hash,
+so resent or updated emails with an identical body are not converted twice.
+'''
+import os
+import time
+import atexit
+import hashlib
+import threading
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+import html2text
+from dotenv import load_dotenv
+
+load_dotenv()
+HTML_CONVERT_WORKERS = int(os.getenv("HTML_CONVERT_WORKERS", "2")) # Process pool size, 0 converts everything inline
+HTML_CONVERT_INLINE_MAX_BYTES = int(os.getenv("HTML_CONVERT_INLINE_MAX_BYTES", "65536")) # Smaller bodies skip the pool
+HTML_CONVERT_CACHE_SIZE = int(os.getenv("HTML_CONVERT_CACHE_SIZE", "512")) # Converted bodies kept by hash
+
+
+def html_to_markdown(html):
+    h = html2text.HTML2Text()
+    h.ignore_images = True
+    h.ignore_emphasis = False
+    h.body_width = 0
+    return h.handle(html)
+
+
+def _timed_html_to_markdown(html):
+    started = time.perf_counter()
+    markdown = html_to_markdown(html)
+    return markdown, time.perf_counter() - started
+
+
+class MarkdownConverter:
+    def __init__(self, workers=HTML_CONVERT_WORKERS, inline_max_bytes=HTML_CONVERT_INLINE_MAX_BYTES,
+                 cache_size=HTML_CONVERT_CACHE_SIZE):
+        self.workers = workers
+        self.inline_max_bytes = inline_max_bytes
+        self.cache_size = cache_size
+        self._cache = OrderedDict() # sha256 -> markdown
+        self._lock = threading.Lock()
+        self._executor = None
+        self.converted = 0
+        self.pooled = 0
+        self.cache_hits = 0
+        self.total_seconds = 0.0
+
+    def _get_executor(self):
+        """Create the process pool on first use (after any fork by the web server)."""
+        with self._lock:
+            if self._executor is None:
+                # spawn: forking a process that runs worker threads is unsafe
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                )
+                atexit.register(self.close)
+            return self._executor
+
+    def _cache_get(self, key):
+        with self._lock:
+            markdown = self._cache.get(key)
+            if markdown is not None:
+                self._cache.move_to_end(key)
+                self.cache_hits += 1
+            return markdown
+
+    def _cache_put(self, key, markdown, seconds, pooled):
+        with self._lock:
+            self._cache[key] = markdown
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+            self.converted += 1
+            self.pooled += int(pooled)
+            self.total_seconds += seconds
+
+    def convert_many(self, htmls):
+        """
+        Convert a batch of HTML bodies.
+        htmls: list of HTML strings (None is treated as empty)
+
+        return: list of (markdown, seconds) in input order; seconds is 0.0 for cache hits
+        """
+        results = [None] * len(htmls)
+        resolved = {} # content hash -> (markdown, seconds), converts each distinct body once
+        futures = {}
+        waiting = []
+        for i, html in enumerate(htmls):
+            html = html or ""
+            key = hashlib.sha256(html.encode("utf-8")).hexdigest()
+            if key in resolved or key in futures:
+                waiting.append((i, key))
+                continue
+            markdown = self._cache_get(key)
+            if markdown is not None:
+                results[i] = (markdown, 0.0)
+            elif self.workers > 0 and len(html) > self.inline_max_bytes:
+                futures[key] = self._get_executor().submit(_timed_html_to_markdown, html)
+                waiting.append((i, key))
+            else:
+                resolved[key] = _timed_html_to_markdown(html)
+                self._cache_put(key, *resolved[key], pooled=False)
+                results[i] = resolved[key]
+
+        for key, future in futures.items():
+            resolved[key] = future.result()
+            self._cache_put(key, *resolved[key], pooled=True)
+        for i, key in waiting:
+            results[i] = resolved.get(key) or (self._cache_get(key), 0.0)
+        return results
+
+    def convert(self, html):
+        return self.convert_many([html])[0][0]
+
+    def stats(self):
+        with self._lock:
+            return {
+                "converted": self.converted,
+                "pooled": self.pooled,
+                "cache_hits": self.cache_hits,
+                "avg_ms": round(1000 * self.total_seconds / self.converted, 2) if self.converted else 0.0,
+            }
+
+    def close(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)
@@ -0,0 +1,282 @@
+'''
+Durable ingestion queue for webhook notifications.
+The /notifications endpoint only validates and enqueues; a bounded pool of
+worker threads drains the queue and runs the (slow) Graph + Mongo pipeline.
+Notifications are persisted in SQLite so a crash does not lose them.
+'''
+import os
+import json
+import time
+import sqlite3
+import threading
+import logging
+from dotenv import load_dotenv
+
+load_dotenv()
+INGEST_QUEUE_PATH = os.getenv("INGEST_QUEUE_PATH", "ingest_queue.db")
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", "4"))
+INGEST_BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", "20")) # Notifications handed to one worker at a time
+INGEST_MAX_DEPTH = int(os.getenv("INGEST_MAX_DEPTH", "10000")) # Reject (503) above this depth
+INGEST_VISIBILITY_TIMEOUT = int(os.getenv("INGEST_VISIBILITY_TIMEOUT", "300")) # Seconds before a claimed item is retried
+INGEST_MAX_ATTEMPTS = int(os.getenv("INGEST_MAX_ATTEMPTS", "10")) # Attempts before an item is dead-lettered
+INGEST_RETRY_BASE_SECONDS = float(os.getenv("INGEST_RETRY_BASE_SECONDS", "5")) # Delay after the first failure, doubled per attempt
+INGEST_RETRY_MAX_SECONDS = float(os.getenv("INGEST_RETRY_MAX_SECONDS", "900"))
+
+
+class QueueFullError(Exception):
+    """Raised when the queue is at max depth and cannot accept more work."""
+
+
+class NotificationQueue:
+    def __init__(self, path=INGEST_QUEUE_PATH, max_depth=INGEST_MAX_DEPTH,
+                 visibility_timeout=INGEST_VISIBILITY_TIMEOUT, max_attempts=INGEST_MAX_ATTEMPTS,
+                 retry_base=INGEST_RETRY_BASE_SECONDS, retry_max=INGEST_RETRY_MAX_SECONDS):
+        self.path = path
+        self.max_depth = max_depth
+        self.visibility_timeout = visibility_timeout
+        self.max_attempts = max_attempts
+        self.retry_base = retry_base
+        self.retry_max = retry_max
+        self._local = threading.local()
+        self._not_empty = threading.Condition()
+
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        conn = self._connect()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS notifications ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " payload TEXT NOT NULL,"
+            " enqueued_at REAL NOT NULL,"
+            " claimed_at REAL,"
+            " attempts INTEGER NOT NULL DEFAULT 0,"
+            " dead INTEGER NOT NULL DEFAULT 0,"
+            " available_at REAL NOT NULL DEFAULT 0)"
+        )
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(notifications)")}
+        if "available_at" not in columns: # Queue file created before retry backoff
+            try:
+                conn.execute("ALTER TABLE notifications ADD COLUMN available_at REAL NOT NULL DEFAULT 0")
+            except sqlite3.OperationalError:
+                pass # Added by another worker process in the meantime
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_notifications_ready "
+            "ON notifications (dead, claimed_at, id)"
+        )
+
+    def _connect(self):
+        """One SQLite connection per thread (sqlite3 connections are not thread-safe)."""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL") # WAL + NORMAL survives process crashes
+            self._local.conn = conn
+        return conn
+
+    def depth(self):
+        row = self._connect().execute(
+            "SELECT COUNT(*) FROM notifications WHERE dead = 0"
+        ).fetchone()
+        return row[0]
+
+    def put(self, notifications):
+        """
+        Persist a list of notifications.
+        notifications: list of notification JSON objects
+
+        return: number of notifications enqueued
+        """
+        if not notifications:
+            return 0
+        now = time.time()
+        rows = [(json.dumps(n), now) for n in notifications]
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE") # Depth check and insert under one write lock, across processes
+        try:
+            depth = conn.execute("SELECT COUNT(*) FROM notifications WHERE dead = 0").fetchone()[0]
+            if depth + len(rows) > self.max_depth:
+                raise QueueFullError(f"ingestion queue is full ({self.max_depth} items)")
+            conn.executemany(
+                "INSERT INTO notifications (payload, enqueued_at) VALUES (?, ?)", rows
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+        with self._not_empty:
+            self._not_empty.notify_all()
+        return len(rows)
+
+    def claim(self, limit):
+        """
+        Atomically claim up to `limit` ready notifications.
+        Items claimed longer than the visibility timeout ago are reclaimed,
+        so work held by a crashed worker is eventually retried; those already
+        out of attempts (e.g. one that keeps killing the worker) are dead-lettered.
+        Items backing off after a failure are skipped until they are due.
+
+        return: list of (item_id, notification) tuples
+        """
+        now = time.time()
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            expired = conn.execute(
+                "UPDATE notifications SET dead = 1 "
+                "WHERE dead = 0 AND claimed_at < ? AND attempts >= ?",
+                (now - self.visibility_timeout, self.max_attempts),
+            ).rowcount
+            rows = conn.execute(
+                "SELECT id, payload FROM notifications "
+                "WHERE dead = 0 AND available_at <= ? AND (claimed_at IS NULL OR claimed_at < ?) "
+                "ORDER BY id LIMIT ?",
+                (now, now - self.visibility_timeout, limit),
+            ).fetchall()
+            if rows:
+                conn.executemany(
+                    "UPDATE notifications SET claimed_at = ?, attempts = attempts + 1 WHERE id = ?",
+                    [(now, row[0]) for row in rows],
+                )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        if expired:
+            logging.warning("[Ingest] Dead-lettered %d notification(s) that timed out on every attempt", expired)
+        return [(row[0], json.loads(row[1])) for row in rows]
+
+    def ack(self, item_ids):
+        """Remove successfully processed items."""
+        if not item_ids:
+            return
+        self._connect().executemany(
+            "DELETE FROM notifications WHERE id = ?", [(i,) for i in item_ids]
+        )
+
+    def nack(self, item_ids):
+        """
+        Release failed items for retry after an exponential backoff
+        (retry_base * 2^(attempts-1), capped at retry_max), dead-lettering those out of attempts.
+        """
+        if not item_ids:
+            return
+        now = time.time()
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.executemany(
+                "UPDATE notifications SET claimed_at = NULL, dead = (attempts >= ?),"
+                " available_at = ? + MIN(?, ? * (1 << MIN(MAX(attempts - 1, 0), 30))) WHERE id = ?",
+                [(self.max_attempts, now, self.retry_max, self.retry_base, i) for i in item_ids],
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def requeue_dead(self, item_ids=None):
+        """
+        Give dead-lettered items (all of them, or `item_ids`) a fresh set of attempts.
+        return: number of items requeued
+        """
+        sql = "UPDATE notifications SET dead = 0, attempts = 0, claimed_at = NULL, available_at = 0 WHERE dead = 1"
+        conn = self._connect()
+        if item_ids is None:
+            count = conn.execute(sql).rowcount
+        else:
+            count = sum(conn.execute(sql + " AND id = ?", (i,)).rowcount for i in item_ids)
+        if count:
+            with self._not_empty:
+                self._not_empty.notify_all()
+        return count
+
+    def wait(self, timeout):
+        """Block until new work is enqueued in this process or `timeout` elapses."""
+        with self._not_empty:
+            self._not_empty.wait(timeout)
+
+    def wake_all(self):
+        with self._not_empty:
+            self._not_empty.notify_all()
+
+    def stats(self):
+        """Return queue depth, in-flight, backing-off and dead-letter counts and the age of the oldest item."""
+        now = time.time()
+        row = self._connect().execute(
+            "SELECT "
+            " COALESCE(SUM(dead = 0), 0),"
+            " COALESCE(SUM(dead = 0 AND claimed_at IS NOT NULL), 0),"
+            " COALESCE(SUM(dead = 0 AND claimed_at IS NULL AND available_at > ?), 0),"
+            " COALESCE(SUM(dead = 1), 0),"
+            " MIN(CASE WHEN dead = 0 THEN enqueued_at END) "
+            "FROM notifications",
+            (now,),
+        ).fetchone()
+        depth, in_flight, backing_off, dead, oldest = row
+        return {
+            "depth": depth,
+            "in_flight": in_flight,
+            "backing_off": backing_off,
+            "dead": dead,
+            "oldest_age_seconds": round(now - oldest, 3) if oldest else 0.0,
+            "max_depth": self.max_depth,
+        }
+
+
+class IngestionWorkerPool:
+    def __init__(self, queue, handler, workers=INGEST_WORKERS, batch_size=INGEST_BATCH_SIZE):
+        """
+        queue: NotificationQueue to drain
+        handler: callable receiving a list of notifications (e.g. OutlookService.handle_notification_batch)
+        workers: number of worker threads
+        batch_size: max notifications per handler call
+        """
+        self.queue = queue
+        self.handler = handler
+        self.workers = workers
+        self.batch_size = batch_size
+        self._stop = threading.Event()
+        self._threads = []
+
+    def start(self):
+        if self._threads:
+            return
+        self._stop.clear()
+        for i in range(self.workers):
+            t = threading.Thread(target=self._run, name=f"ingest-worker-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+        logging.info("[Ingest] Started %d worker(s) on %s", self.workers, self.queue.path)
+
+    def stop(self, timeout=30):
+        """Stop workers after their current batch. Unfinished items stay in the queue."""
+        self._stop.set()
+        self.queue.wake_all()
+        for t in self._threads:
+            t.join(timeout)
+        self._threads = []
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                items = self.queue.claim(self.batch_size)
+            except Exception:
+                logging.exception("[Ingest] Failed to claim from queue")
+                self._stop.wait(1.0)
+                continue
+
+            if not items:
+                self.queue.wait(1.0) # Poll too, items may be enqueued by another process
+                continue
+
+            item_ids = [item_id for item_id, _ in items]
+            notifications = [notification for _, notification in items]
+            try:
+                self.handler(notifications)
+            except Exception:
+                logging.exception("[Ingest] Failed to process %d notification(s), will retry", len(items))
+                self.queue.nack(item_ids)
+            else:
+                self.queue.ack(item_ids)
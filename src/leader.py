@@ -0,0 +1,132 @@
+'''
+Leader election for work that must run in exactly one serving process
+(the subscription lifecycle and the periodic delta sync).
+Every worker runs a LeaderElector; the one holding the lock runs the duties.
+The file lock is released by the OS when its holder dies, the Mongo lock is a
+lease that expires, so another worker takes over on its next attempt.
+'''
+import os
+import uuid
+import socket
+import logging
+import threading
+from dotenv import load_dotenv
+
+load_dotenv()
+LEADER_LOCK_BACKEND = os.getenv("LEADER_LOCK_BACKEND", "file") # "file" (single host) or "mongo" (multi host)
+LEADER_LOCK_FILE = os.getenv("LEADER_LOCK_FILE", "subscription_leader.lock")
+LEADER_LEASE_SECONDS = int(os.getenv("LEADER_LEASE_SECONDS", "30")) # Mongo lease, renewed every third of it
+
+
+class FileLeaderLock:
+    def __init__(self, path=LEADER_LOCK_FILE):
+        self.path = path
+        self._fd = None
+
+    def try_acquire(self):
+        """Take (or keep) an exclusive flock on the lock file without blocking."""
+        import fcntl
+        if self._fd is not None:
+            return True
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return False
+        os.ftruncate(fd, 0)
+        os.write(fd, str(os.getpid()).encode())
+        self._fd = fd
+        return True
+
+    def release(self):
+        import fcntl
+        if self._fd is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            os.close(self._fd)
+            self._fd = None
+
+
+class MongoLeaderLock:
+    def __init__(self, name="subscription-lifecycle", lease_seconds=LEADER_LEASE_SECONDS):
+        self.name = name
+        self.lease_seconds = lease_seconds
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+    def try_acquire(self):
+        """Take the lease if it is free or expired, or extend it if we already hold it."""
+        import src.mongo_service as mongodb
+        return mongodb.get_shared_client().try_acquire_lock(self.name, self.owner, self.lease_seconds)
+
+    def release(self):
+        import src.mongo_service as mongodb
+        mongodb.get_shared_client().release_lock(self.name, self.owner)
+
+
+def make_leader_lock(backend=LEADER_LOCK_BACKEND):
+    if backend == "mongo":
+        return MongoLeaderLock()
+    if backend == "file":
+        return FileLeaderLock()
+    raise ValueError(f"Unknown LEADER_LOCK_BACKEND: {backend}")
+
+
+class LeaderElector:
+    def __init__(self, lock, duties, interval=None):
+        """
+        lock: FileLeaderLock or MongoLeaderLock
+        duties: callables receiving a stop event, each run in its own thread while leader
+        interval: seconds between acquire / renew attempts
+        """
+        self.lock = lock
+        self.duties = duties
+        self.interval = interval or max(1, LEADER_LEASE_SECONDS // 3)
+        self.is_leader = False
+        self._stop = threading.Event()
+        self._duty_stop = None
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="leader-elector", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=10):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                held = self.lock.try_acquire()
+            except Exception:
+                logging.exception("[Leader] Lock attempt failed")
+                held = False
+            if held and not self.is_leader:
+                self._promote()
+            elif not held and self.is_leader:
+                logging.warning("[Leader] Lost leadership in pid %d", os.getpid())
+                self._demote()
+            self._stop.wait(self.interval)
+
+        if self.is_leader:
+            self._demote()
+            try:
+                self.lock.release()
+            except Exception:
+                logging.exception("[Leader] Failed to release lock")
+
+    def _promote(self):
+        logging.info("[Leader] pid %d elected leader", os.getpid())
+        self.is_leader = True
+        self._duty_stop = threading.Event()
+        for duty in self.duties:
+            threading.Thread(target=duty, args=(self._duty_stop,), daemon=True).start()
+
+    def _demote(self):
+        self.is_leader = False
+        if self._duty_stop is not None:
+            self._duty_stop.set()
+            self._duty_stop = None
@@ -0,0 +1,151 @@
+'''
+Central logging configuration, called once by each entry point (app, cli, auth).
+Records are put on an in-memory queue by the calling thread and written to stdout
+by a background listener, so request threads never block on stdout. The listener
+redacts secrets (bearer tokens, JWTs, clientState, validation tokens) and writes
+compact JSON lines; long messages are truncated and hot-path loggers can be sampled.
+'''
+import os
+import re
+import sys
+import json
+import queue
+import atexit
+import random
+import logging
+import logging.handlers
+import threading
+from datetime import datetime, timezone
+from dotenv import load_dotenv
+
+load_dotenv()
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json").lower() # json or text
+LOG_MAX_MESSAGE_CHARS = int(os.getenv("LOG_MAX_MESSAGE_CHARS", "2000")) # Longer messages are truncated
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000")) # Records beyond this are dropped, not waited for
+WEBHOOK_LOG_SAMPLE_RATE = float(os.getenv("WEBHOOK_LOG_SAMPLE_RATE", "0.1")) # Share of per-request INFO logs kept
+
+TEXT_FORMAT = "%(asctime)s [%(levelname)s] %(name)s: %(message)s"
+REDACTED = "[REDACTED]"
+_SECRET_KEYS = ("access_token", "refresh_token", "id_token", "client_secret", "password",
+                "clientState", "validationToken", "validationTokens", "dataKey", "Authorization")
+_SECRET_PATTERNS = [
+    re.compile(r"(?i)(bearer\s+)[\w.~+/=-]+"),
+    re.compile(r"eyJ[\w-]{8,}\.[\w-]{8,}\.[\w-]*"), # JWT
+    re.compile(r"(?i)([\"']?(?:" + "|".join(_SECRET_KEYS) + r")[\"']?\s*[:=]\s*[\[\"']*)[^\"'\s,&}\]]+"),
+]
+# Standard LogRecord attributes; anything else on a record came from `extra=`
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+
+def redact(text):
+    for pattern in _SECRET_PATTERNS:
+        text = pattern.sub(lambda m: (m.group(1) if m.groups() else "") + REDACTED, text)
+    client_state = os.getenv("OUTLOOK_CLIENT_STATE")
+    if client_state:
+        text = text.replace(client_state, REDACTED)
+    return text
+
+
+def _truncate(text, limit=LOG_MAX_MESSAGE_CHARS):
+    if limit and len(text) > limit:
+        return f"{text[:limit]}... [{len(text) - limit} chars truncated]"
+    return text
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds").replace("+00:00", "Z"),
+            "level": record.levelname,
+            "logger": record.name,
+            "pid": record.process,
+            "msg": redact(record.getMessage()),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES and not key.startswith("_"):
+                entry[key] = value
+        if record.exc_text:
+            entry["exc"] = redact(record.exc_text)
+        return json.dumps(entry, default=str, separators=(",", ":"))
+
+
+class RedactingFormatter(logging.Formatter):
+    def format(self, record):
+        return redact(super().format(record))
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that renders cheaply on the calling thread and drops records when the queue is full."""
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Merge args now (they may be mutated later) but leave redaction and JSON to the listener
+        record = logging.makeLogRecord(record.__dict__)
+        record.msg = _truncate(record.getMessage())
+        record.args = None
+        if record.exc_info:
+            record.exc_text = _truncate(logging.Formatter().formatException(record.exc_info), 4 * LOG_MAX_MESSAGE_CHARS)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class SamplingFilter(logging.Filter):
+    """Keep only a share of records below WARNING; warnings and errors always pass."""
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        return record.levelno >= logging.WARNING or random.random() < self.rate
+
+
+_listener = None
+_configured_pid = None
+_lock = threading.Lock()
+
+def configure_logging(level=LOG_LEVEL, fmt=LOG_FORMAT):
+    """
+    Route the root logger through a background queue listener (idempotent per process,
+    re-run after a fork since the listener thread does not survive it).
+    """
+    global _listener, _configured_pid
+    with _lock:
+        if _configured_pid == os.getpid():
+            return
+        stream_handler = logging.StreamHandler(sys.stdout)
+        stream_handler.setFormatter(JsonFormatter() if fmt == "json" else RedactingFormatter(TEXT_FORMAT))
+        log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+        _listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+        _listener.start()
+
+        root = logging.getLogger()
+        for handler in list(root.handlers):
+            if isinstance(handler, DroppingQueueHandler):
+                root.removeHandler(handler)
+        root.addHandler(DroppingQueueHandler(log_queue))
+        root.setLevel(level)
+
+        webhook_logger = logging.getLogger("src.webhook")
+        webhook_logger.filters = [f for f in webhook_logger.filters if not isinstance(f, SamplingFilter)]
+        if WEBHOOK_LOG_SAMPLE_RATE < 1:
+            webhook_logger.addFilter(SamplingFilter(WEBHOOK_LOG_SAMPLE_RATE))
+        _configured_pid = os.getpid()
+
+def stop_logging():
+    """Flush queued records (called at exit)."""
+    global _listener
+    with _lock:
+        if _listener is not None and _configured_pid == os.getpid():
+            _listener.stop()
+        _listener = None
+
+atexit.register(stop_logging)
@@ -0,0 +1,315 @@
+'''
+Minimal Prometheus-style metrics for the ingestion path.
+Counters, gauges and histograms are plain in-process objects guarded by a lock,
+so recording a sample is a dict update; /metrics renders the text exposition format.
+Every series carries a `pid` label, one per gunicorn worker. Each worker also writes a
+snapshot of its values to METRICS_DIR every METRICS_SNAPSHOT_SECONDS, and a scrape
+(which nginx routes to any one worker) renders its own live values plus every other live
+worker's latest snapshot, so each pid's series is complete on every scrape.
+Sum by job (or use rate()) across pids in Prometheus.
+'''
+import os
+import json
+import time
+import bisect
+import atexit
+import logging
+import tempfile
+import threading
+from contextlib import contextmanager
+from dotenv import load_dotenv
+
+load_dotenv()
+METRICS_DIR = os.getenv("METRICS_DIR", os.path.join(tempfile.gettempdir(), "outlook-service-metrics")) # Shared by the workers of one host
+METRICS_SNAPSHOT_SECONDS = float(os.getenv("METRICS_SNAPSHOT_SECONDS", "5"))
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+LAG_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0, 1800.0)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in labels) + "}"
+
+
+class _Metric:
+    type = ""
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def samples(self):
+        """Yield (suffix, labels, value) for rendering."""
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+        for key, value in values.items():
+            yield "_total", list(zip(self.labelnames, key)), value
+
+
+class Gauge(_Metric):
+    type = "gauge"
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+        for key, value in values.items():
+            yield "", list(zip(self.labelnames, key)), value
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def samples(self):
+        with self._lock:
+            values = {key: ([*entry[0]], entry[1], entry[2]) for key, entry in self._values.items()}
+        for key, (counts, total, count) in values.items():
+            labels = list(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                yield "_bucket", labels + [("le", repr(float(bound)))], cumulative
+            yield "_bucket", labels + [("le", "+Inf")], count
+            yield "_sum", labels, total
+            yield "_count", labels, count
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+        self._lock = threading.Lock()
+        self._snapshot_dir = None
+        self._snapshot_stop = None
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def register_collector(self, collector):
+        """
+        collector: callable returning a list of (name, documentation, labels dict, value) gauges,
+        evaluated at scrape time (e.g. queue depth)
+        """
+        with self._lock:
+            self._collectors.append(collector)
+
+    def collect(self):
+        """
+        This process's metric families.
+        return: list of [name, type, documentation, [[name suffix, label pairs, value], ...]]
+        """
+        with self._lock:
+            metrics = list(self._metrics)
+            collectors = list(self._collectors)
+        families = [
+            [metric.name, metric.type, metric.documentation,
+             [[suffix, labels, value] for suffix, labels, value in metric.samples()]]
+            for metric in metrics
+        ]
+        gauges = {}
+        for collector in collectors:
+            try:
+                collected = collector()
+            except Exception:
+                continue
+            for name, documentation, labels, value in collected:
+                if name not in gauges:
+                    gauges[name] = [name, "gauge", documentation, []]
+                    families.append(gauges[name])
+                gauges[name][3].append(["", sorted(labels.items()), value])
+        return families
+
+    def render(self):
+        """Exposition text for this process (live) and the other workers (latest snapshots)."""
+        per_pid = [(os.getpid(), self.collect())] + self._read_snapshots()
+        merged = {} # name -> (type, documentation, sample lines), in first-seen order
+        for pid, families in per_pid:
+            pid_label = [("pid", str(pid))]
+            for name, metric_type, documentation, samples in families:
+                family = merged.setdefault(name, (metric_type, documentation, []))
+                for suffix, labels, value in samples:
+                    family[2].append(f"{name}{suffix}{_format_labels(pid_label + [tuple(l) for l in labels])} {value}")
+        lines = []
+        for name, (metric_type, documentation, samples) in merged.items():
+            lines.append(f"# HELP {name} {documentation}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            lines.extend(samples)
+        return "\n".join(lines) + "\n"
+
+    def start_snapshots(self, directory=METRICS_DIR, interval=METRICS_SNAPSHOT_SECONDS):
+        """Periodically write this process's values to `directory` for the other workers' scrapes."""
+        if self._snapshot_stop is not None:
+            return
+        os.makedirs(directory, exist_ok=True)
+        self._snapshot_dir = directory
+        self._snapshot_stop = threading.Event()
+
+        def run(stop):
+            while True:
+                self._write_snapshot()
+                if stop.wait(interval):
+                    return
+        threading.Thread(target=run, args=(self._snapshot_stop,), name="metrics-snapshot", daemon=True).start()
+
+    def stop_snapshots(self):
+        """Stop snapshotting and remove this process's snapshot (worker exit)."""
+        if self._snapshot_stop is None:
+            return
+        self._snapshot_stop.set()
+        self._snapshot_stop = None
+        try:
+            os.remove(os.path.join(self._snapshot_dir, f"{os.getpid()}.json"))
+        except OSError:
+            pass
+
+    def _write_snapshot(self):
+        path = os.path.join(self._snapshot_dir, f"{os.getpid()}.json")
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=self._snapshot_dir, prefix=".", suffix=".tmp")
+            with os.fdopen(fd, "w") as f:
+                json.dump(self.collect(), f, default=str)
+            os.replace(tmp_path, path)
+        except Exception:
+            logging.exception("Could not write the metrics snapshot")
+
+    def _read_snapshots(self):
+        """Latest snapshots of the other live workers; those of exited workers are removed."""
+        if self._snapshot_dir is None:
+            return []
+        snapshots = []
+        own = os.getpid()
+        for filename in os.listdir(self._snapshot_dir):
+            stem, ext = os.path.splitext(filename)
+            if ext != ".json" or not stem.isdigit() or int(stem) == own:
+                continue
+            path = os.path.join(self._snapshot_dir, filename)
+            if not _pid_alive(int(stem)):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                continue
+            try:
+                with open(path) as f:
+                    snapshots.append((int(stem), json.load(f)))
+            except (OSError, ValueError):
+                continue # Removed or replaced meanwhile
+        return snapshots
+
+
+REGISTRY = Registry()
+atexit.register(REGISTRY.stop_snapshots)
+
+NOTIFICATIONS_RECEIVED = REGISTRY.register(Counter(
+    "outlook_notifications_received", "Webhook notifications received, by outcome", ["result"]))
+NOTIFICATIONS_PROCESSED = REGISTRY.register(Counter(
+    "outlook_notifications_processed", "Notifications handled by ingestion workers"))
+NOTIFICATION_LAG = REGISTRY.register(Histogram(
+    "outlook_notification_lag_seconds", "Time from webhook receipt to the notification being stored",
+    buckets=LAG_BUCKETS))
+GRAPH_REQUESTS = REGISTRY.register(Counter(
+    "outlook_graph_requests", "Graph HTTP requests, by endpoint and status", ["method", "endpoint", "status"]))
+GRAPH_REQUEST_SECONDS = REGISTRY.register(Histogram(
+    "outlook_graph_request_seconds", "Graph HTTP request latency", ["method", "endpoint"]))
+TOKEN_REFRESHES = REGISTRY.register(Counter(
+    "outlook_token_refreshes", "Access token refreshes"))
+TOKEN_REFRESH_SECONDS = REGISTRY.register(Histogram(
+    "outlook_token_refresh_seconds", "Access token refresh latency"))
+HTML_CONVERSION_SECONDS = REGISTRY.register(Histogram(
+    "outlook_html_conversion_seconds", "HTML to Markdown conversion time per message (cache misses)"))
+MONGO_WRITE_SECONDS = REGISTRY.register(Histogram(
+    "outlook_mongo_write_seconds", "MongoDB / GridFS write latency", ["operation"]))
+MONGO_WRITE_BYTES = REGISTRY.register(Counter(
+    "outlook_mongo_write_bytes", "Payload bytes written to MongoDB / GridFS", ["operation"]))
+DUPLICATES_SKIPPED = REGISTRY.register(Counter(
+    "outlook_duplicates_skipped", "Messages or attachments skipped as already stored", ["stage"]))
+RICH_NOTIFICATIONS = REGISTRY.register(Counter(
+    "outlook_rich_notifications", "Notifications with resource data: used, partial (fetched) or invalid", ["result"]))
+WRITE_BEHIND_FLUSH_DOCUMENTS = REGISTRY.register(Histogram(
+    "outlook_write_behind_flush_documents", "Documents written per write-behind flush",
+    buckets=(1, 2, 5, 10, 25, 50, 100, 250, 500, 1000)))
+
+
+_ID_SEGMENT_MAX_LENGTH = 20
+
+
+def graph_endpoint_label(url):
+    """
+    Collapse a Graph URL into a low-cardinality endpoint label,
+    e.g. /users/{id}/messages/{id}/attachments
+    """
+    path = url.split("?", 1)[0]
+    if "/v1.0/" in path:
+        path = path.split("/v1.0/", 1)[1]
+    segments = []
+    for segment in path.strip("/").split("/"):
+        if not segment:
+            continue
+        word = segment.lstrip("$")
+        if word.isalpha() and len(segment) <= _ID_SEGMENT_MAX_LENGTH:
+            segments.append(segment.lower())
+        else:
+            segments.append("{id}")
+    return "/" + "/".join(segments)
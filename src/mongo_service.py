@@ -1,9 +1,18 @@
 import os
 from dotenv import load_dotenv
-from pymongo import MongoClient
-from pymongo.errors import BulkWriteError
+from pymongo import ASCENDING, DESCENDING, TEXT, MongoClient, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
 import logging
 import gridfs
+import gridfs.errors
+import time
+import atexit
+import hashlib
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from src import metrics, compression
 
 load_dotenv()
 MONGO_URI = os.getenv("MONGO_URI")
@@ -11,10 +20,59 @@ MONGO_DB_NAME = os.getenv("MONGO_DB_NAME")
 BLOOMBERG_COLLECTION_NAME = os.getenv("MONGO_COLLECTION_BLOOMBERG") # Collection for Bloomberg
 SHUCHUANG_COLLECTION_NAME = os.getenv("MONGO_COLLECTION_SHUCHUANG") # Collection for Shuchuang
 SHUCHUANG_FS_COLLECTION_NAME = os.getenv("MONGO_COLLECTION_SHUCHUANG_FS") # GridFS collection for Shuchuang attachments
+SYNC_STATE_COLLECTION_NAME = os.getenv("MONGO_COLLECTION_SYNC_STATE", "sync_state") # Delta links and sync checkpoints
+LOCKS_COLLECTION_NAME = os.getenv("MONGO_COLLECTION_LOCKS", "locks") # Leader election leases
+SUBSCRIPTIONS_COLLECTION_NAME = os.getenv("MONGO_COLLECTION_SUBSCRIPTIONS", "subscriptions") # Graph subscription registry
+MONGO_MAX_POOL_SIZE = int(os.getenv("MONGO_MAX_POOL_SIZE", "50"))
+MONGO_WRITE_CONCERN = os.getenv("MONGO_WRITE_CONCERN") # e.g. "majority" or "1"; server default when unset
+MONGO_SERVER_SELECTION_TIMEOUT_MS = int(os.getenv("MONGO_SERVER_SELECTION_TIMEOUT_MS", "5000"))
+MONGO_CONNECT_TIMEOUT_MS = int(os.getenv("MONGO_CONNECT_TIMEOUT_MS", "5000"))
+MONGO_SOCKET_TIMEOUT_MS = int(os.getenv("MONGO_SOCKET_TIMEOUT_MS", "30000"))
+GRIDFS_UPLOAD_WORKERS = int(os.getenv("GRIDFS_UPLOAD_WORKERS", "4")) # Parallel GridFS uploads per batch
+ATTACHMENT_CLAIM_STALE_SECONDS = int(os.getenv("ATTACHMENT_CLAIM_STALE_SECONDS", "600")) # Reclaim unlinked metadata after this
+ATTACHMENT_SPOOL_MAX_BYTES = int(os.getenv("ATTACHMENT_SPOOL_MAX_BYTES", str(8 * 1024 * 1024))) # Streamed attachments spill to disk above this while hashed
+GRIDFS_UPLOAD_WAIT_SECONDS = 30 # Wait for another worker uploading the same content
+MONGO_TEXT_INDEX = os.getenv("MONGO_TEXT_INDEX", "false").lower() == "true" # Full-text index on Bloomberg subject/body
+
+_shared_client = None
+_shared_client_lock = threading.Lock()
+
+def _client_options():
+    options = {
+        "maxPoolSize": MONGO_MAX_POOL_SIZE,
+        "serverSelectionTimeoutMS": MONGO_SERVER_SELECTION_TIMEOUT_MS,
+        "connectTimeoutMS": MONGO_CONNECT_TIMEOUT_MS,
+        "socketTimeoutMS": MONGO_SOCKET_TIMEOUT_MS,
+    }
+    if MONGO_WRITE_CONCERN:
+        options["w"] = int(MONGO_WRITE_CONCERN) if MONGO_WRITE_CONCERN.isdigit() else MONGO_WRITE_CONCERN
+    return options
+
+def get_shared_client():
+    """
+    Return the process-wide MongoDBClient, created lazily on first use.
+    MongoClient is thread-safe and pools connections, so all workers share one instance.
+    """
+    global _shared_client
+    if _shared_client is None:
+        with _shared_client_lock:
+            if _shared_client is None:
+                _shared_client = MongoDBClient(MONGO_URI, MONGO_DB_NAME, **_client_options())
+    return _shared_client
+
+def close_shared_client():
+    """Close the process-wide client (called at shutdown)."""
+    global _shared_client
+    with _shared_client_lock:
+        if _shared_client is not None:
+            _shared_client.close_connection()
+            _shared_client = None
+
+atexit.register(close_shared_client)
 
 class MongoDBClient:
-    def __init__(self, uri, db_name):
-        self.client = MongoClient(uri)
+    def __init__(self, uri, db_name, **client_options):
+        self.client = MongoClient(uri, **client_options)
         self.db = self.client[db_name]
 
     def get_mongo_client(self):
@@ -24,11 +82,47 @@ class MongoDBClient:
     def get_mongo_collection(self, collection_name):
         """Get a specific MongoDB collection"""
         return self.db[collection_name]
+
+    def ensure_indexes(self, text_index=MONGO_TEXT_INDEX):
+        """
+        Create the indexes used by dedup lookups and the query API (idempotent, run at startup).
+        Sort keys end with _id so keyset pagination is served by the index.
+        """
+        indexes = {
+            BLOOMBERG_COLLECTION_NAME: [
+                [("time", DESCENDING), ("_id", DESCENDING)],
+                [("from", ASCENDING), ("time", DESCENDING), ("_id", DESCENDING)],
+            ],
+            SHUCHUANG_COLLECTION_NAME: [
+                [("createdAt", DESCENDING), ("_id", DESCENDING)],
+                [("emailId", ASCENDING)],
+            ],
+        }
+        if text_index:
+            # Compressed bodies are binary and only their subject is indexed
+            indexes[BLOOMBERG_COLLECTION_NAME].append([("subject", TEXT), ("body", TEXT)])
+        for collection_name, keys_list in indexes.items():
+            collection = self.get_mongo_collection(collection_name)
+            for keys in keys_list:
+                try:
+                    collection.create_index(keys)
+                except OperationFailure as e:
+                    # E.g. a different text index already exists; keep starting with the others
+                    logging.warning("Could not create index %s on %s: %s", keys, collection_name, e)
     
     def save_bloomberg_emails_to_db(self, emails):
         """Save Bloomberg emails to MongoDB"""
+        return len(self.insert_bloomberg_emails(emails))
+
+    def insert_bloomberg_emails(self, emails, errors=None):
+        """
+        Insert Bloomberg emails with one unordered insert_many, skipping ones already stored.
+        errors: optional dict receiving {email id: exception} for emails that failed on their own,
+            instead of raising for them (the write-behind buffer fails only their requests)
+        return: ids of the newly inserted emails
+        """
         if not emails:
-            return 0
+            return []
         try:
             collection = self.get_mongo_collection(BLOOMBERG_COLLECTION_NAME)
             ops = []
@@ -37,22 +131,28 @@ class MongoDBClient:
                 id = email.get("id")
                 if not id:
                     continue 
+                body = email.get("body")
+                codec, stored_body = compression.compress(body.encode("utf-8")) if body else (None, body)
                 email_doc = {
                     "_id": str(id),
                     "subject": email.get("subject"),
-                    "body": email.get("body"),
+                    "body": stored_body if codec else body,
                     "time": email.get("time"),
                     "from": email.get("from"),
                 }
+                if codec:
+                    email_doc["bodyCodec"] = codec # Read back with decode_bloomberg_email
                 ops.append(email_doc)
 
             if not ops:
-                return 0
+                return []
 
-            result = collection.insert_many(ops, ordered=False)
-            inserted = len(result.inserted_ids) if result.inserted_ids else 0
+            with metrics.MONGO_WRITE_SECONDS.time(operation="bloomberg_insert"):
+                result = collection.insert_many(ops, ordered=False)
+            inserted = list(result.inserted_ids or [])
+            metrics.MONGO_WRITE_BYTES.inc(sum(len(op.get("body") or b"") for op in ops), operation="bloomberg_insert")
 
-            logging.info("Inserted %d new emails (skipped duplicates).", inserted)
+            logging.debug("Inserted %d new emails (skipped duplicates).", len(inserted))
             return inserted
 
         except BulkWriteError as e:
@@ -60,10 +160,12 @@ class MongoDBClient:
             details = getattr(e, "details", {}) or {}
             write_errors = details.get("writeErrors", [])
             non_dup = [x for x in write_errors if x.get("code") != 11000]
-            if not non_dup:
-                attempted = len(ops)
-                dup_count = len(write_errors)
-                return max(0, attempted - dup_count)
+            if not non_dup or errors is not None:
+                for x in non_dup:
+                    errors[ops[x["index"]]["_id"]] = RuntimeError(f"insert failed: {(x.get('errmsg') or str(x.get('code')))[:160]}")
+                failed = {x.get("index") for x in write_errors}
+                metrics.DUPLICATES_SKIPPED.inc(len(write_errors) - len(non_dup), stage="insert")
+                return [op["_id"] for index, op in enumerate(ops) if index not in failed]
             brief = "; ".join((x.get("errmsg") or str(x.get("code")))[:160] for x in non_dup[:3])
             raise RuntimeError(f"insert_many failed (non-duplicate): {brief}") from None
 
@@ -74,66 +176,468 @@ class MongoDBClient:
     
     def save_shuchuang_attachments_to_db(self, attachments):
         """Save Shuchuang attachments to MongoDB"""
+        return len(self.insert_shuchuang_attachments(attachments))
+
+    def insert_shuchuang_attachments(self, attachments, errors=None):
+        """
+        Save Shuchuang attachments to MongoDB in three bulk steps:
+        claim metadata ids with one bulk upsert, store the claimed files in GridFS,
+        then link them with one bulk update. GridFS files are content-addressed
+        (SHA-256) and reference-counted, so identical attachments share one file.
+        Attachments whose upload fails have their claims released, the others are still
+        linked; metadata left unlinked by a crashed run is reclaimed once it is stale.
+        Until then the call raises for it, so the notification is retried instead of
+        acked without its file.
+        errors: optional dict receiving {metadata id: exception} for attachments that failed
+            (or are still being stored by another worker) instead of raising for them
+        return: metadata ids ("email_id:attachment_id") of the newly stored attachments
+        """
         if not attachments:
-            return 0
+            return []
         collection = self.get_mongo_collection(SHUCHUANG_COLLECTION_NAME)
         db = collection.database
         fs = gridfs.GridFS(db, collection=SHUCHUANG_FS_COLLECTION_NAME)
-        inserted = 0
+        now = datetime.now(timezone.utc)
 
+        by_meta_id = {}
         for attachment in attachments:
             if attachment is None:
                 continue
             id = attachment.get("id")
             email_id = attachment.get("email_id")
-            attachment_content = attachment.get("content")
-            filename = attachment.get("name")
-            content_type = attachment.get("content_type")
-            time = attachment.get("time")
-            
-            metaId = f"{email_id}:{id}"
-            
             if not id or not email_id:
                 continue
-            
+            by_meta_id[f"{email_id}:{id}"] = attachment
+        if not by_meta_id:
+            return []
+
+        # 1) Claim: one round trip upserts every metadata document
+        claim_ops = []
+        for metaId, attachment in by_meta_id.items():
             attachment_doc = {
                 "_id": metaId,
-                "emailId": str(email_id),
-                "attachmentId": str(id),
-                "filename": filename,
-                "contentType": content_type,
-                "createdAt": time,
+                "emailId": str(attachment.get("email_id")),
+                "attachmentId": str(attachment.get("id")),
+                "filename": attachment.get("name"),
+                "contentType": attachment.get("content_type"),
+                "createdAt": attachment.get("time"),
+                "claimedAt": now,
             }
-            
+            claim_ops.append(UpdateOne({"_id": metaId}, {"$setOnInsert": attachment_doc}, upsert=True))
+        metaIds = list(by_meta_id)
+        try:
+            with metrics.MONGO_WRITE_SECONDS.time(operation="attachment_claim"):
+                result = collection.bulk_write(claim_ops, ordered=False)
+            claimed = list(result.upserted_ids.values())
+        except BulkWriteError as e:
+            # A concurrent worker upserting the same id loses with E11000, anything else is fatal
+            details = getattr(e, "details", {}) or {}
+            if any(x.get("code") != 11000 for x in details.get("writeErrors", [])):
+                raise
+            claimed = [x["_id"] for x in details.get("upserted", [])]
+        reclaimed, pending = self._reclaim_stale_attachments(collection, metaIds, set(claimed), now)
+        claimed += reclaimed
+        metrics.DUPLICATES_SKIPPED.inc(len(metaIds) - len(claimed) - len(pending), stage="insert")
+        # 2) Store the claimed files by content digest, in parallel when there are several
+        uploaded, failed = self._upload_claimed(fs, db, by_meta_id, claimed) if claimed else ([], {})
+        if failed:
+            # Undo these claims so the retry stores them instead of skipping them as duplicates
+            self._release_claims(collection, db, list(failed), [])
+
+        # 3) Link: one round trip sets gridfsId on every uploaded file
+        if uploaded:
+            link_ops = [
+                UpdateOne({"_id": metaId, "gridfsId": {"$exists": False}},
+                          {"$set": {"gridfsId": gridfsId}, "$unset": {"pendingGridfsId": ""}})
+                for metaId, gridfsId in uploaded
+            ]
+            try:
+                with metrics.MONGO_WRITE_SECONDS.time(operation="attachment_link"):
+                    linked = collection.bulk_write(link_ops, ordered=False).modified_count
+            except Exception:
+                self._release_claims(collection, db, [metaId for metaId, _ in uploaded], uploaded)
+                raise
+            logging.debug("Inserted %d new attachments (skipped duplicates).", linked)
+
+        # Claimed by another worker (or a crashed one) and not linked yet: fail so the
+        # caller retries later rather than acking attachments that may never be stored
+        for metaId in pending:
+            failed[metaId] = RuntimeError(f"attachment {metaId} is still being stored by another worker")
+        if failed and errors is None:
+            raise next(iter(failed.values()))
+        if errors is not None:
+            errors.update(failed)
+        return [metaId for metaId, _ in uploaded]
+
+    def _upload_claimed(self, fs, db, by_meta_id, claimed):
+        """
+        Upload the claimed attachments.
+        return: ([(metaId, gridfsId) of the stored and referenced ones], {metaId: exception} of the failed ones)
+        """
+        def upload(metaId):
+            return metaId, self._put_attachment_file(fs, db, by_meta_id[metaId])
+        uploaded, failed = [], {}
+        if len(claimed) == 1:
+            try:
+                uploaded.append(upload(claimed[0]))
+            except Exception as e:
+                failed[claimed[0]] = e
+            return uploaded, failed
+        with ThreadPoolExecutor(max_workers=min(GRIDFS_UPLOAD_WORKERS, len(claimed))) as executor:
+            futures = {metaId: executor.submit(upload, metaId) for metaId in claimed}
+        for metaId, future in futures.items():
+            try:
+                uploaded.append(future.result())
+            except Exception as e:
+                failed[metaId] = e
+        return uploaded, failed
+
+    @classmethod
+    def _release_claims(cls, collection, db, claimed, uploaded):
+        """
+        Delete claimed metadata documents that were not linked and release the GridFS
+        references taken for them, deleting files left unreferenced.
+        Best effort: what is left is reclaimed once stale.
+        """
+        gridfs_ids = dict(uploaded)
+        for metaId in claimed:
+            try:
+                if not collection.delete_one({"_id": metaId, "gridfsId": {"$exists": False}}).deleted_count:
+                    continue # Linked before the failure, it is stored
+                if metaId in gridfs_ids:
+                    cls._release_file_reference(db, gridfs_ids[metaId])
+            except Exception:
+                logging.exception("Could not release the claim on attachment %s", metaId)
+
+    @staticmethod
+    def _reclaim_stale_attachments(collection, metaIds, claimed, now):
+        """
+        Take over metadata documents that were claimed but never linked to a GridFS file
+        (a previous run crashed), once their claim is older than the stale timeout.
+        return: (reclaimed metadata ids, ids still claimed by someone else and not linked)
+        """
+        cutoff = now - timedelta(seconds=ATTACHMENT_CLAIM_STALE_SECONDS)
+        unlinked = collection.find(
+            {"_id": {"$in": [m for m in metaIds if m not in claimed]}, "gridfsId": {"$exists": False}},
+            {"claimedAt": 1},
+        )
+        reclaimed, pending = [], []
+        for doc in unlinked:
+            claimed_at = doc.get("claimedAt")
+            if claimed_at is not None and claimed_at.replace(tzinfo=timezone.utc) >= cutoff:
+                pending.append(doc["_id"])
+                continue
+            # Compare-and-set on claimedAt so only one worker takes over each document
             res = collection.update_one(
-                {"_id": metaId},
-                {"$setOnInsert": attachment_doc},
-                upsert=True
+                {"_id": doc["_id"], "gridfsId": {"$exists": False}, "claimedAt": claimed_at},
+                {"$set": {"claimedAt": now}},
             )
-            
-            if res.upserted_id is None:
-                # Duplicate, skip
-                continue
-            
-            gridfsId = fs.put(
-                attachment_content,
-                _id=metaId,
-                filename=filename,
-                contentType=content_type,
-                emailId=str(email_id),
-                attachment_id=str(id),
-                time=time,
+            if res.modified_count:
+                reclaimed.append(doc["_id"])
+            else:
+                pending.append(doc["_id"])
+        if reclaimed:
+            logging.warning("Reclaimed %d unlinked attachment(s) from an interrupted run.", len(reclaimed))
+        return reclaimed, pending
+
+    @classmethod
+    def _put_attachment_file(cls, fs, db, attachment):
+        """
+        Store one attachment's content in GridFS keyed by its SHA-256 digest and take a reference on it.
+        Content already stored (the same report mailed again, or to another folder) is only referenced.
+        return: GridFS file id, "sha256:<hex digest>"
+        """
+        content_stream = attachment.get("content_stream")
+        content_type = attachment.get("content_type")
+        if attachment.get("content_file") is not None: # Already downloaded by spool_attachment, closed by its owner
+            data, digest, size, codec = (attachment["content_file"], attachment["sha256"],
+                                         attachment["size"], attachment.get("codec"))
+        elif content_stream is None:
+            content = attachment.get("content") or b""
+            digest, size = hashlib.sha256(content).hexdigest(), len(content)
+            codec, data = compression.compress(content, content_type)
+        else:
+            codec = compression.choose_codec(attachment.get("size"), content_type)
+            data, digest, size = cls._spool_and_hash(content_stream, codec)
+        # The id is the digest of the raw content, so dedup holds whatever codec stored it
+        file_id = f"sha256:{digest}"
+        files = db[f"{SHUCHUANG_FS_COLLECTION_NAME}.files"]
+        try:
+            # Record the reference on the metadata before taking it, so reconcile_attachment_refcounts
+            # counts it; a crash before the link leaves refCount too high until that reconcile
+            db[SHUCHUANG_COLLECTION_NAME].update_one(
+                {"_id": f"{attachment.get('email_id')}:{attachment.get('id')}", "gridfsId": {"$exists": False}},
+                {"$set": {"pendingGridfsId": file_id}},
             )
-            
+            for _ in range(3):
+                if fs.exists(file_id) or not cls._upload_content(fs, db, file_id, data, size, codec, attachment):
+                    metrics.DUPLICATES_SKIPPED.inc(stage="content")
+                if files.update_one({"_id": file_id}, {"$inc": {"refCount": 1}}).matched_count:
+                    return file_id
+                # Released and deleted between the existence check and the reference, store it again
+            raise RuntimeError(f"GridFS file {file_id} kept disappearing while referencing it")
+        finally:
+            if content_stream is not None:
+                data.close()
+
+    @classmethod
+    def spool_attachment(cls, attachment):
+        """
+        Download a streamed attachment (`content_stream`) into a spooled file while hashing it,
+        so the Graph download runs in the calling thread rather than at write time.
+        The caller closes the returned `content_file`.
+        return: a copy of the attachment carrying content_file, sha256, size and codec
+        """
+        codec = compression.choose_codec(attachment.get("size"), attachment.get("content_type"))
+        data, digest, size = cls._spool_and_hash(attachment["content_stream"], codec)
+        spooled = {k: v for k, v in attachment.items() if k != "content_stream"}
+        spooled.update(content_file=data, sha256=digest, size=size, codec=codec)
+        return spooled
+
+    @staticmethod
+    def _spool_and_hash(content_stream, codec=None):
+        """
+        Hash a streamed attachment while buffering it (compressed with `codec` if given),
+        in memory up to ATTACHMENT_SPOOL_MAX_BYTES and on disk beyond,
+        so the digest is known before anything is written to GridFS.
+        return: (spooled file, hex digest, raw size)
+        """
+        spool = tempfile.SpooledTemporaryFile(max_size=ATTACHMENT_SPOOL_MAX_BYTES)
+        sha256 = hashlib.sha256()
+        compressor = compression.compressor(codec) if codec else None
+        size = 0
+        try:
+            for chunk in content_stream():
+                sha256.update(chunk)
+                size += len(chunk)
+                spool.write(compressor.compress(chunk) if compressor else chunk)
+            if compressor:
+                spool.write(compressor.flush())
+        except Exception:
+            spool.close()
+            raise
+        return spool, sha256.hexdigest(), size
+
+    @staticmethod
+    def _upload_content(fs, db, file_id, data, size, codec, attachment):
+        """
+        Upload content under its digest id.
+        data: bytes or a file object, already compressed with `codec` (None when raw)
+        size: raw content size
+        return: False if another worker stored the same content first
+        """
+        chunks = db[f"{SHUCHUANG_FS_COLLECTION_NAME}.chunks"]
+        file_fields = {
+            "_id": file_id,
+            "filename": attachment.get("name"), # Of the first attachment seen with this content
+            "contentType": attachment.get("content_type"),
+            "emailId": str(attachment.get("email_id")),
+            "attachment_id": str(attachment.get("id")),
+            "time": attachment.get("time"),
+            "refCount": 0,
+            "rawLength": size, # GridFS `length` is the stored, possibly compressed, size
+        }
+        if codec:
+            file_fields["codec"] = codec # Read back with iter_shuchuang_attachment
+        deadline = time.monotonic() + GRIDFS_UPLOAD_WAIT_SECONDS
+        started = time.perf_counter()
+        while True:
+            if hasattr(data, "seek"):
+                data.seek(0)
+            try:
+                fs.put(data, **file_fields)
+                stored_size = data.tell() if hasattr(data, "tell") else len(data)
+                break
+            except gridfs.errors.FileExists:
+                if fs.exists(file_id):
+                    return False
+                # Chunks without a files document: an upload in progress, or left over from a crash
+                first_chunk = chunks.find_one({"files_id": file_id}, {"_id": 1}, sort=[("_id", 1)])
+                if first_chunk is None:
+                    continue
+                age = (datetime.now(timezone.utc) - first_chunk["_id"].generation_time).total_seconds()
+                if age > ATTACHMENT_CLAIM_STALE_SECONDS:
+                    chunks.delete_many({"files_id": file_id})
+                    continue
+                if time.monotonic() > deadline:
+                    raise RuntimeError(f"Timed out waiting for a concurrent upload of {file_id}") from None
+                time.sleep(0.5)
+        metrics.MONGO_WRITE_SECONDS.observe(time.perf_counter() - started, operation="gridfs_upload")
+        metrics.MONGO_WRITE_BYTES.inc(stored_size, operation="gridfs_upload")
+        return True
+
+    def reconcile_attachment_refcounts(self):
+        """
+        Recompute every content-addressed GridFS file's refCount from the metadata documents
+        referencing it (linked, or pending while being stored), and delete files no longer
+        referenced once older than ATTACHMENT_CLAIM_STALE_SECONDS. Repairs the over-count a
+        crash between referencing a file and linking its metadata leaves behind.
+        Each correction is a compare-and-set on the old count, so a concurrent save is never lost.
+        return: dict with the number of files checked, corrected and deleted
+        """
+        collection = self.get_mongo_collection(SHUCHUANG_COLLECTION_NAME)
+        files = self.db[f"{SHUCHUANG_FS_COLLECTION_NAME}.files"]
+        chunks = self.db[f"{SHUCHUANG_FS_COLLECTION_NAME}.chunks"]
+        references = {}
+        for doc in collection.find(
+            {"$or": [{"gridfsId": {"$exists": True}}, {"pendingGridfsId": {"$exists": True}}]},
+            {"gridfsId": 1, "pendingGridfsId": 1},
+        ):
+            file_id = doc.get("gridfsId") or doc.get("pendingGridfsId")
+            references[file_id] = references.get(file_id, 0) + 1
+
+        cutoff = datetime.now(timezone.utc) - timedelta(seconds=ATTACHMENT_CLAIM_STALE_SECONDS)
+        checked = corrected = deleted = 0
+        # Files stored before content addressing carry no refCount and have a single reference
+        for file_doc in files.find({"refCount": {"$exists": True}}, {"refCount": 1, "uploadDate": 1}):
+            checked += 1
+            file_id, count = file_doc["_id"], file_doc["refCount"]
+            expected = references.get(file_id, 0)
+            if count != expected:
+                if not files.update_one({"_id": file_id, "refCount": count}, {"$set": {"refCount": expected}}).modified_count:
+                    continue # Referenced or released meanwhile, checked again next run
+                corrected += 1
+            upload_date = file_doc.get("uploadDate")
+            if expected == 0 and upload_date is not None and upload_date.replace(tzinfo=timezone.utc) < cutoff:
+                if files.delete_one({"_id": file_id, "refCount": {"$lte": 0}}).deleted_count:
+                    chunks.delete_many({"files_id": file_id})
+                    deleted += 1
+        if corrected or deleted:
+            logging.warning("Reconciled attachment references: %d refCount(s) corrected, %d unreferenced file(s) deleted.",
+                            corrected, deleted)
+        return {"checked": checked, "corrected": corrected, "deleted": deleted}
+
+    def delete_shuchuang_attachment(self, metaId):
+        """
+        Delete an attachment's metadata document and release its reference on the GridFS content.
+        The file is removed once no metadata document references it
+        (files stored before content addressing carry no refCount and have a single reference).
+        return: True if the metadata document existed
+        """
+        collection = self.get_mongo_collection(SHUCHUANG_COLLECTION_NAME)
+        doc = collection.find_one_and_delete({"_id": metaId})
+        if doc is None:
+            return False
+        gridfsId = doc.get("gridfsId")
+        if gridfsId is not None:
+            self._release_file_reference(self.db, gridfsId)
+        return True
+
+    @staticmethod
+    def _release_file_reference(db, gridfsId):
+        """Drop one reference on a GridFS file, deleting the file and its chunks with the last one."""
+        files = db[f"{SHUCHUANG_FS_COLLECTION_NAME}.files"]
+        released = files.find_one_and_update(
+            {"_id": gridfsId}, {"$inc": {"refCount": -1}},
+            projection={"refCount": 1}, return_document=ReturnDocument.AFTER,
+        )
+        if released is not None and released.get("refCount", 0) <= 0:
+            # Only while still unreferenced, a concurrent save may have just taken a reference
+            if files.delete_one({"_id": gridfsId, "refCount": {"$lte": 0}}).deleted_count:
+                db[f"{SHUCHUANG_FS_COLLECTION_NAME}.chunks"].delete_many({"files_id": gridfsId})
+
+    @staticmethod
+    def decode_bloomberg_email(doc):
+        """Return a stored Bloomberg document with its body decompressed (no-op for raw bodies)."""
+        if doc is None or not doc.get("bodyCodec"):
+            return doc
+        doc = dict(doc)
+        doc["body"] = compression.decompress(doc.pop("bodyCodec"), doc["body"]).decode("utf-8")
+        return doc
+
+    def get_bloomberg_email(self, email_id):
+        """Get a Bloomberg email by id with its body decompressed"""
+        collection = self.get_mongo_collection(BLOOMBERG_COLLECTION_NAME)
+        return self.decode_bloomberg_email(collection.find_one({"_id": str(email_id)}))
+
+    def iter_shuchuang_attachment(self, gridfsId):
+        """
+        Yield the raw content of a Shuchuang attachment file chunk by chunk, decompressing it if needed.
+        Raises gridfs.errors.NoFile if it does not exist.
+        """
+        fs = gridfs.GridFS(self.db, collection=SHUCHUANG_FS_COLLECTION_NAME)
+        grid_out = fs.get(gridfsId)
+        codec = getattr(grid_out, "codec", None)
+        return compression.iter_decompress(codec, iter(grid_out.readchunk, b""))
+
+    def read_shuchuang_attachment(self, gridfsId):
+        """Read the whole raw content of a Shuchuang attachment file"""
+        return b"".join(self.iter_shuchuang_attachment(gridfsId))
+
+    def find_existing_email_ids(self, email_ids):
+        """
+        Return which of the given Outlook message ids are already stored,
+        with one `$in` lookup per collection
+        """
+        if not email_ids:
+            return set()
+        email_ids = [str(e) for e in email_ids]
+        existing = set()
+        bloomberg = self.get_mongo_collection(BLOOMBERG_COLLECTION_NAME)
+        existing.update(doc["_id"] for doc in bloomberg.find({"_id": {"$in": email_ids}}, {"_id": 1}))
+        shuchuang = self.get_mongo_collection(SHUCHUANG_COLLECTION_NAME)
+        # Only linked attachments: unlinked ones are mid-upload or failed and must be fetched again
+        existing.update(shuchuang.distinct("emailId", {"emailId": {"$in": email_ids}, "gridfsId": {"$exists": True}}))
+        return existing
+
+    def get_sync_state(self, key):
+        """Get a sync state document (e.g. a folder's delta link) by key"""
+        collection = self.get_mongo_collection(SYNC_STATE_COLLECTION_NAME)
+        return collection.find_one({"_id": key})
+
+    def save_sync_state(self, key, **fields):
+        """Upsert fields of a sync state document"""
+        collection = self.get_mongo_collection(SYNC_STATE_COLLECTION_NAME)
+        fields["updatedAt"] = datetime.now(timezone.utc)
+        collection.update_one({"_id": key}, {"$set": fields}, upsert=True)
+
+    def save_subscription(self, subscription, folder_id, folder_name):
+        """Upsert a Graph subscription into the registry"""
+        collection = self.get_mongo_collection(SUBSCRIPTIONS_COLLECTION_NAME)
+        collection.update_one(
+            {"_id": subscription["id"]},
+            {"$set": {
+                "resource": subscription.get("resource"),
+                "notificationUrl": subscription.get("notificationUrl"),
+                "expirationDateTime": subscription.get("expirationDateTime"),
+                "folderId": folder_id,
+                "folderName": folder_name,
+                "updatedAt": datetime.now(timezone.utc),
+            }},
+            upsert=True,
+        )
+
+    def list_subscriptions(self):
+        """List all subscriptions in the registry"""
+        collection = self.get_mongo_collection(SUBSCRIPTIONS_COLLECTION_NAME)
+        return list(collection.find({}))
+
+    def delete_subscription(self, subscription_id):
+        """Remove a subscription from the registry"""
+        collection = self.get_mongo_collection(SUBSCRIPTIONS_COLLECTION_NAME)
+        collection.delete_one({"_id": subscription_id})
+
+    def try_acquire_lock(self, name, owner, lease_seconds):
+        """
+        Acquire or renew a lease-based lock.
+        Succeeds when the lock is free, expired, or already held by `owner`.
+        """
+        collection = self.get_mongo_collection(LOCKS_COLLECTION_NAME)
+        now = datetime.now(timezone.utc)
+        try:
             collection.update_one(
-                {"_id": metaId},
-                {"$set": {"gridfsId": gridfsId}}
+                {"_id": name, "$or": [{"owner": owner}, {"expiresAt": {"$lt": now}}]},
+                {"$set": {"owner": owner, "expiresAt": now + timedelta(seconds=lease_seconds)}},
+                upsert=True,
             )
-            
-            inserted += 1
+            return True
+        except DuplicateKeyError: # Held by someone else: the filter missed and the upsert collided
+            return False
 
-        logging.info("Inserted %d new attachments (skipped duplicates).", inserted)
-        return inserted
+    def release_lock(self, name, owner):
+        """Release a lock if `owner` still holds it"""
+        collection = self.get_mongo_collection(LOCKS_COLLECTION_NAME)
+        collection.delete_one({"_id": name, "owner": owner})
 
     def close_connection(self):
         self.client.close()
\ No newline at end of file
@@ -4,28 +4,58 @@ url = "https://developer.microsoft.com/en-us/graph/graph-explorer"
 Token is generated via graph explorer.
 '''
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import os
 from dotenv import load_dotenv
 from datetime import datetime, timedelta, timezone
-import html2text
 import src.mongo_service as mongodb
-from src.auth import AuthManager
+from src.html_conversion import MarkdownConverter, html_to_markdown
+from src import metrics, write_behind, rich_notifications
+from src.rich_notifications import NotificationDecryptionError
+from src.throttling import MailboxThrottle, retry_after_seconds, backoff_delay, GRAPH_MAX_RETRIES, THROTTLE_STATUSES
+from src.auth import get_auth_manager
 import logging
-import sys
 import base64
+import time
 
 load_dotenv()
 OUTLOOK_CLIENT_ID = os.getenv("OUTLOOK_CLIENT_ID")
-OUTLOOK_URL = "https://graph.microsoft.com/v1.0/" # Used API version 1.0
+OUTLOOK_URL = os.getenv("OUTLOOK_GRAPH_URL", "https://graph.microsoft.com/v1.0").rstrip("/") + "/" # Used API version 1.0, overridable for benchmarks
 AUTHORITY = "https://login.microsoftonline.com/consumers"
 SCOPES = ["Mail.Read", "User.Read"]
 CACHE_FILE = "msal_cache.bin"
+CLIENT_STATE = os.getenv("OUTLOOK_CLIENT_STATE", "secretClientValue") # Echoed back by Graph in every notification
+GRAPH_BATCH_LIMIT = 20 # Max requests per JSON $batch call
+GRAPH_BATCH_MAX_RETRIES = int(os.getenv("GRAPH_BATCH_MAX_RETRIES", "3"))
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+IDEMPOTENT_METHODS = ("GET", "PATCH", "DELETE")
+GRAPH_POOL_SIZE = int(os.getenv("GRAPH_POOL_SIZE", "20")) # Keep-alive connections kept to graph.microsoft.com
+GRAPH_CONNECT_TIMEOUT = float(os.getenv("GRAPH_CONNECT_TIMEOUT", "5"))
+GRAPH_READ_TIMEOUT = float(os.getenv("GRAPH_READ_TIMEOUT", "30"))
+GRAPH_TRANSPORT_RETRIES = int(os.getenv("GRAPH_TRANSPORT_RETRIES", "3")) # Connection errors only, statuses are retried in _request
+SHUCHUANG_STREAM_ATTACHMENTS = os.getenv("SHUCHUANG_STREAM_ATTACHMENTS", "false").lower() in ("1", "true", "yes")
+EMAIL_SELECT_FIELDS = "id,subject,receivedDateTime,bodyPreview,body,from,parentFolderId,categories"
+MESSAGE_SELECT_FIELDS = "id,subject,receivedDateTime,body,from,parentFolderId,categories" # What process_emails reads
+GRAPH_PAGE_SIZE = int(os.getenv("GRAPH_PAGE_SIZE", "50"))
+ATTACHMENT_CHUNK_SIZE = int(os.getenv("ATTACHMENT_CHUNK_SIZE", str(255 * 1024))) # Matches the GridFS chunk size
+SUBSCRIPTION_LIFETIME = timedelta(days=6, hours=23)
+RICH_SUBSCRIPTION_LIFETIME = timedelta(hours=23) # Graph caps message subscriptions with resource data at one day
+
+class DeltaTokenExpiredError(Exception):
+    """Raised when Graph no longer accepts a stored delta link (HTTP 410) and a full resync is needed."""
+
+
+def parse_graph_datetime(value: str) -> datetime:
+    """Parse a Graph timestamp; Graph may send 7 fractional digits, which fromisoformat rejects."""
+    value = value.replace("Z", "+00:00")
+    if "." in value:
+        head, tail = value.split(".", 1)
+        digits = len(tail) - len(tail.lstrip("0123456789"))
+        value = f"{head}.{tail[:min(digits, 6)].ljust(6, '0')}{tail[digits:]}"
+    dt = datetime.fromisoformat(value)
+    return dt if dt.tzinfo else dt.replace(tzinfo=timezone.utc)
 
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s [%(levelname)s] %(name)s: %(message)s",
-    handlers=[logging.StreamHandler(sys.stdout)],
-)
 
 def iso_z(dt: datetime) -> str:
     """Format a tz-aware datetime as ISO-8601 with trailing Z."""
@@ -35,22 +65,100 @@ def iso_z(dt: datetime) -> str:
 
 
 class OutlookAPI:
-    def __init__(self, auth=AuthManager()):
-        self.auth = auth
+    def __init__(self, auth=None):
+        self.auth = auth or get_auth_manager() # Shared per process, no token until the first request
+        self.session = self._build_session()
+        self.throttle = MailboxThrottle()
+        self.converter = MarkdownConverter()
+        self.subscription_folders: dict[str, str] = {} # subscription id -> folder name
     
+    @staticmethod
+    def _build_session():
+        """
+        Shared keep-alive session for all Graph calls.
+        urllib3's connection pool is thread-safe, so Flask threads and workers can share it.
+        """
+        retry = Retry(
+            total=GRAPH_TRANSPORT_RETRIES,
+            status=0, # HTTP statuses (429/5xx) are handled by the throttling-aware _request
+            backoff_factor=0.5,
+            allowed_methods=frozenset(IDEMPOTENT_METHODS), # POST is not safe to replay
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=GRAPH_POOL_SIZE, max_retries=retry)
+        session = requests.Session()
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        session.headers.update({"Accept-Encoding": "gzip, deflate"})
+        return session
+
     def _auth_headers(self):
         token = self.auth.get_access_token()
         return {"Authorization": f"Bearer {token}"}
 
+    def _request(self, method, url, **kwargs):
+        """
+        Send a Graph request over the pooled session with auth headers and default timeouts.
+        Each attempt holds a slot of the mailbox's adaptive concurrency limiter. 429/503 are
+        retried after Retry-After (or jittered exponential backoff), other 5xx only for
+        idempotent methods. The last response is returned once retries are exhausted.
+        """
+        extra_headers = kwargs.pop("headers", None) or {}
+        kwargs.setdefault("timeout", (GRAPH_CONNECT_TIMEOUT, GRAPH_READ_TIMEOUT))
+        limiter = self.throttle.limiter(self.throttle.mailbox_key(url))
+        endpoint = metrics.graph_endpoint_label(url)
+
+        for attempt in range(GRAPH_MAX_RETRIES + 1):
+            headers = self._auth_headers()
+            headers.update(extra_headers)
+            with limiter.slot() as slot:
+                started = time.perf_counter()
+                response = self.session.request(method, url, headers=headers, **kwargs)
+                metrics.GRAPH_REQUEST_SECONDS.observe(time.perf_counter() - started, method=method, endpoint=endpoint)
+                metrics.GRAPH_REQUESTS.inc(method=method, endpoint=endpoint, status=response.status_code)
+                slot["throttled"] = response.status_code in THROTTLE_STATUSES
+
+            status = response.status_code
+            retryable = status in THROTTLE_STATUSES or (status in RETRY_STATUSES and method in IDEMPOTENT_METHODS)
+            if not retryable or attempt == GRAPH_MAX_RETRIES:
+                return response
+            delay = retry_after_seconds(response.headers)
+            if delay is None:
+                delay = backoff_delay(attempt)
+            logging.warning("Graph %s %s returned %d, retrying in %.1fs (attempt %d/%d)",
+                            method, url.split("?", 1)[0], status, delay, attempt + 1, GRAPH_MAX_RETRIES)
+            response.close()
+            time.sleep(delay)
+        return response
+
+    def connection_stats(self):
+        """Return request / new-connection counts across the session's pools; the difference is reuse."""
+        requests_sent = 0
+        connections_opened = 0
+        for adapter in self.session.adapters.values():
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools.get(key)
+                if pool is None:
+                    continue
+                requests_sent += pool.num_requests
+                connections_opened += pool.num_connections
+        return {
+            "requests": requests_sent,
+            "connections_opened": connections_opened,
+            "connections_reused": max(0, requests_sent - connections_opened),
+        }
+
     def get_user_info(self):
-        url = f"{OUTLOOK_URL}/me"
-        response = requests.get(url, headers=self._auth_headers())
+        url = f"{OUTLOOK_URL}me"
+        response = self._request("GET", url)
         return response.json()
 
     def get_user_folder_ids(self):
         """Return list of target folder IDs and cache folder_id → name mapping."""
-        url = f"{OUTLOOK_URL}/me/mailFolders"
-        response = requests.get(url, headers=self._auth_headers())
+        url = f"{OUTLOOK_URL}me/mailFolders"
+        response = self._request("GET", url)
+        response.raise_for_status()
         folders = response.json().get('value', [])
         folder_ids: list[str] = []
         self.folder_map: dict[str, str] = {}
@@ -64,31 +172,142 @@ class OutlookAPI:
         return folder_ids if folder_ids else None
     
 
-    def get_email_by_resource(self, resource):
+    @staticmethod
+    def _message_query(expand_attachments=False):
+        """Query string limiting a message GET to the fields process_emails uses."""
+        query = f"$select={MESSAGE_SELECT_FIELDS}"
+        if expand_attachments and not SHUCHUANG_STREAM_ATTACHMENTS: # Streaming mode downloads bodies separately
+            query += "&$expand=attachments"
+        return query
+
+    def message_from_notification(self, notification):
+        """
+        Decrypt the message embedded in a rich notification.
+        notification: change notification JSON object
+
+        return: the message with the fields process_emails reads, or None when the
+        notification has no (complete, valid) resource data and the message must be fetched
+        """
+        encrypted_content = notification.get("encryptedContent")
+        decryptor = rich_notifications.get_decryptor()
+        if not encrypted_content or decryptor is None:
+            return None
+        try:
+            resource_data = decryptor.decrypt(encrypted_content)
+        except NotificationDecryptionError as e:
+            logging.warning("Discarding resource data of %s: %s", notification.get("resource"), e)
+            metrics.RICH_NOTIFICATIONS.inc(result="invalid")
+            return None
+        # Property names follow the casing of the subscription's $select
+        fields = {name.lower(): name for name in MESSAGE_SELECT_FIELDS.split(",")}
+        message = {fields.get(key.lower(), key): value for key, value in resource_data.items()}
+        complete = all(message.get(name) for name in ("id", "receivedDateTime", "parentFolderId")) \
+            and isinstance(message.get("body"), dict) and "content" in message["body"]
+        metrics.RICH_NOTIFICATIONS.inc(result="used" if complete else "partial")
+        return message if complete else None
+
+    def get_email_by_resource(self, resource, expand_attachments=False):
         """
         Fetch email details using the resource URL from notification
         resource: The resource URL from the notification
+        expand_attachments: inline the attachments in the same request (Shuchuang)
         """
         resource = resource.lstrip('/')
-        url = f"{OUTLOOK_URL}/{resource}"
-        response = requests.get(url, headers=self._auth_headers())
+        url = f"{OUTLOOK_URL}{resource}?{self._message_query(expand_attachments)}"
+        response = self._request("GET", url)
         response.raise_for_status()
         return response.json()
 
+    def get_emails_by_resources(self, resources, expand_attachments=()):
+        """
+        Fetch several emails with Graph JSON batching, packing up to 20 GETs per $batch call.
+        Items answered with 429/5xx are retried (honouring Retry-After), other failures are logged and skipped.
+        resources: list of resource URLs from notifications
+        expand_attachments: resources whose attachments are inlined in the same request (Shuchuang)
+
+        return: list of email JSON objects in the same order as `resources`, None for items that failed
+        """
+        results = [None] * len(resources)
+        exhausted = []
+        for start in range(0, len(resources), GRAPH_BATCH_LIMIT):
+            pending = {
+                str(i): "/" + resources[i].lstrip('/') + "?" + self._message_query(resources[i] in expand_attachments)
+                for i in range(start, min(start + GRAPH_BATCH_LIMIT, len(resources)))
+            }
+            attempt = 0
+            while pending:
+                body = {"requests": [
+                    {"id": request_id, "method": "GET", "url": url}
+                    for request_id, url in pending.items()
+                ]}
+                response = self._request("POST", f"{OUTLOOK_URL}$batch", json=body)
+                response.raise_for_status()
+
+                retry = dict(pending) # Anything missing from the response is retried too
+                retry_after = 0
+                for item in response.json().get("responses", []):
+                    request_id = item.get("id")
+                    if request_id not in pending:
+                        continue
+                    status = item.get("status", 0)
+                    if 200 <= status < 300:
+                        results[int(request_id)] = item.get("body")
+                        retry.pop(request_id)
+                    elif status == 429 or status >= 500:
+                        if status in THROTTLE_STATUSES:
+                            self.throttle.limiter("me").record_throttle()
+                        retry_after = max(retry_after, retry_after_seconds(item.get("headers")) or 0)
+                    else:
+                        error = (item.get("body") or {}).get("error", {})
+                        logging.error("Batch GET %s failed with %s: %s",
+                                      pending[request_id], status, error.get("message"))
+                        retry.pop(request_id)
+
+                attempt += 1
+                if retry and attempt > GRAPH_BATCH_MAX_RETRIES:
+                    exhausted.extend(retry.values())
+                    break
+                pending = retry
+                if pending:
+                    delay = max(retry_after, backoff_delay(attempt))
+                    logging.warning("Retrying %d batched GET(s) in %.1fs", len(pending), delay)
+                    time.sleep(delay)
+
+        if exhausted:
+            raise RuntimeError(f"Graph batch retries exhausted for {len(exhausted)} resource(s): {exhausted[:3]}")
+        return results
+
+    @property
+    def include_resource_data(self):
+        """Whether subscriptions carry encrypted message data (GRAPH_RICH_NOTIFICATIONS)."""
+        return rich_notifications.get_decryptor() is not None
+
+    def _subscription_expiration(self):
+        lifetime = RICH_SUBSCRIPTION_LIFETIME if self.include_resource_data else SUBSCRIPTION_LIFETIME
+        return (datetime.now(timezone.utc) + lifetime).strftime('%Y-%m-%dT%H:%M:%SZ')
+
     def subscribe_single_outlook_webhook(self, callback_url, folder_id):
         """
         Subscribe to Outlook webhook notifications for a single folder
         callback_url: The URL of AWS EC2 instance to receive notifications
         """
-        url = f"{OUTLOOK_URL}/subscriptions"
+        url = f"{OUTLOOK_URL}subscriptions"
         data = {
             "changeType": "created,updated",
             "notificationUrl": callback_url,
             "resource": f"me/mailFolders/{folder_id}/messages",
-            "expirationDateTime": (datetime.now(timezone.utc) + timedelta(days=6, hours=23)).strftime('%Y-%m-%dT%H:%M:%SZ'),
-            "clientState": "secretClientValue"
+            "expirationDateTime": self._subscription_expiration(),
+            "clientState": CLIENT_STATE
         }
-        response = requests.post(url, headers=self._auth_headers(), json=data)
+        decryptor = rich_notifications.get_decryptor()
+        if decryptor is not None:
+            # The selected fields are embedded, encrypted, in every notification
+            data["resource"] += f"?$select={MESSAGE_SELECT_FIELDS}"
+            data.update(decryptor.subscription_fields())
+            # Required for subscriptions with resource data: reauthorization / missed notification events
+            data["lifecycleNotificationUrl"] = callback_url.rsplit("/", 1)[0] + "/lifecycle"
+        response = self._request("POST", url, json=data)
+        response.raise_for_status()
         return response.json()
     
     def subscribe_outlook_webhook(self, callback_url):
@@ -106,7 +325,10 @@ class OutlookAPI:
         subs = []
         for folder_id in folder_ids:
             response = self.subscribe_single_outlook_webhook(callback_url, folder_id)
-            logging.info(f"Subscribe successfully to {folder_id}, getting response {response}.")
+            logging.info("Subscribed to folder %s, subscription %s expires %s",
+                         folder_id, response.get("id"), response.get("expirationDateTime"))
+            if response.get("id"):
+                self.subscription_folders[response["id"]] = self.folder_map.get(folder_id, "")
             subs.append(response)
         return subs
     
@@ -115,20 +337,43 @@ class OutlookAPI:
         Patch subscription to extend expiration
         subscription_id: The ID of the subscription to patch
         """
-        url = f"{OUTLOOK_URL}/subscriptions/{subscription_id}"
+        url = f"{OUTLOOK_URL}subscriptions/{subscription_id}"
         data = {
-            "expirationDateTime": (datetime.now(timezone.utc) + timedelta(days=6, hours=23)).strftime('%Y-%m-%dT%H:%M:%SZ')
+            "expirationDateTime": self._subscription_expiration()
         }
-        response = requests.patch(url, headers=self._auth_headers(), json=data)
+        response = self._request("PATCH", url, json=data)
+        response.raise_for_status()
         return response.json()
 
+    def list_subscriptions(self):
+        """
+        List all active subscriptions of this app
+
+        return: list of subscription JSON objects
+        """
+        url = f"{OUTLOOK_URL}subscriptions"
+        subscriptions = []
+        while url:
+            response = self._request("GET", url)
+            response.raise_for_status()
+            data = response.json()
+            subscriptions.extend(data.get('value', []))
+            url = data.get('@odata.nextLink')
+        return subscriptions
+
+    def delete_subscription(self, subscription_id):
+        """
+        Delete a subscription; an already deleted/expired one is not an error
+        subscription_id: The ID of the subscription to delete
+        """
+        url = f"{OUTLOOK_URL}subscriptions/{subscription_id}"
+        response = self._request("DELETE", url)
+        if response.status_code != 404:
+            response.raise_for_status()
+
     @staticmethod
     def html_to_markdown(html):
-        h = html2text.HTML2Text()
-        h.ignore_images = True
-        h.ignore_emphasis = False
-        h.body_width = 0
-        return h.handle(html)
+        return html_to_markdown(html)
     
     def process_emails(self, emails):
         """
@@ -140,7 +385,11 @@ class OutlookAPI:
             "bloomberg_emails": [],
             "shuchuang_emails": [],
         }
-        folder_map = getattr(self, 'folder_map', {})
+        folder_map = getattr(self, 'folder_map', None)
+        if folder_map is None: # Only the leader process lists folders on its own
+            self.get_user_folder_ids()
+            folder_map = self.folder_map
+        bloomberg_emails = []
         for email in emails:
             parent_id = email.get('parentFolderId', '')
             folder_name = folder_map.get(parent_id, '')
@@ -155,49 +404,91 @@ class OutlookAPI:
 
             if folder_name == 'Shuchuang':
                 email_id = email.get('id')
-                attachments = self.get_attachment_by_email_id(email_id)
+                if SHUCHUANG_STREAM_ATTACHMENTS: # Metadata only, bodies are streamed at save time
+                    attachments = self.list_attachment_metadata(email_id)
+                    process_attachment = self.process_attachment_stream
+                elif 'attachments' in email: # Already inlined with $expand=attachments
+                    attachments = email['attachments']
+                    process_attachment = self.process_attachment_from_email
+                else:
+                    attachments = self.get_attachment_by_email_id(email_id)
+                    process_attachment = self.process_attachment_from_email
                 for att in (attachments or []):
-                    processed = self.process_attachment_from_email(att, email_id)
+                    processed = process_attachment(att, email_id)
                     if processed:
                         processed_emails['shuchuang_emails'].append(processed)
             elif folder_name == 'Bloomberg':
-                processed_email = self.process_message_from_email(email)
-                processed_emails['bloomberg_emails'].append(processed_email)
+                bloomberg_emails.append(email)
+
+        # Convert all Bloomberg bodies as one batch so large ones run in parallel
+        conversions = self.converter.convert_many(
+            [email.get("body", {}).get("content") for email in bloomberg_emails]
+        )
+        for email, (markdown, seconds) in zip(bloomberg_emails, conversions):
+            logging.debug("Converted body of %s in %.1f ms", email.get("id"), seconds * 1000)
+            if seconds:
+                metrics.HTML_CONVERSION_SECONDS.observe(seconds)
+            processed_email = self.process_message_from_email(email, body=markdown)
+            processed_emails['bloomberg_emails'].append(processed_email)
         return processed_emails
     
     def save_emails_to_db(self, emails):
         processed_emails = self.process_emails(emails)
         # print("Processed Emails:", json.dumps(processed_emails, default=str, indent=2))
         
-        mongodb_client = mongodb.MongoDBClient(mongodb.MONGO_URI, mongodb.MONGO_DB_NAME)
-        inserted_bloomberg = 0
-        inserted_shuchuang = 0
-        
-        try:
-            shuchuang_attachments = processed_emails["shuchuang_emails"]
+        shuchuang_attachments = processed_emails["shuchuang_emails"]
+        bloomberg_emails = processed_emails["bloomberg_emails"]
+        if write_behind.WRITE_BEHIND_ENABLED:
+            # Batched with other requests' writes; returns once they are stored
+            inserted_count = write_behind.get_write_buffer().save(bloomberg_emails, shuchuang_attachments)
+        else:
+            mongodb_client = mongodb.get_shared_client()
+            inserted_count = 0
             if shuchuang_attachments:
-                inserted_shuchuang = mongodb_client.save_shuchuang_attachments_to_db(shuchuang_attachments)
-        
-            bloomberg_emails = processed_emails["bloomberg_emails"]
+                inserted_count += mongodb_client.save_shuchuang_attachments_to_db(shuchuang_attachments)
             if bloomberg_emails:
-                inserted_bloomberg = mongodb_client.save_bloomberg_emails_to_db(bloomberg_emails)
-            
-            inserted_count = inserted_shuchuang + inserted_bloomberg
-            logging.info("Saved %d emails to MongoDB.", inserted_count)
-            return inserted_count
-        finally:
-            mongodb_client.client.close()
+                inserted_count += mongodb_client.save_bloomberg_emails_to_db(bloomberg_emails)
+
+        logging.debug("Saved %d emails to MongoDB.", inserted_count)
+        return inserted_count
     
     def get_attachment_by_email_id(self, email_id):
-        url = f"{OUTLOOK_URL}/me/messages/{email_id}/attachments"
-        response = requests.get(url, headers=self._auth_headers())
-        logging.info(response.raise_for_status())
+        url = f"{OUTLOOK_URL}me/messages/{email_id}/attachments"
+        response = self._request("GET", url)
+        response.raise_for_status()
+        return response.json().get('value', [])
+
+    def list_attachment_metadata(self, email_id):
+        """
+        List the attachments of an email without their contentBytes
+        email_id: ID of the email
+        """
+        url = f"{OUTLOOK_URL}me/messages/{email_id}/attachments"
+        params = {"$select": "id,name,contentType,size,lastModifiedDateTime"}
+        response = self._request("GET", url, params=params)
+        response.raise_for_status()
         return response.json().get('value', [])
+
+    def iter_attachment_content(self, email_id, attachment_id):
+        """
+        Stream the raw bytes of a file attachment from the /$value endpoint
+        email_id: ID of the email containing the attachment
+        attachment_id: ID of the attachment
+
+        return: generator of byte chunks of at most ATTACHMENT_CHUNK_SIZE
+        """
+        url = f"{OUTLOOK_URL}me/messages/{email_id}/attachments/{attachment_id}/$value"
+        with self._request("GET", url, stream=True) as response:
+            response.raise_for_status()
+            for chunk in response.iter_content(chunk_size=ATTACHMENT_CHUNK_SIZE):
+                if chunk:
+                    yield chunk
     
-    def process_message_from_email(self, email):
+    def process_message_from_email(self, email, body=None):
         """
         Process the plain body of email message
         email: email JSON object
+        body: already converted markdown body, converted here when omitted
         """
         raw_time = email.get("receivedDateTime")
         dt = datetime.fromisoformat(raw_time.replace("Z", "+00:00"))
@@ -205,7 +496,7 @@ class OutlookAPI:
         processed_email = {
             "id": email.get("id"),
             "subject": email.get("subject"),
-            "body": self.html_to_markdown(email.get("body", {}).get("content")),
+            "body": body if body is not None else self.converter.convert(email.get("body", {}).get("content")),
             "time": dt,
             "from": email.get("from", {}).get("emailAddress", {}).get("address"),
         }
@@ -240,6 +531,86 @@ class OutlookAPI:
             return processed_attachment
         return None
 
+    def process_attachment_stream(self, attachment, email_id):
+        """
+        Process attachment metadata for streaming; the content is downloaded lazily when saved
+        attachment: attachment metadata JSON object (no contentBytes)
+        email_id: ID of the email containing the attachment
+
+        return: processed attachment with a `content_stream` callable instead of `content`
+        """
+        odata_type = attachment.get("@odata.type")
+        if odata_type and odata_type != "#microsoft.graph.fileAttachment":
+            return None # Only file attachments expose raw bytes via /$value
+        raw_time = attachment.get("lastModifiedDateTime")
+        dt = datetime.fromisoformat(raw_time.replace("Z", "+00:00"))
+        id = attachment.get("id")
+
+        return {
+            "id": id,
+            "email_id": email_id,
+            "name": attachment.get("name"),
+            "time": dt,
+            "content_type": attachment.get("contentType"),
+            "size": attachment.get("size"),
+            "content_stream": lambda: self.iter_attachment_content(email_id, id),
+        }
+
+    def iter_folder_messages_delta(self, folder_id, delta_link=None, since=None):
+        """
+        Page through message changes in a folder with a Graph delta query
+        folder_id: ID of the mail folder
+        delta_link: @odata.deltaLink from the previous sync; None starts a new sync
+        since: for a new sync, only messages received at or after this datetime
+
+        yield: (messages, delta_link) per page; delta_link is only set on the last page
+        """
+        if delta_link:
+            url, params = delta_link, None # deltaLink already includes query params
+        else:
+            url = f"{OUTLOOK_URL}me/mailFolders/{folder_id}/messages/delta"
+            params = {"$select": EMAIL_SELECT_FIELDS}
+            if since:
+                params["$filter"] = f"receivedDateTime ge {iso_z(since)}"
+
+        while url:
+            response = self._request("GET", url, params=params,
+                                     headers={"Prefer": f"odata.maxpagesize={GRAPH_PAGE_SIZE}"})
+            if response.status_code == 410:
+                raise DeltaTokenExpiredError(f"Delta link for folder {folder_id} has expired")
+            response.raise_for_status()
+            data = response.json()
+            messages = [m for m in data.get('value', []) if '@removed' not in m]
+            url = data.get('@odata.nextLink')
+            params = None
+            yield messages, data.get('@odata.deltaLink')
+
+    def iter_emails_by_range(self, folder_id, start, end):
+        """
+        Page through the emails of a folder received in [start, end)
+        folder_id: ID of the mail folder
+        start, end: datetime bounds
+
+        yield: one list of email JSON objects per Graph page
+        """
+        url = f"{OUTLOOK_URL}me/mailFolders/{folder_id}/messages"
+        params = {
+            "$select": EMAIL_SELECT_FIELDS,
+            "$orderby": "receivedDateTime desc",
+            "$top": GRAPH_PAGE_SIZE,
+            "$filter": (
+                f"receivedDateTime ge {iso_z(start)} "
+                f"and receivedDateTime lt {iso_z(end)}"
+            ),
+        }
+        while url:
+            response = self._request("GET", url, params=params)
+            response.raise_for_status() # An error body must not silently end the paging
+            data = response.json()
+            yield data.get('value', [])
+            url = data.get('@odata.nextLink')
+            params = None  # nextLink already includes query params
+
     def get_targeted_emails_by_range_mailfolders(self, start, end, folder_id=None):
         folder_ids = self.get_user_folder_ids() if not folder_id else folder_id
         if not folder_ids:
@@ -249,23 +620,9 @@ class OutlookAPI:
         emails = []
 
         for folder_id in folder_ids:
-            url = f"{OUTLOOK_URL}/me/mailFolders/{folder_id}/messages"
-            params = {
-                "$select": "id,subject,receivedDateTime,bodyPreview,body,from,parentFolderId,categories",
-                "$orderby": "receivedDateTime desc",
-                "$top": 50,
-                "$filter": (
-                    f"receivedDateTime ge {iso_z(start)} "
-                    f"and receivedDateTime lt {iso_z(end)}"
-                ),
-            }
             folder_emails: list = []
-            while url:
-                response = requests.get(url, headers=self._auth_headers(), params=params)
-                data = response.json()
-                folder_emails.extend(data.get('value', []))
-                url = data.get('@odata.nextLink')
-                params = None  # nextLink already includes query params
+            for page in self.iter_emails_by_range(folder_id, start, end):
+                folder_emails.extend(page)
             emails.append(folder_emails)
 
-        return emails
\ No newline at end of file
+        return emails
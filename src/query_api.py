@@ -0,0 +1,189 @@
+'''
+Read endpoints over ingested mail, so consumers stop scanning whole collections.
+Results are newest first and paged with an opaque keyset cursor (time, _id) served by
+the indexes from MongoDBClient.ensure_indexes; bodies are decompressed and attachments
+are streamed from GridFS chunk by chunk.
+    GET /api/bloomberg?since=2025-01-01&until=2025-02-01&from=a@b.com&q=rates&fields=subject,time&limit=50&cursor=...
+    GET /api/bloomberg/<email_id>
+    GET /api/shuchuang?since=...&until=...&email_id=...&fields=...&limit=...&cursor=...
+    GET /api/shuchuang/<attachment_doc_id>/content
+'''
+import os
+import json
+import base64
+import binascii
+import hmac
+from datetime import datetime, timezone
+from urllib.parse import quote
+import gridfs.errors
+from dotenv import load_dotenv
+from flask import Blueprint, Response, abort, jsonify, request, stream_with_context
+import src.mongo_service as mongodb
+
+load_dotenv()
+QUERY_API_TOKEN = os.getenv("QUERY_API_TOKEN") # Bearer token required by /api, which is disabled (404) when unset
+QUERY_PAGE_SIZE = int(os.getenv("QUERY_PAGE_SIZE", "50"))
+QUERY_MAX_PAGE_SIZE = int(os.getenv("QUERY_MAX_PAGE_SIZE", "500"))
+
+BLOOMBERG_FIELDS = ("subject", "body", "time", "from")
+SHUCHUANG_FIELDS = ("emailId", "attachmentId", "filename", "contentType", "createdAt", "gridfsId")
+
+query_api = Blueprint("query_api", __name__, url_prefix="/api")
+
+
+@query_api.before_request
+def require_token():
+    # Fail closed: nginx exposes every path, so no token means no API
+    if not QUERY_API_TOKEN:
+        return jsonify({"error": "not found"}), 404
+    supplied = request.headers.get("Authorization", "")
+    if not hmac.compare_digest(supplied.encode(), f"Bearer {QUERY_API_TOKEN}".encode()):
+        return jsonify({"error": "unauthorized"}), 401
+    return None
+
+
+def _isoformat(dt):
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc) # pymongo returns naive UTC datetimes
+    return dt.astimezone(timezone.utc).isoformat(timespec="milliseconds").replace("+00:00", "Z")
+
+
+def _parse_time(name):
+    value = request.args.get(name)
+    if not value:
+        return None
+    try:
+        dt = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except ValueError:
+        abort(400, description=f"{name} must be an ISO-8601 datetime")
+    return dt if dt.tzinfo else dt.replace(tzinfo=timezone.utc)
+
+
+def _page_size():
+    try:
+        limit = int(request.args.get("limit", QUERY_PAGE_SIZE))
+    except ValueError:
+        abort(400, description="limit must be an integer")
+    return max(1, min(limit, QUERY_MAX_PAGE_SIZE))
+
+
+def _projection(allowed, sort_field):
+    """Requested fields (all by default) plus the sort keys the cursor needs."""
+    fields = request.args.get("fields")
+    if not fields:
+        return None
+    requested = [f.strip() for f in fields.split(",") if f.strip()]
+    unknown = [f for f in requested if f not in allowed]
+    if unknown:
+        abort(400, description=f"unknown field(s): {', '.join(unknown)}; allowed: {', '.join(allowed)}")
+    projection = dict.fromkeys(requested + [sort_field], 1)
+    if "body" in requested:
+        projection["bodyCodec"] = 1
+    return projection
+
+
+def _encode_cursor(doc, sort_field):
+    value = doc.get(sort_field)
+    position = [_isoformat(value) if value else None, doc["_id"]]
+    return base64.urlsafe_b64encode(json.dumps(position).encode()).decode().rstrip("=")
+
+
+def _cursor_filter(sort_field):
+    """
+    Keyset condition for the page after the cursor, ordered by (sort_field desc, _id desc).
+    Documents without a sort value sort last, after every dated one.
+    """
+    cursor = request.args.get("cursor")
+    if not cursor:
+        return None
+    try:
+        value, last_id = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        value = datetime.fromisoformat(value.replace("Z", "+00:00")) if value else None
+    except (ValueError, TypeError, binascii.Error):
+        abort(400, description="invalid cursor")
+    if value is None:
+        return {sort_field: None, "_id": {"$lt": last_id}}
+    return {"$or": [
+        {sort_field: {"$lt": value}},
+        {sort_field: value, "_id": {"$lt": last_id}},
+        {sort_field: None},
+    ]}
+
+
+def _time_filter(sort_field):
+    since, until = _parse_time("since"), _parse_time("until")
+    bounds = {}
+    if since:
+        bounds["$gte"] = since
+    if until:
+        bounds["$lt"] = until
+    return {sort_field: bounds} if bounds else None
+
+
+def _page(collection, filters, sort_field, projection, decode=None):
+    conditions = [f for f in filters + [_cursor_filter(sort_field)] if f]
+    query = {"$and": conditions} if conditions else {}
+    limit = _page_size()
+    docs = list(
+        collection.find(query, projection)
+        .sort([(sort_field, -1), ("_id", -1)])
+        .limit(limit + 1) # One extra tells whether there is a next page
+    )
+    next_cursor = _encode_cursor(docs[limit - 1], sort_field) if len(docs) > limit else None
+    items = []
+    for doc in docs[:limit]:
+        if decode:
+            doc = decode(doc)
+        items.append({k: _isoformat(v) if isinstance(v, datetime) else v for k, v in doc.items()})
+    return jsonify({"items": items, "next_cursor": next_cursor})
+
+
+@query_api.route("/bloomberg")
+def list_bloomberg():
+    client = mongodb.get_shared_client()
+    filters = [_time_filter("time")]
+    if request.args.get("from"):
+        filters.append({"from": request.args["from"]})
+    if request.args.get("q"):
+        if not mongodb.MONGO_TEXT_INDEX:
+            abort(400, description="full-text search needs MONGO_TEXT_INDEX=true")
+        filters.append({"$text": {"$search": request.args["q"]}})
+    return _page(client.get_mongo_collection(mongodb.BLOOMBERG_COLLECTION_NAME), filters, "time",
+                 _projection(BLOOMBERG_FIELDS, "time"), decode=client.decode_bloomberg_email)
+
+
+@query_api.route("/bloomberg/<email_id>")
+def get_bloomberg(email_id):
+    doc = mongodb.get_shared_client().get_bloomberg_email(email_id)
+    if doc is None:
+        abort(404)
+    return jsonify({k: _isoformat(v) if isinstance(v, datetime) else v for k, v in doc.items()})
+
+
+@query_api.route("/shuchuang")
+def list_shuchuang():
+    client = mongodb.get_shared_client()
+    # Only linked documents: the others are still being uploaded
+    filters = [_time_filter("createdAt"), {"gridfsId": {"$exists": True}}]
+    if request.args.get("email_id"):
+        filters.append({"emailId": request.args["email_id"]})
+    projection = _projection(SHUCHUANG_FIELDS, "createdAt") or {"claimedAt": 0}
+    return _page(client.get_mongo_collection(mongodb.SHUCHUANG_COLLECTION_NAME), filters, "createdAt", projection)
+
+
+@query_api.route("/shuchuang/<path:doc_id>/content")
+def download_shuchuang(doc_id):
+    client = mongodb.get_shared_client()
+    doc = client.get_mongo_collection(mongodb.SHUCHUANG_COLLECTION_NAME).find_one({"_id": doc_id})
+    if doc is None or doc.get("gridfsId") is None:
+        abort(404)
+    try:
+        chunks = client.iter_shuchuang_attachment(doc["gridfsId"])
+    except gridfs.errors.NoFile:
+        abort(404)
+    filename = quote(doc.get("filename") or "attachment") # RFC 5987, names are often not ASCII
+    return Response(
+        stream_with_context(chunks),
+        mimetype=doc.get("contentType") or "application/octet-stream",
+        headers={"Content-Disposition": f"attachment; filename*=UTF-8''{filename}"},
+    )
@@ -0,0 +1,103 @@
+'''
+Change notifications with encrypted resource data ("rich" notifications).
+Subscriptions created with includeResourceData carry the message itself, encrypted for
+our certificate, so ingestion workers can skip the per-message Graph GET:
+    1. unwrap the symmetric key (dataKey) with our RSA private key, OAEP padding
+    2. verify the HMAC-SHA256 of the payload (dataSignature) with that key
+    3. AES-CBC decrypt the payload, IV = first 16 bytes of the key, PKCS7 padding
+Needs a certificate / private key pair in PEM files.
+'''
+import os
+import hmac
+import json
+import base64
+import hashlib
+import logging
+import threading
+from dotenv import load_dotenv
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, padding, serialization
+from cryptography.hazmat.primitives.asymmetric import padding as asymmetric_padding
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+
+load_dotenv()
+GRAPH_RICH_NOTIFICATIONS = os.getenv("GRAPH_RICH_NOTIFICATIONS", "false").lower() == "true"
+GRAPH_NOTIFICATION_CERT_FILE = os.getenv("GRAPH_NOTIFICATION_CERT_FILE", "certs/graph_notifications.crt")
+GRAPH_NOTIFICATION_KEY_FILE = os.getenv("GRAPH_NOTIFICATION_KEY_FILE", "certs/graph_notifications.key")
+GRAPH_NOTIFICATION_KEY_PASSWORD = os.getenv("GRAPH_NOTIFICATION_KEY_PASSWORD")
+GRAPH_NOTIFICATION_CERT_ID = os.getenv("GRAPH_NOTIFICATION_CERT_ID", "outlook-service") # Echoed back in each notification
+
+
+class NotificationDecryptionError(Exception):
+    """Raised when encrypted resource data cannot be decrypted or fails its signature check."""
+
+
+class NotificationDecryptor:
+    def __init__(self, cert_file=GRAPH_NOTIFICATION_CERT_FILE, key_file=GRAPH_NOTIFICATION_KEY_FILE,
+                 key_password=GRAPH_NOTIFICATION_KEY_PASSWORD, certificate_id=GRAPH_NOTIFICATION_CERT_ID):
+        with open(cert_file, "rb") as f:
+            certificate = x509.load_pem_x509_certificate(f.read())
+        with open(key_file, "rb") as f:
+            self._private_key = serialization.load_pem_private_key(
+                f.read(), password=key_password.encode() if key_password else None)
+        self.certificate_id = certificate_id
+        # What the subscription's encryptionCertificate expects: the base64 DER certificate
+        self.encryption_certificate = base64.b64encode(
+            certificate.public_bytes(serialization.Encoding.DER)).decode()
+
+    def subscription_fields(self):
+        """Fields to add to a subscription request to receive encrypted resource data."""
+        return {
+            "includeResourceData": True,
+            "encryptionCertificate": self.encryption_certificate,
+            "encryptionCertificateId": self.certificate_id,
+        }
+
+    def decrypt(self, encrypted_content):
+        """
+        Decrypt a notification's encryptedContent.
+        return: the resource (message) JSON object
+        """
+        try:
+            if encrypted_content.get("encryptionCertificateId") not in (None, self.certificate_id):
+                raise NotificationDecryptionError(
+                    f"encrypted for certificate {encrypted_content.get('encryptionCertificateId')}, not ours")
+            key = self._private_key.decrypt(
+                base64.b64decode(encrypted_content["dataKey"]),
+                asymmetric_padding.OAEP(mgf=asymmetric_padding.MGF1(algorithm=hashes.SHA1()),
+                                        algorithm=hashes.SHA1(), label=None),
+            )
+            data = base64.b64decode(encrypted_content["data"])
+            signature = hmac.new(key, data, hashlib.sha256).digest()
+            if not hmac.compare_digest(signature, base64.b64decode(encrypted_content["dataSignature"])):
+                raise NotificationDecryptionError("dataSignature does not match, payload was tampered with")
+            decryptor = Cipher(algorithms.AES(key), modes.CBC(key[:16])).decryptor()
+            padded = decryptor.update(data) + decryptor.finalize()
+            unpadder = padding.PKCS7(algorithms.AES.block_size).unpadder()
+            return json.loads(unpadder.update(padded) + unpadder.finalize())
+        except NotificationDecryptionError:
+            raise
+        except Exception as e:
+            raise NotificationDecryptionError(f"{type(e).__name__}: {e}") from None
+
+
+_decryptor = None
+_decryptor_lock = threading.Lock()
+
+def get_decryptor():
+    """
+    Return the process-wide decryptor, or None when rich notifications are disabled
+    (or the certificate cannot be loaded, then subscriptions fall back to basic notifications).
+    """
+    global _decryptor
+    if not GRAPH_RICH_NOTIFICATIONS:
+        return None
+    if _decryptor is None:
+        with _decryptor_lock:
+            if _decryptor is None:
+                try:
+                    _decryptor = NotificationDecryptor()
+                except Exception:
+                    logging.exception("Cannot load the notification certificate, rich notifications disabled")
+                    _decryptor = False
+    return _decryptor or None
@@ -1,26 +1,99 @@
-from src.outlook_api import OutlookAPI
+from src.outlook_api import OutlookAPI, DeltaTokenExpiredError, iso_z, parse_graph_datetime
+import src.mongo_service as mongodb
+from src.dedup import SeenMessageCache
+from src import metrics
 from datetime import date, datetime, timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import os
 import time
 import logging
+import threading
+from dotenv import load_dotenv
+
+load_dotenv()
+DELTA_SYNC_INITIAL_DAYS = int(os.getenv("DELTA_SYNC_INITIAL_DAYS", "7")) # Look-back of a folder's first delta sync
+BACKFILL_SLICE_HOURS = int(os.getenv("BACKFILL_SLICE_HOURS", "24")) # Width of one backfill time slice
+BACKFILL_CONCURRENCY = int(os.getenv("BACKFILL_CONCURRENCY", "4")) # Slices fetched in parallel
+SUBSCRIPTION_RECONCILE_SECONDS = int(os.getenv("SUBSCRIPTION_RECONCILE_SECONDS", "3600")) # Re-check Graph against the registry
+SUBSCRIPTION_RETRY_SECONDS = int(os.getenv("SUBSCRIPTION_RETRY_SECONDS", "60")) # Delay after a failed renew / reconcile
+SUBSCRIPTION_REGISTRY_REFRESH_SECONDS = 60 # How often non-leader workers reload subscription -> folder names
 
 class OutlookService:
-    def __init__(self, outlook_api=OutlookAPI()):
-        self.api = outlook_api
+    def __init__(self, outlook_api=None):
+        self.api = outlook_api or OutlookAPI()
+        self.seen_cache = SeenMessageCache()
+        self._registry_loaded_at = 0.0
 
     def handle_notification_batch(self, notifications):
         """
         Process incoming notification from Outlook webhook
         notification: The notification payload from Outlook
         """
-        email_data = []
+        resources = {} # message id -> resource, also collapses repeats within the batch
+        embedded = {} # message id -> notification carrying encrypted resource data
+        expand_attachments = set()
         for notification in notifications:
             resource = notification.get('resource')
             if not resource:
-                print("No resource found in notification.")
-                return None
-            email_data.append(self.api.get_email_by_resource(resource))
-        return self.api.save_emails_to_db(email_data)
+                logging.warning("No resource found in notification.")
+                continue
+            message_id = (notification.get('resourceData') or {}).get('id') or resource.rstrip('/').split('/')[-1]
+            resources[message_id] = resource
+            if notification.get('encryptedContent'):
+                embedded[message_id] = notification
+            # Shuchuang mail is only useful for its attachments, fetch them in the same request
+            if self._subscription_folder(notification.get('subscriptionId')) == 'Shuchuang':
+                expand_attachments.add(resource)
+        if not resources:
+            return 0
+
+        # Skip messages already ingested, they would only be dropped as duplicates after the fetch
+        unseen = self.seen_cache.filter_unseen(list(resources), mongodb.get_shared_client().find_existing_email_ids)
+        metrics.DUPLICATES_SKIPPED.inc(len(resources) - len(unseen), stage="prefetch")
+        saved = 0
+        if unseen:
+            # Rich notifications carry the message: only fetch what is missing or needs attachments
+            email_data = []
+            to_fetch = []
+            for message_id in unseen:
+                message = None
+                if message_id in embedded and resources[message_id] not in expand_attachments:
+                    message = self.api.message_from_notification(embedded[message_id])
+                if message:
+                    email_data.append(message)
+                else:
+                    to_fetch.append(resources[message_id])
+            if to_fetch:
+                fetched = self.api.get_emails_by_resources(to_fetch, expand_attachments)
+                email_data += [email for email in fetched if email]
+            saved = self.api.save_emails_to_db(email_data)
+            self.seen_cache.add_many(email.get('id') for email in email_data if email.get('id'))
+        self._record_lag(notifications)
+        return saved
+
+    @staticmethod
+    def _record_lag(notifications):
+        """Observe webhook-receipt-to-stored lag for notifications stamped by the /notifications endpoint."""
+        now = time.time()
+        for notification in notifications:
+            received_at = notification.get('receivedAt')
+            if received_at:
+                metrics.NOTIFICATION_LAG.observe(now - received_at)
+        metrics.NOTIFICATIONS_PROCESSED.inc(len(notifications))
     
+    def _subscription_folder(self, subscription_id):
+        """Folder name of a subscription; workers other than the leader learn it from the registry."""
+        folder_name = self.api.subscription_folders.get(subscription_id)
+        if folder_name is None and time.time() - self._registry_loaded_at > SUBSCRIPTION_REGISTRY_REFRESH_SECONDS:
+            self._registry_loaded_at = time.time()
+            try:
+                for doc in mongodb.get_shared_client().list_subscriptions():
+                    self.api.subscription_folders[doc["_id"]] = doc.get("folderName", "")
+            except Exception:
+                logging.exception("[Service] Failed to load the subscription registry")
+            folder_name = self.api.subscription_folders.get(subscription_id)
+        return folder_name
+
     def update_access_token(self):
         """Update the access token for Outlook API"""
         self.api.renew_access_token()
@@ -39,30 +112,261 @@ class OutlookService:
         """
         return self.api.patch_subscription_expiration(subscription_id) 
     
-    def subscription_lifecycle(self, callback_url, renew_margin_minutes=60):
+    def reconcile_subscriptions(self, callback_url, renew_margin_minutes=60):
         """
-        Manage subscription lifecycle: create, monitor, and extend all subscriptions.
+        Reconcile Graph subscriptions with the registry in Mongo instead of re-subscribing:
+        keep one subscription per target folder (renewing it when close to expiry),
+        delete duplicates and stale ones, and only create what is missing.
         :param callback_url: The URL to receive notifications
         :param renew_margin_minutes: Minutes before expiration to trigger renewal
+        :return: list of kept subscriptions, each with folderId and folderName added
+        """
+        mongodb_client = mongodb.get_shared_client()
+        folder_ids = self.api.get_user_folder_ids() or []
+        registry = {doc["_id"]: doc for doc in mongodb_client.list_subscriptions()}
+        ours = [
+            sub for sub in self.api.list_subscriptions()
+            if sub.get("notificationUrl") == callback_url or sub.get("id") in registry
+        ]
+        margin = timedelta(minutes=renew_margin_minutes)
+
+        kept = {}
+        for folder_id in folder_ids:
+            matches = [
+                sub for sub in ours
+                if sub.get("notificationUrl") == callback_url
+                and folder_id.lower() in (sub.get("resource") or "").lower()
+                # Switching GRAPH_RICH_NOTIFICATIONS replaces the subscriptions of the other kind
+                and bool(sub.get("includeResourceData")) == self.api.include_resource_data
+            ]
+            matches.sort(key=lambda sub: parse_graph_datetime(sub["expirationDateTime"]), reverse=True)
+            sub = matches[0] if matches else None
+            if sub and parse_graph_datetime(sub["expirationDateTime"]) - datetime.now(timezone.utc) <= margin:
+                try:
+                    sub = dict(sub, **self.extend_subscription(sub["id"]))
+                    logging.info("[Service] Renewed subscription %s for folder %s", sub["id"], folder_id)
+                except Exception:
+                    logging.exception("[Service] Failed to renew subscription %s, replacing it", sub["id"])
+                    sub = None
+            if sub is None:
+                sub = self.api.subscribe_single_outlook_webhook(callback_url, folder_id)
+                logging.info("[Service] Created subscription %s for folder %s", sub["id"], folder_id)
+            else:
+                logging.info("[Service] Reusing subscription %s for folder %s", sub["id"], folder_id)
+            folder_name = self.api.folder_map.get(folder_id, "")
+            kept[sub["id"]] = dict(sub, folderId=folder_id, folderName=folder_name)
+
+        for sub in ours:
+            if sub["id"] not in kept:
+                logging.info("[Service] Deleting duplicate/stale subscription %s (%s)", sub["id"], sub.get("resource"))
+                try:
+                    self.api.delete_subscription(sub["id"])
+                except Exception:
+                    logging.exception("[Service] Failed to delete subscription %s", sub["id"])
+        for sub_id in registry:
+            if sub_id not in kept:
+                mongodb_client.delete_subscription(sub_id)
+        for sub_id, sub in kept.items():
+            mongodb_client.save_subscription(sub, sub["folderId"], sub["folderName"])
+            self.api.subscription_folders[sub_id] = sub["folderName"]
+        return list(kept.values())
+
+    def subscription_lifecycle(self, callback_url, renew_margin_minutes=60, stop_event=None):
+        """
+        Manage subscription lifecycle: reconcile with the registry on start (and hourly),
+        then sleep until the next subscription is due and renew all due ones concurrently.
+        :param callback_url: The URL to receive notifications
+        :param renew_margin_minutes: Minutes before expiration to trigger renewal
+        :param stop_event: threading.Event that ends the loop (e.g. on losing leadership)
+        """
+        stop_event = stop_event or threading.Event()
+        margin = timedelta(minutes=renew_margin_minutes)
+        subs = []
+        next_reconcile = datetime.now(timezone.utc)
+
+        while not stop_event.is_set():
+            now = datetime.now(timezone.utc)
+            min_wait = 1.0
+            if now >= next_reconcile:
+                try:
+                    subs = self.reconcile_subscriptions(callback_url, renew_margin_minutes)
+                    logging.info("[Service] Reconciled %d subscription(s)", len(subs))
+                    next_reconcile = now + timedelta(seconds=SUBSCRIPTION_RECONCILE_SECONDS)
+                except Exception:
+                    logging.exception("[Service] Subscription reconcile failed, will retry")
+                    next_reconcile = now + timedelta(seconds=SUBSCRIPTION_RETRY_SECONDS)
+
+            due = [sub for sub in subs if parse_graph_datetime(sub["expirationDateTime"]) - now <= margin]
+            if due:
+                subs, failed = self._renew_subscriptions(subs, due)
+                if failed:
+                    min_wait = SUBSCRIPTION_RETRY_SECONDS
+
+            # Sleep until the earliest renewal is due, or the next reconcile
+            wake_at = min([parse_graph_datetime(sub["expirationDateTime"]) - margin for sub in subs] + [next_reconcile])
+            stop_event.wait(max(min_wait, (wake_at - datetime.now(timezone.utc)).total_seconds()))
+
+    def _renew_subscriptions(self, subs, due):
+        """
+        Renew due subscriptions concurrently and record the new expirations in the registry.
+        :return: (updated subscription list, number of failed renewals)
+        """
+        mongodb_client = mongodb.get_shared_client()
+        with ThreadPoolExecutor(max_workers=len(due)) as executor:
+            futures = {sub["id"]: executor.submit(self.extend_subscription, sub["id"]) for sub in due}
+        renewed = {}
+        failed = 0
+        for sub in due:
+            try:
+                renewed[sub["id"]] = dict(sub, **futures[sub["id"]].result())
+                mongodb_client.save_subscription(renewed[sub["id"]], sub["folderId"], sub["folderName"])
+                logging.info("[Service] Renewed subscription %s, new expiration: %s",
+                             sub["id"], renewed[sub["id"]]["expirationDateTime"])
+            except Exception:
+                failed += 1
+                logging.exception("[Service] Failed to renew subscription %s, will retry", sub["id"])
+        return [renewed.get(sub["id"], sub) for sub in subs], failed
+
+    def sync_folder_deltas(self, folder_ids=None):
+        """
+        Incrementally sync target folders with Graph delta queries.
+        Only messages changed since the delta link stored in Mongo are fetched.
+        :param folder_ids: folders to sync, defaults to all target folders
+        :return: number of documents saved
+        """
+        all_folder_ids = self.api.get_user_folder_ids() or [] # Also refreshes the folder name map
+        folder_ids = folder_ids or all_folder_ids
+        saved = 0
+        for folder_id in folder_ids:
+            saved += self.sync_folder_delta(folder_id)
+        return saved
+
+    def sync_folder_delta(self, folder_id):
+        """
+        Run one delta sync for a folder, restarting from scratch if the stored delta link expired.
+        :param folder_id: The ID of the mail folder
+        :return: number of documents saved
         """
-        subs = self.create_subscription(callback_url)
-        logging.info("Created %d subscription(s): %s", len(subs), subs)
+        mongodb_client = mongodb.get_shared_client()
+        key = f"delta:{folder_id}"
+        state = mongodb_client.get_sync_state(key) or {}
+        try:
+            saved, delta_link = self._run_delta(folder_id, state.get("deltaLink"))
+        except DeltaTokenExpiredError:
+            logging.warning("[Service] Delta link for %s expired, starting a new sync", folder_id)
+            saved, delta_link = self._run_delta(folder_id, None)
 
-        while True:
-            for i, sub in enumerate(subs):
-                exp_str = sub.get("expirationDateTime")
-                expiration = datetime.fromisoformat(exp_str.replace("Z", "+00:00"))
-                minutes_left = (expiration - datetime.now(timezone.utc)).total_seconds() / 60
+        # Only advance the stored link once every page is saved, so an interrupted run is repeated
+        if delta_link:
+            mongodb_client.save_sync_state(key, folderId=folder_id, deltaLink=delta_link)
+        logging.info("[Service] Delta sync of %s saved %d document(s)", folder_id, saved)
+        return saved
 
-                logging.info("[Service] Subscription %d/%d (%s) expires in %.1f minutes",
-                             i + 1, len(subs), sub['id'], minutes_left)
+    def _run_delta(self, folder_id, delta_link):
+        since = None
+        if not delta_link:
+            since = datetime.now(timezone.utc) - timedelta(days=DELTA_SYNC_INITIAL_DAYS)
+        saved = 0
+        new_delta_link = None
+        for messages, page_delta_link in self.api.iter_folder_messages_delta(folder_id, delta_link, since):
+            if messages:
+                saved += self._save_unseen_messages(messages)
+            new_delta_link = page_delta_link or new_delta_link
+        return saved, new_delta_link
 
-                if minutes_left <= renew_margin_minutes:
-                    logging.info("[Service] Renewing subscription %s ...", sub['id'])
-                    try:
-                        subs[i] = self.extend_subscription(sub["id"])
-                        logging.info("[Service] New expiration: %s", subs[i]["expirationDateTime"])
-                    except Exception:
-                        logging.exception("[Service] Failed to renew subscription %s, will retry next cycle", sub['id'])
+    def _save_unseen_messages(self, messages):
+        """
+        Save a page of fetched messages, skipping ones already ingested
+        (so Shuchuang attachments are not downloaded again only to be dropped as duplicates).
+        :return: number of documents saved
+        """
+        ids = [message['id'] for message in messages if message.get('id')]
+        unseen = set(self.seen_cache.filter_unseen(ids, mongodb.get_shared_client().find_existing_email_ids))
+        metrics.DUPLICATES_SKIPPED.inc(len(ids) - len(unseen), stage="prefetch")
+        messages = [message for message in messages if message.get('id') in unseen]
+        if not messages:
+            return 0
+        saved = self.api.save_emails_to_db(messages)
+        self.seen_cache.add_many(message['id'] for message in messages)
+        return saved
+
+    def delta_sync_loop(self, interval_seconds, stop_event=None):
+        """
+        Periodically run delta sync as a safety net for missed webhooks
+        :param interval_seconds: Seconds between runs
+        :param stop_event: threading.Event that ends the loop (e.g. on losing leadership)
+        """
+        stop_event = stop_event or threading.Event()
+        while not stop_event.is_set():
+            try:
+                self.sync_folder_deltas()
+            except Exception:
+                logging.exception("[Service] Delta sync failed, will retry next cycle")
+            stop_event.wait(interval_seconds)
 
-            time.sleep(300)  # check every 5 minutes
\ No newline at end of file
+    def backfill_range(self, start, end, folder_ids=None,
+                       slice_hours=BACKFILL_SLICE_HOURS, concurrency=BACKFILL_CONCURRENCY):
+        """
+        Backfill emails received in [start, end).
+        The range is split into time slices that are paged concurrently across folders;
+        pages are saved as they arrive and finished slices are checkpointed, so a rerun resumes.
+        :param start: Start datetime (inclusive)
+        :param end: End datetime (exclusive)
+        :param folder_ids: folders to backfill, defaults to all target folders
+        :param slice_hours: Width of one time slice in hours
+        :param concurrency: Max slices fetched at the same time
+        :return: number of documents saved
+        """
+        all_folder_ids = self.api.get_user_folder_ids() or [] # Also refreshes the folder name map
+        folder_ids = folder_ids or all_folder_ids
+        mongodb_client = mongodb.get_shared_client()
+
+        tasks = []
+        for folder_id in folder_ids:
+            for slice_start, slice_end in self._time_slices(start, end, timedelta(hours=slice_hours)):
+                key = f"backfill:{folder_id}:{iso_z(slice_start)}:{iso_z(slice_end)}"
+                state = mongodb_client.get_sync_state(key)
+                if state and state.get("done"):
+                    continue
+                tasks.append((key, folder_id, slice_start, slice_end))
+        logging.info("[Service] Backfilling %d slice(s) across %d folder(s)", len(tasks), len(folder_ids))
+
+        saved = 0
+        failed = 0
+        with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+            futures = {executor.submit(self._backfill_slice, *task): task for task in tasks}
+            for future in as_completed(futures):
+                key = futures[future][0]
+                try:
+                    saved += future.result()
+                except Exception:
+                    failed += 1
+                    logging.exception("[Service] Backfill slice %s failed, rerun to resume", key)
+
+        logging.info("[Service] Backfill saved %d document(s), %d slice(s) failed", saved, failed)
+        return saved
+
+    def _backfill_slice(self, key, folder_id, start, end):
+        saved = 0
+        for page in self.api.iter_emails_by_range(folder_id, start, end):
+            if page:
+                saved += self._save_unseen_messages(page)
+        mongodb.get_shared_client().save_sync_state(key, done=True, folderId=folder_id, saved=saved)
+        return saved
+
+    @staticmethod
+    def _time_slices(start, end, width):
+        """
+        Split [start, end) into slices aligned to multiples of `width` since the epoch,
+        so overlapping backfills produce the same slice keys and share checkpoints.
+        """
+        if start.tzinfo is None:
+            start = start.replace(tzinfo=timezone.utc)
+        if end.tzinfo is None:
+            end = end.replace(tzinfo=timezone.utc)
+        epoch = datetime(1970, 1, 1, tzinfo=timezone.utc)
+        cursor = epoch + ((start - epoch) // width) * width
+        while cursor < end:
+            slice_end = cursor + width
+            yield max(cursor, start), min(slice_end, end)
+            cursor = slice_end
@@ -0,0 +1,138 @@
+'''
+Throttling-aware helpers for the Graph request layer.
+Graph answers 429/503 with a Retry-After header when a mailbox is pushed too hard
+(Outlook allows only a few concurrent requests per mailbox). Requests wait for a slot
+from a per-mailbox AIMD limiter: the allowed concurrency grows by one per window of
+successful requests and halves on every throttle, so it settles just under the limit.
+'''
+import os
+import time
+import random
+import threading
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+from dotenv import load_dotenv
+
+load_dotenv()
+GRAPH_MAX_RETRIES = int(os.getenv("GRAPH_MAX_RETRIES", "5")) # Retries of a throttled / failed request
+GRAPH_BACKOFF_BASE = float(os.getenv("GRAPH_BACKOFF_BASE", "1")) # Seconds, doubled per attempt
+GRAPH_BACKOFF_MAX = float(os.getenv("GRAPH_BACKOFF_MAX", "60"))
+GRAPH_CONCURRENCY_INITIAL = int(os.getenv("GRAPH_CONCURRENCY_INITIAL", "4")) # Outlook allows 4 concurrent requests per mailbox
+GRAPH_CONCURRENCY_MIN = int(os.getenv("GRAPH_CONCURRENCY_MIN", "1"))
+GRAPH_CONCURRENCY_MAX = int(os.getenv("GRAPH_CONCURRENCY_MAX", "8"))
+THROTTLE_STATUSES = (429, 503)
+
+
+def retry_after_seconds(headers):
+    """Parse a Retry-After header (delta-seconds or HTTP date); None when absent or invalid."""
+    value = (headers or {}).get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+
+def backoff_delay(attempt, base=GRAPH_BACKOFF_BASE, cap=GRAPH_BACKOFF_MAX):
+    """Exponential backoff with full jitter for the given (0-based) attempt."""
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+
+class AdaptiveConcurrencyLimiter:
+    def __init__(self, initial=GRAPH_CONCURRENCY_INITIAL, minimum=GRAPH_CONCURRENCY_MIN,
+                 maximum=GRAPH_CONCURRENCY_MAX):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.limit = float(max(minimum, min(initial, maximum)))
+        self.in_flight = 0
+        self.throttle_events = 0
+        self._last_decrease = 0.0
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        with self._cond:
+            while self.in_flight >= int(self.limit):
+                self._cond.wait()
+            self.in_flight += 1
+
+    def release(self, throttled=False):
+        with self._cond:
+            self.in_flight -= 1
+            if throttled:
+                self._on_throttle()
+            else:
+                # Additive increase: +1 after `limit` consecutive successes
+                self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+            self._cond.notify_all()
+
+    def record_throttle(self):
+        """Count a throttle seen outside a slot (e.g. one item of a $batch response)."""
+        with self._cond:
+            self._on_throttle()
+
+    def _on_throttle(self):
+        self.throttle_events += 1
+        now = time.monotonic()
+        # Multiplicative decrease, at most once per second so a burst of 429s halves once
+        if now - self._last_decrease >= 1.0:
+            self.limit = max(float(self.minimum), self.limit / 2)
+            self._last_decrease = now
+
+    @contextmanager
+    def slot(self):
+        """Hold a concurrency slot; set `state["throttled"]` to report a throttle on release."""
+        state = {"throttled": False}
+        self.acquire()
+        try:
+            yield state
+        finally:
+            self.release(state["throttled"])
+
+    def stats(self):
+        with self._cond:
+            return {
+                "limit": int(self.limit),
+                "in_flight": self.in_flight,
+                "throttle_events": self.throttle_events,
+            }
+
+
+class MailboxThrottle:
+    """One AdaptiveConcurrencyLimiter per mailbox."""
+    def __init__(self):
+        self._limiters = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def mailbox_key(url):
+        """'me' or the user id/UPN addressed by a Graph URL."""
+        path = url.split("?", 1)[0].lower()
+        marker = "/users/"
+        if marker in path:
+            return path.split(marker, 1)[1].split("/", 1)[0]
+        return "me"
+
+    def limiter(self, mailbox):
+        with self._lock:
+            limiter = self._limiters.get(mailbox)
+            if limiter is None:
+                limiter = self._limiters[mailbox] = AdaptiveConcurrencyLimiter()
+            return limiter
+
+    def stats(self):
+        with self._lock:
+            limiters = dict(self._limiters)
+        mailboxes = {mailbox: limiter.stats() for mailbox, limiter in limiters.items()}
+        return {
+            "throttle_events": sum(m["throttle_events"] for m in mailboxes.values()),
+            "mailboxes": mailboxes,
+        }
@@ -0,0 +1,226 @@
+'''
+Write-behind buffer in front of MongoDBClient.
+Processed Bloomberg emails and Shuchuang attachments from concurrent requests are
+gathered and written together, so a steady stream of small webhook batches becomes a
+few large unordered bulk writes. Writes are group-committed: the flusher writes whatever
+is pending as soon as it is idle, so batches form while the previous write is in flight.
+A batch is also cut at WRITE_BEHIND_MAX_DOCS documents or WRITE_BEHIND_MAX_BYTES, and
+WRITE_BEHIND_MAX_DELAY_MS (0 by default) can make the flusher linger to gather more.
+Callers block until their documents are flushed, so a queue item is only acked once durable;
+each caller gets its own result or error, a failing document does not fail its neighbours.
+Streamed attachments are downloaded by the caller before buffering, only Mongo writes are batched.
+'''
+import os
+import time
+import atexit
+import logging
+import threading
+from concurrent.futures import Future
+from dotenv import load_dotenv
+import src.mongo_service as mongodb
+from src import metrics
+
+load_dotenv()
+WRITE_BEHIND_ENABLED = os.getenv("WRITE_BEHIND_ENABLED", "true").lower() == "true"
+WRITE_BEHIND_MAX_DOCS = int(os.getenv("WRITE_BEHIND_MAX_DOCS", "500")) # Flush at this many documents
+WRITE_BEHIND_MAX_BYTES = int(os.getenv("WRITE_BEHIND_MAX_BYTES", str(5 * 1024 * 1024))) # ... or this much payload
+WRITE_BEHIND_MAX_DELAY_MS = int(os.getenv("WRITE_BEHIND_MAX_DELAY_MS", "0")) # Linger this long for more documents (0: flush when idle)
+
+
+def _attachment_size(attachment):
+    if attachment.get("content_file") is not None:
+        return attachment["size"]
+    content = attachment.get("content")
+    return len(content) if content is not None else int(attachment.get("size") or 0)
+
+
+class WriteBehindBuffer:
+    def __init__(self, client_factory=mongodb.get_shared_client, max_docs=WRITE_BEHIND_MAX_DOCS,
+                 max_bytes=WRITE_BEHIND_MAX_BYTES, max_delay_ms=WRITE_BEHIND_MAX_DELAY_MS):
+        """
+        client_factory: returns the MongoDBClient to flush to
+        """
+        self.client_factory = client_factory
+        self.max_docs = max_docs
+        self.max_bytes = max_bytes
+        self.max_delay = max_delay_ms / 1000
+        self._cond = threading.Condition()
+        self._pending = [] # (bloomberg emails, shuchuang attachments, future)
+        self._docs = 0
+        self._bytes = 0
+        self._oldest = None
+        self._flush_requested = False
+        self._closed = False
+        self._thread = None
+        self._flushes = 0
+        self._flushed_docs = 0
+        self._largest_flush = 0
+
+    def save(self, bloomberg_emails, shuchuang_attachments):
+        """
+        Buffer processed emails and attachments and wait until they are written.
+        return: number of newly stored documents among them
+        """
+        return self.submit(bloomberg_emails, shuchuang_attachments).result()
+
+    def submit(self, bloomberg_emails, shuchuang_attachments):
+        """
+        Buffer processed emails and attachments without waiting.
+        return: Future resolving to the number of newly stored documents, or raising the flush error
+        """
+        future = Future()
+        bloomberg_emails = list(bloomberg_emails or [])
+        shuchuang_attachments = [a for a in shuchuang_attachments or [] if a]
+        docs = len(bloomberg_emails) + len(shuchuang_attachments)
+        if not docs:
+            future.set_result(0)
+            return future
+        # Download streamed bodies here, in the caller's thread, so the single flusher only writes
+        spooled = []
+        try:
+            for i, attachment in enumerate(shuchuang_attachments):
+                if attachment.get("content_stream") is not None:
+                    shuchuang_attachments[i] = mongodb.MongoDBClient.spool_attachment(attachment)
+                    spooled.append(shuchuang_attachments[i])
+        except Exception:
+            _close_spooled(spooled)
+            raise
+        size = sum(len(e.get("body") or "") for e in bloomberg_emails)
+        size += sum(_attachment_size(a) for a in shuchuang_attachments)
+
+        with self._cond:
+            if self._closed:
+                _close_spooled(spooled)
+                raise RuntimeError("write-behind buffer is closed")
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="write-behind", daemon=True)
+                self._thread.start()
+            self._pending.append((bloomberg_emails, shuchuang_attachments, future))
+            self._docs += docs
+            self._bytes += size
+            if self._oldest is None:
+                self._oldest = time.monotonic()
+            self._cond.notify()
+        return future
+
+    def flush(self):
+        """Ask for the pending documents to be written now (does not wait)."""
+        with self._cond:
+            self._flush_requested = True
+            self._cond.notify()
+
+    def close(self, timeout=30):
+        """Flush everything pending and stop the flusher thread (shutdown)."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+            thread = self._thread
+        if thread is not None:
+            thread.join(timeout)
+
+    def stats(self):
+        with self._cond:
+            return {
+                "pending_documents": self._docs,
+                "pending_bytes": self._bytes,
+                "flushes": self._flushes,
+                "flushed_documents": self._flushed_docs,
+                "largest_flush": self._largest_flush,
+            }
+
+    def _due(self):
+        if not self._pending:
+            return False
+        return (self._closed or self._flush_requested
+                or self._docs >= self.max_docs or self._bytes >= self.max_bytes
+                or time.monotonic() - self._oldest >= self.max_delay)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._due():
+                    if self._closed:
+                        return
+                    timeout = self.max_delay - (time.monotonic() - self._oldest) if self._pending else None
+                    self._cond.wait(timeout)
+                batch, docs = self._pending, self._docs
+                self._pending, self._docs, self._bytes, self._oldest = [], 0, 0, None
+                self._flush_requested = False
+            self._flush(batch, docs)
+
+    def _flush(self, batch, docs):
+        """
+        Write a batch, then resolve each request's future from its own documents: a failed
+        bulk call fails only the requests with documents of that kind, and documents failing
+        on their own (errors keyed by id) fail only their request.
+        """
+        bloomberg_emails = [email for emails, _, _ in batch for email in emails]
+        shuchuang_attachments = [attachment for _, attachments, _ in batch for attachment in attachments]
+        inserted_emails, inserted_attachments, errors = set(), set(), {}
+        bloomberg_error = shuchuang_error = None
+        try:
+            client = self.client_factory()
+        except Exception as e:
+            bloomberg_error = shuchuang_error = e
+        else:
+            if bloomberg_emails:
+                try:
+                    inserted_emails = set(client.insert_bloomberg_emails(bloomberg_emails, errors=errors))
+                except Exception as e:
+                    bloomberg_error = e
+            if shuchuang_attachments:
+                try:
+                    inserted_attachments = set(client.insert_shuchuang_attachments(shuchuang_attachments, errors=errors))
+                except Exception as e:
+                    shuchuang_error = e
+        finally:
+            _close_spooled(shuchuang_attachments)
+        if bloomberg_error or shuchuang_error:
+            logging.error("[WriteBehind] Flush of %d document(s) failed: %s", docs, bloomberg_error or shuchuang_error)
+
+        metrics.WRITE_BEHIND_FLUSH_DOCUMENTS.observe(docs)
+        with self._cond:
+            self._flushes += 1
+            self._flushed_docs += docs
+            self._largest_flush = max(self._largest_flush, docs)
+        for emails, attachments, future in batch:
+            email_ids = [str(e.get("id")) for e in emails]
+            meta_ids = [f"{a.get('email_id')}:{a.get('id')}" for a in attachments]
+            error = ((bloomberg_error if emails else None) or (shuchuang_error if attachments else None)
+                     or next((errors[i] for i in email_ids + meta_ids if i in errors), None))
+            if error is not None:
+                future.set_exception(error)
+                continue
+            inserted = sum(1 for i in email_ids if i in inserted_emails)
+            inserted += sum(1 for i in meta_ids if i in inserted_attachments)
+            future.set_result(inserted)
+
+
+def _close_spooled(attachments):
+    for attachment in attachments:
+        content_file = attachment.get("content_file")
+        if content_file is not None:
+            content_file.close()
+
+
+_write_buffer = None
+_write_buffer_lock = threading.Lock()
+
+def get_write_buffer():
+    """Return the process-wide write-behind buffer, created on first use."""
+    global _write_buffer
+    if _write_buffer is None:
+        with _write_buffer_lock:
+            if _write_buffer is None:
+                _write_buffer = WriteBehindBuffer()
+    return _write_buffer
+
+def close_write_buffer():
+    """Flush and stop the process-wide buffer (called at shutdown, before the Mongo client closes)."""
+    global _write_buffer
+    with _write_buffer_lock:
+        if _write_buffer is not None:
+            _write_buffer.close()
+            _write_buffer = None
+
+atexit.register(close_write_buffer)
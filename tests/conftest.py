@@ -0,0 +1,34 @@
+'''
+Shared fixtures. Modules under src read their settings at import time,
+so the environment is set here, before any test module imports them.
+'''
+import os
+import tempfile
+
+_workdir = tempfile.mkdtemp(prefix="outlook-tests-")
+os.environ.update({
+    "MONGO_DB_NAME": "outlook_test",
+    "MONGO_COLLECTION_BLOOMBERG": "bloomberg",
+    "MONGO_COLLECTION_SHUCHUANG": "shuchuang",
+    "MONGO_COLLECTION_SHUCHUANG_FS": "shuchuang_fs",
+    "INGEST_QUEUE_PATH": os.path.join(_workdir, "ingest_queue.db"),
+    "METRICS_DIR": os.path.join(_workdir, "metrics"),
+    "MSAL_CACHE_FILE": os.path.join(_workdir, "msal_cache.bin"),
+})
+
+import mongomock
+import mongomock.gridfs
+import pytest
+import src.mongo_service as mongodb
+
+mongomock.gridfs.enable_gridfs_integration()
+
+
+@pytest.fixture
+def mongo_client(monkeypatch):
+    """A MongoDBClient backed by an empty in-memory mongomock database, installed as the shared client."""
+    client = mongodb.MongoDBClient.__new__(mongodb.MongoDBClient)
+    client.client = mongomock.MongoClient()
+    client.db = client.client[mongodb.MONGO_DB_NAME]
+    monkeypatch.setattr(mongodb, "_shared_client", client)
+    return client
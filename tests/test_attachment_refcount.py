@@ -0,0 +1,125 @@
+import hashlib
+import gridfs
+from datetime import datetime, timedelta, timezone
+import pytest
+import src.mongo_service as mongodb
+from src.mongo_service import MongoDBClient
+
+CONTENT = b"daily rates report" * 100
+FILE_ID = f"sha256:{hashlib.sha256(CONTENT).hexdigest()}"
+
+
+def attachment(email_id, id="a1", content=CONTENT):
+    return {"email_id": email_id, "id": id, "name": "report.pdf", "content_type": "application/pdf",
+            "content": content, "time": datetime(2025, 1, 1, tzinfo=timezone.utc)}
+
+
+def files(client):
+    return client.db[f"{mongodb.SHUCHUANG_FS_COLLECTION_NAME}.files"]
+
+
+def chunks(client):
+    return client.db[f"{mongodb.SHUCHUANG_FS_COLLECTION_NAME}.chunks"]
+
+
+def ref_count(client, file_id=FILE_ID):
+    doc = files(client).find_one({"_id": file_id})
+    return doc and doc["refCount"]
+
+
+def test_identical_content_is_stored_once_and_referenced_per_attachment(mongo_client):
+    stored = mongo_client.insert_shuchuang_attachments([attachment("m1"), attachment("m2")])
+    assert sorted(stored) == ["m1:a1", "m2:a1"]
+    assert files(mongo_client).count_documents({}) == 1
+    assert ref_count(mongo_client) == 2
+    assert b"".join(mongo_client.iter_shuchuang_attachment(FILE_ID)) == CONTENT
+
+    # The same attachments again are duplicates and take no new reference
+    assert mongo_client.insert_shuchuang_attachments([attachment("m1")]) == []
+    assert ref_count(mongo_client) == 2
+
+
+def test_deleting_the_last_reference_deletes_the_file(mongo_client):
+    mongo_client.insert_shuchuang_attachments([attachment("m1"), attachment("m2")])
+
+    assert mongo_client.delete_shuchuang_attachment("m1:a1")
+    assert ref_count(mongo_client) == 1
+    assert mongo_client.delete_shuchuang_attachment("m2:a1")
+    assert files(mongo_client).count_documents({}) == 0
+    assert chunks(mongo_client).count_documents({}) == 0
+    assert not mongo_client.delete_shuchuang_attachment("m2:a1")
+
+
+def test_failed_upload_releases_its_claim_and_keeps_the_others(mongo_client, monkeypatch):
+    upload_content = MongoDBClient._upload_content
+    def upload_failing_m2(fs, db, file_id, data, size, codec, attachment):
+        if attachment["email_id"] == "m2":
+            raise RuntimeError("GridFS unavailable")
+        return upload_content(fs, db, file_id, data, size, codec, attachment)
+    monkeypatch.setattr(MongoDBClient, "_upload_content", staticmethod(upload_failing_m2))
+
+    errors = {}
+    stored = mongo_client.insert_shuchuang_attachments(
+        [attachment("m1"), attachment("m2", content=b"other report")], errors=errors)
+    assert stored == ["m1:a1"]
+    assert list(errors) == ["m2:a1"]
+    collection = mongo_client.get_mongo_collection(mongodb.SHUCHUANG_COLLECTION_NAME)
+    assert collection.find_one({"_id": "m2:a1"}) is None # Released, the retry stores it
+    assert ref_count(mongo_client) == 1
+
+    monkeypatch.undo()
+    assert mongo_client.insert_shuchuang_attachments([attachment("m2", content=b"other report")]) == ["m2:a1"]
+
+
+def test_release_after_a_failed_link_deletes_files_left_unreferenced(mongo_client):
+    collection = mongo_client.get_mongo_collection(mongodb.SHUCHUANG_COLLECTION_NAME)
+    mongo_client.insert_shuchuang_attachments([attachment("m1")])
+    # A claim that took the only reference on new content but was never linked
+    collection.insert_one({"_id": "m2:a1"})
+    fs = gridfs.GridFS(mongo_client.db, collection=mongodb.SHUCHUANG_FS_COLLECTION_NAME)
+    MongoDBClient._put_attachment_file(fs, mongo_client.db, attachment("m2", content=b"other report"))
+    other_id = f"sha256:{hashlib.sha256(b'other report').hexdigest()}"
+    assert ref_count(mongo_client, other_id) == 1
+
+    MongoDBClient._release_claims(collection, mongo_client.db, ["m2:a1", "m1:a1"], [("m2:a1", other_id)])
+    assert files(mongo_client).find_one({"_id": other_id}) is None
+    assert chunks(mongo_client).count_documents({"files_id": other_id}) == 0
+    assert collection.find_one({"_id": "m1:a1"}) is not None # Linked, left alone
+    assert ref_count(mongo_client) == 1
+
+
+def test_reconcile_repairs_counts_left_by_a_crash(mongo_client):
+    mongo_client.insert_shuchuang_attachments([attachment("m1")])
+    # A worker crashed after referencing the file, before linking (its claim then went away)
+    files(mongo_client).update_one({"_id": FILE_ID}, {"$inc": {"refCount": 1}})
+
+    assert mongo_client.reconcile_attachment_refcounts() == {"checked": 1, "corrected": 1, "deleted": 0}
+    assert ref_count(mongo_client) == 1
+
+    # Unreferenced files are kept until stale, then deleted
+    mongo_client.get_mongo_collection(mongodb.SHUCHUANG_COLLECTION_NAME).delete_one({"_id": "m1:a1"})
+    assert mongo_client.reconcile_attachment_refcounts() == {"checked": 1, "corrected": 1, "deleted": 0}
+    assert ref_count(mongo_client) == 0
+    files(mongo_client).update_one({"_id": FILE_ID}, {"$set": {
+        "uploadDate": datetime.now(timezone.utc) - timedelta(seconds=mongodb.ATTACHMENT_CLAIM_STALE_SECONDS + 60)}})
+    assert mongo_client.reconcile_attachment_refcounts() == {"checked": 1, "corrected": 0, "deleted": 1}
+    assert chunks(mongo_client).count_documents({}) == 0
+
+
+def test_reconcile_counts_pending_references(mongo_client):
+    collection = mongo_client.get_mongo_collection(mongodb.SHUCHUANG_COLLECTION_NAME)
+    mongo_client.insert_shuchuang_attachments([attachment("m1")])
+    # Another worker is between referencing the file and linking its metadata
+    collection.insert_one({"_id": "m2:a1", "pendingGridfsId": FILE_ID})
+    files(mongo_client).update_one({"_id": FILE_ID}, {"$inc": {"refCount": 1}})
+
+    assert mongo_client.reconcile_attachment_refcounts()["corrected"] == 0
+    assert ref_count(mongo_client) == 2
+
+
+@pytest.mark.parametrize("count", [0, 5])
+def test_reconcile_sets_the_count_from_the_references(mongo_client, count):
+    mongo_client.insert_shuchuang_attachments([attachment("m1"), attachment("m2")])
+    files(mongo_client).update_one({"_id": FILE_ID}, {"$set": {"refCount": count}})
+    mongo_client.reconcile_attachment_refcounts()
+    assert ref_count(mongo_client) == 2
@@ -0,0 +1,92 @@
+import time
+import pytest
+from src.ingestion_queue import NotificationQueue, QueueFullError
+
+
+class Clock:
+    def __init__(self):
+        self.now = time.time()
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(time, "time", clock)
+    return clock
+
+
+def make_queue(tmp_path, **options):
+    options.setdefault("retry_base", 5)
+    options.setdefault("retry_max", 60)
+    return NotificationQueue(path=str(tmp_path / "queue.db"), **options)
+
+
+def available_at(queue, item_id):
+    return queue._connect().execute("SELECT available_at FROM notifications WHERE id = ?", (item_id,)).fetchone()[0]
+
+
+def test_claim_then_ack_removes_items(tmp_path, clock):
+    queue = make_queue(tmp_path)
+    assert queue.put([{"resource": "a"}, {"resource": "b"}]) == 2
+
+    claimed = queue.claim(10)
+    assert [n["resource"] for _, n in claimed] == ["a", "b"]
+    assert queue.claim(10) == [] # In flight
+    assert queue.stats()["in_flight"] == 2
+
+    queue.ack([item_id for item_id, _ in claimed])
+    assert queue.depth() == 0
+
+
+def test_put_rejects_batches_above_max_depth(tmp_path, clock):
+    queue = make_queue(tmp_path, max_depth=2)
+    queue.put([{"resource": "a"}])
+    with pytest.raises(QueueFullError):
+        queue.put([{"resource": "b"}, {"resource": "c"}])
+    assert queue.depth() == 1 # Nothing of the rejected batch was inserted
+
+
+def test_nack_backs_off_exponentially_up_to_the_cap(tmp_path, clock):
+    queue = make_queue(tmp_path, retry_base=5, retry_max=12, max_attempts=10)
+    queue.put([{"resource": "a"}])
+    delays = []
+    for _ in range(3):
+        [(item_id, _)] = queue.claim(1)
+        queue.nack([item_id])
+        delays.append(available_at(queue, item_id) - clock.now)
+        assert queue.claim(1) == [] # Not due yet
+        assert queue.stats()["backing_off"] == 1
+        clock.now += delays[-1]
+    assert delays == [5, 10, 12]
+    assert len(queue.claim(1)) == 1
+
+
+def test_nack_dead_letters_after_max_attempts_and_requeue_dead(tmp_path, clock):
+    queue = make_queue(tmp_path, retry_base=0, max_attempts=2)
+    queue.put([{"resource": "a"}])
+    for _ in range(2):
+        [(item_id, _)] = queue.claim(1)
+        queue.nack([item_id])
+
+    assert queue.claim(1) == []
+    stats = queue.stats()
+    assert (stats["depth"], stats["dead"]) == (0, 1)
+
+    assert queue.requeue_dead([item_id + 1]) == 0 # Not a dead item
+    assert queue.requeue_dead() == 1
+    [(requeued_id, notification)] = queue.claim(1)
+    assert (requeued_id, notification) == (item_id, {"resource": "a"})
+
+
+def test_timed_out_claims_are_retried_then_dead_lettered(tmp_path, clock):
+    queue = make_queue(tmp_path, visibility_timeout=30, max_attempts=2)
+    queue.put([{"resource": "a"}])
+    assert len(queue.claim(1)) == 1
+    clock.now += 31 # The worker died holding it
+    assert len(queue.claim(1)) == 1
+    clock.now += 31
+    assert queue.claim(1) == []
+    assert queue.stats()["dead"] == 1
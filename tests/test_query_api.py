@@ -0,0 +1,89 @@
+from datetime import datetime, timedelta, timezone
+import pytest
+from flask import Flask
+import src.mongo_service as mongodb
+import src.query_api as query_api_module
+from src.query_api import query_api
+
+TOKEN = "test-token"
+AUTH = {"Authorization": f"Bearer {TOKEN}"}
+START = datetime(2025, 1, 1, tzinfo=timezone.utc)
+
+
+@pytest.fixture
+def client(mongo_client, monkeypatch):
+    monkeypatch.setattr(query_api_module, "QUERY_API_TOKEN", TOKEN)
+    app = Flask(__name__)
+    app.register_blueprint(query_api)
+    return app.test_client()
+
+
+@pytest.fixture
+def emails(mongo_client):
+    """Seven emails: two share a time, one has none (it sorts last)."""
+    emails = [{"id": f"m{i}", "subject": f"s{i}", "body": f"body {i}", "from": "a@b.com",
+               "time": START + timedelta(hours=i)} for i in range(5)]
+    emails.append({"id": "m5", "subject": "s5", "body": "body 5", "from": "c@d.com", "time": START + timedelta(hours=4)})
+    emails.append({"id": "m6", "subject": "s6", "body": "body 6", "from": "a@b.com", "time": None})
+    mongo_client.insert_bloomberg_emails(emails)
+    return emails
+
+
+def fetch_all(client, url):
+    ids, pages, cursor = [], 0, None
+    while True:
+        response = client.get(url + (f"&cursor={cursor}" if cursor else ""), headers=AUTH)
+        assert response.status_code == 200
+        page = response.get_json()
+        ids += [item["_id"] for item in page["items"]]
+        pages += 1
+        cursor = page["next_cursor"]
+        if cursor is None:
+            return ids, pages
+
+
+@pytest.mark.parametrize("limit", [1, 2, 3, 10])
+def test_cursors_walk_every_email_once_newest_first(client, emails, limit):
+    ids, pages = fetch_all(client, f"/api/bloomberg?limit={limit}")
+    assert ids == ["m5", "m4", "m3", "m2", "m1", "m0", "m6"]
+    assert pages == -(-len(emails) // limit)
+
+
+def test_cursor_pages_keep_the_filters(client, emails):
+    ids, _ = fetch_all(client, "/api/bloomberg?limit=2&from=a@b.com&since=2025-01-01T01:00:00Z&fields=subject")
+    assert ids == ["m4", "m3", "m2", "m1"]
+    page = client.get("/api/bloomberg?limit=1&fields=subject", headers=AUTH).get_json()
+    assert set(page["items"][0]) == {"_id", "subject", "time"}
+
+
+def test_bodies_are_returned_decompressed(client, emails):
+    page = client.get("/api/bloomberg?limit=1", headers=AUTH).get_json()
+    assert page["items"][0]["body"] == "body 5"
+    assert "bodyCodec" not in page["items"][0]
+
+
+def test_attachment_cursors_list_only_linked_attachments(client, mongo_client):
+    mongo_client.insert_shuchuang_attachments([
+        {"email_id": f"m{i}", "id": "a1", "name": f"r{i}.pdf", "content": b"report %d" % i,
+         "time": START + timedelta(hours=i)} for i in range(3)
+    ])
+    # Claimed by a worker and not linked yet
+    mongo_client.get_mongo_collection(mongodb.SHUCHUANG_COLLECTION_NAME).insert_one(
+        {"_id": "m9:a1", "createdAt": START + timedelta(hours=9)})
+    ids, _ = fetch_all(client, "/api/shuchuang?limit=2")
+    assert ids == ["m2:a1", "m1:a1", "m0:a1"]
+
+    response = client.get("/api/shuchuang/m1:a1/content", headers=AUTH)
+    assert response.data == b"report 1"
+    assert "r1.pdf" in response.headers["Content-Disposition"]
+
+
+def test_invalid_cursor_is_a_bad_request(client, emails):
+    assert client.get("/api/bloomberg?cursor=not-a-cursor", headers=AUTH).status_code == 400
+
+
+def test_api_requires_the_token(client, monkeypatch):
+    assert client.get("/api/bloomberg").status_code == 401
+    assert client.get("/api/bloomberg", headers={"Authorization": "Bearer wrong"}).status_code == 401
+    monkeypatch.setattr(query_api_module, "QUERY_API_TOKEN", None)
+    assert client.get("/api/bloomberg", headers=AUTH).status_code == 404 # Disabled
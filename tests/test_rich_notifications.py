@@ -0,0 +1,109 @@
+import os
+import hmac
+import json
+import base64
+import hashlib
+from datetime import datetime, timedelta, timezone
+import pytest
+from cryptography import x509
+from cryptography.x509.oid import NameOID
+from cryptography.hazmat.primitives import hashes, padding, serialization
+from cryptography.hazmat.primitives.asymmetric import rsa, padding as asymmetric_padding
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from src import rich_notifications
+from src.rich_notifications import NotificationDecryptor, NotificationDecryptionError
+
+MESSAGE = {
+    "id": "AAMk1",
+    "subject": "Rates",
+    "receivedDateTime": "2025-01-01T08:00:00Z",
+    "parentFolderId": "folder-1",
+    "body": {"contentType": "html", "content": "<p>hello</p>"},
+}
+
+
+@pytest.fixture(scope="module")
+def key_pair(tmp_path_factory):
+    """A self-signed certificate and its private key, as the PEM files the service loads."""
+    directory = tmp_path_factory.mktemp("certs")
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "outlook-service-test")])
+    now = datetime.now(timezone.utc)
+    certificate = (x509.CertificateBuilder().subject_name(name).issuer_name(name)
+                   .public_key(key.public_key()).serial_number(x509.random_serial_number())
+                   .not_valid_before(now).not_valid_after(now + timedelta(days=1))
+                   .sign(key, hashes.SHA256()))
+    cert_file, key_file = directory / "test.crt", directory / "test.key"
+    cert_file.write_bytes(certificate.public_bytes(serialization.Encoding.PEM))
+    key_file.write_bytes(key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                                           serialization.NoEncryption()))
+    return str(cert_file), str(key_file), key.public_key()
+
+
+@pytest.fixture
+def decryptor(key_pair):
+    cert_file, key_file, _ = key_pair
+    return NotificationDecryptor(cert_file, key_file, key_password=None, certificate_id="test-cert")
+
+
+def encrypt(public_key, resource, certificate_id="test-cert"):
+    """Encrypt resource data the way Graph does for rich notifications."""
+    key = os.urandom(32)
+    padder = padding.PKCS7(algorithms.AES.block_size).padder()
+    padded = padder.update(json.dumps(resource).encode()) + padder.finalize()
+    encryptor = Cipher(algorithms.AES(key), modes.CBC(key[:16])).encryptor()
+    data = encryptor.update(padded) + encryptor.finalize()
+    data_key = public_key.encrypt(key, asymmetric_padding.OAEP(
+        mgf=asymmetric_padding.MGF1(algorithm=hashes.SHA1()), algorithm=hashes.SHA1(), label=None))
+    return {
+        "data": base64.b64encode(data).decode(),
+        "dataKey": base64.b64encode(data_key).decode(),
+        "dataSignature": base64.b64encode(hmac.new(key, data, hashlib.sha256).digest()).decode(),
+        "encryptionCertificateId": certificate_id,
+    }
+
+
+def test_decrypts_resource_data(decryptor, key_pair):
+    assert decryptor.decrypt(encrypt(key_pair[2], MESSAGE)) == MESSAGE
+
+
+def test_subscription_fields_carry_the_certificate(decryptor):
+    fields = decryptor.subscription_fields()
+    assert fields["includeResourceData"] is True
+    assert fields["encryptionCertificateId"] == "test-cert"
+    x509.load_der_x509_certificate(base64.b64decode(fields["encryptionCertificate"]))
+
+
+def test_rejects_tampered_data(decryptor, key_pair):
+    content = encrypt(key_pair[2], MESSAGE)
+    data = bytearray(base64.b64decode(content["data"]))
+    data[0] ^= 1
+    content["data"] = base64.b64encode(bytes(data)).decode()
+    with pytest.raises(NotificationDecryptionError, match="tampered"):
+        decryptor.decrypt(content)
+
+
+def test_rejects_a_key_not_wrapped_for_us(decryptor):
+    other_key = rsa.generate_private_key(public_exponent=65537, key_size=2048).public_key()
+    with pytest.raises(NotificationDecryptionError):
+        decryptor.decrypt(encrypt(other_key, MESSAGE))
+
+
+def test_rejects_another_certificate(decryptor, key_pair):
+    with pytest.raises(NotificationDecryptionError, match="not ours"):
+        decryptor.decrypt(encrypt(key_pair[2], MESSAGE, certificate_id="rotated-cert"))
+
+
+def test_invalid_resource_data_falls_back_to_fetching(decryptor, key_pair, monkeypatch):
+    from src.outlook_api import OutlookAPI
+    monkeypatch.setattr(rich_notifications, "GRAPH_RICH_NOTIFICATIONS", True)
+    monkeypatch.setattr(rich_notifications, "_decryptor", decryptor)
+    api = OutlookAPI(auth=object())
+
+    content = encrypt(key_pair[2], MESSAGE)
+    assert api.message_from_notification({"encryptedContent": content})["id"] == MESSAGE["id"]
+    content["dataSignature"] = base64.b64encode(b"\0" * 32).decode()
+    assert api.message_from_notification({"encryptedContent": content}) is None
+    # Resource data without the body (a partial $select) is fetched too
+    partial = {k: v for k, v in MESSAGE.items() if k != "body"}
+    assert api.message_from_notification({"encryptedContent": encrypt(key_pair[2], partial)}) is None
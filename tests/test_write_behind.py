@@ -0,0 +1,85 @@
+import pytest
+from src.write_behind import WriteBehindBuffer
+
+
+class FlakyClient:
+    """MongoDBClient stand-in failing the documents (or whole calls) it is told to."""
+    def __init__(self, failing_ids=(), failing_call=None):
+        self.failing_ids = set(failing_ids)
+        self.failing_call = failing_call
+        self.calls = []
+
+    def _insert(self, call, ids, errors):
+        self.calls.append((call, ids))
+        if call == self.failing_call:
+            raise RuntimeError(f"{call} failed")
+        for i in ids:
+            if i in self.failing_ids:
+                errors[i] = RuntimeError(f"{i} failed")
+        return [i for i in ids if i not in self.failing_ids]
+
+    def insert_bloomberg_emails(self, emails, errors=None):
+        return self._insert("bloomberg", [str(e["id"]) for e in emails], errors)
+
+    def insert_shuchuang_attachments(self, attachments, errors=None):
+        return self._insert("shuchuang", [f"{a['email_id']}:{a['id']}" for a in attachments], errors)
+
+
+def attachment(email_id, id):
+    return {"email_id": email_id, "id": id, "content": b"report"}
+
+
+def submit_together(buffer, *requests):
+    """Submit requests into one flush and return their futures."""
+    futures = [buffer.submit(emails, attachments) for emails, attachments in requests]
+    buffer.flush()
+    return futures
+
+
+@pytest.fixture
+def make_buffer():
+    buffers = []
+    def make(client):
+        # A long linger so the requests below are written by a single flush
+        buffer = WriteBehindBuffer(client_factory=lambda: client, max_delay_ms=60_000)
+        buffers.append(buffer)
+        return buffer
+    yield make
+    for buffer in buffers:
+        buffer.close()
+
+
+def test_requests_are_written_together_and_resolved_separately(make_buffer):
+    client = FlakyClient()
+    buffer = make_buffer(client)
+    first, second = submit_together(buffer, ([{"id": "m1"}, {"id": "m2"}], []),
+                                    ([{"id": "m3"}], [attachment("m3", "a1")]))
+    assert (first.result(5), second.result(5)) == (2, 2)
+    assert client.calls == [("bloomberg", ["m1", "m2", "m3"]), ("shuchuang", ["m3:a1"])]
+
+
+def test_failing_document_fails_only_its_request(make_buffer):
+    buffer = make_buffer(FlakyClient(failing_ids={"m3"}))
+    ok, failing = submit_together(buffer, ([{"id": "m1"}], []), ([{"id": "m3"}], []))
+    assert ok.result(5) == 1
+    with pytest.raises(RuntimeError, match="m3 failed"):
+        failing.result(5)
+
+
+def test_failing_call_fails_only_requests_with_that_kind_of_document(make_buffer):
+    buffer = make_buffer(FlakyClient(failing_call="shuchuang"))
+    emails_only, with_attachments = submit_together(
+        buffer, ([{"id": "m1"}], []), ([{"id": "m2"}], [attachment("m2", "a1")]))
+    assert emails_only.result(5) == 1
+    with pytest.raises(RuntimeError, match="shuchuang failed"):
+        with_attachments.result(5)
+
+
+def test_save_writes_to_mongo(mongo_client):
+    buffer = WriteBehindBuffer(client_factory=lambda: mongo_client)
+    try:
+        assert buffer.save([{"id": "m1", "body": "hello"}], [attachment("m1", "a1")]) == 2
+        assert buffer.save([{"id": "m1", "body": "hello"}], []) == 0 # Already stored
+    finally:
+        buffer.close()
+    assert mongo_client.get_bloomberg_email("m1")["body"] == "hello"